@@ -0,0 +1,230 @@
+import os
+import time
+import queue
+import threading
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from f1_optimizer_script import F1Optimizer
+from final_basket_optimizer import write_submission
+from feature_set_io import read_manifest
+from stump_model_compiler import CompiledStumpModel
+
+# Columns of the featured test set that hold the training features under another name
+TEST_TO_TRAIN_COLUMNS = {"time_mean_dow_count": "total_ord_count_p_dow",
+                         "time_mean_ohod_count": "total_ord_count_p_ohod"}
+
+# Marks the end of a stage's output
+_DONE = object()
+
+
+def iter_user_chunks(path, columns, chunk_rows=500_000):
+    """
+    Streams a feature set written by feature_set_io in chunks of about chunk_rows rows that never split
+    a user, so every chunk holds complete candidate sets.
+
+    Parameters:
+    path (str): Directory of the feature set, its manifest must list user_id in sorted_by.
+    columns (list): Columns to read.
+    chunk_rows (int): Rows read at a time. A chunk is larger only when one user has more candidates.
+
+    Yields:
+    pyarrow.Table: The rows of consecutive users.
+    """
+    manifest = read_manifest(path)
+    if "user_id" not in manifest.get("sorted_by", []):
+        raise ValueError(f"{path} is not sorted by user_id, write it again with feature_set_io")
+
+    # Users are contiguous within a file and never span two files unless they follow each other, so only
+    # the rows of the last user of a batch can continue in the next one
+    carry = None
+    for file in manifest["files"]:
+        with manifest["filesystem"].open_input_file(file) as f:
+            for batch in pq.ParquetFile(f).iter_batches(batch_size=chunk_rows, columns=columns):
+                if batch.num_rows == 0:
+                    continue
+                table = pa.Table.from_batches([batch])
+                if carry is not None:
+                    table = pa.concat_tables([carry, table])
+
+                users = table.column("user_id").to_numpy()
+                changes = np.flatnonzero(users[1:] != users[:-1])
+                last_start = changes[-1] + 1 if len(changes) else 0
+                if last_start > 0:
+                    yield table.slice(0, last_start)
+                carry = table.slice(last_start)
+
+    if carry is not None and carry.num_rows:
+        yield carry
+
+
+def _put(outputs, item, stop):
+    # Blocks while the queue is full, unless the pipeline is stopped
+    while not stop.is_set():
+        try:
+            outputs.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+def _run_stage(name, fn, inputs, outputs, stats, stop, time_inputs=False):
+    # Applies fn to every item of inputs, timing it (and producing the item when time_inputs, for the
+    # reading stage), and forwards the results (or the error) downstream
+    rows, busy = 0, 0.0
+    try:
+        inputs = iter(inputs)
+        while not stop.is_set():
+            start = time.perf_counter()
+            item = next(inputs, _DONE)
+            if item is _DONE:
+                break
+            if not time_inputs:
+                start = time.perf_counter()
+            result = fn(item)
+            busy += time.perf_counter() - start
+            rows += result[0] if isinstance(result, tuple) else result.num_rows
+            _put(outputs, result, stop)
+    except BaseException as error:
+        _put(outputs, error, stop)
+    finally:
+        stats[name] = {"rows": rows, "seconds": busy, "rows_per_sec": rows / busy if busy else float("nan")}
+        _put(outputs, _DONE, stop)
+
+
+def _drain(source):
+    while True:
+        item = source.get()
+        if item is _DONE:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+def score_test_set(test_set_path, model, feature_names, chunk_rows=500_000, queue_size=2):
+    """
+    Scores the featured test set chunk by chunk and selects the F1-optimal basket of every user.
+
+    Reading, scoring and basket optimization run in three threads connected by queues of queue_size
+    chunks, so the next chunk is read and scored while the previous one is optimized, and memory holds
+    at most a few chunks whatever the size of the test set.
+
+    Parameters:
+    test_set_path (str): Directory of the featured test set.
+    model: xgb.Booster (its nthread is used) or CompiledStumpModel.
+    feature_names (list): Model input columns in training order, test set columns are renamed to them
+                          with TEST_TO_TRAIN_COLUMNS.
+    chunk_rows (int): Rows per chunk.
+    queue_size (int): Chunks buffered between two stages.
+
+    Returns:
+    tuple: (dict user_id -> (list of product ids, predict None flag), dict of per-stage throughput).
+    """
+    train_to_test = {train: test for test, train in TEST_TO_TRAIN_COLUMNS.items()}
+    test_columns = [train_to_test.get(name, name) for name in feature_names]
+    columns = list(dict.fromkeys(["user_id", "product_id"] + test_columns))
+
+    def score(table):
+        X = np.empty((table.num_rows, len(test_columns)), dtype=np.float32, order="F")
+        for i, name in enumerate(test_columns):
+            X[:, i] = table.column(name).to_numpy(zero_copy_only=False)
+        predictions = model.predict(X) if isinstance(model, CompiledStumpModel) else model.inplace_predict(X)
+        return (table.num_rows, table.column("user_id").to_numpy(), table.column("product_id").to_numpy(),
+                np.asarray(predictions, dtype=np.float64))
+
+    baskets = {}
+
+    def optimize(scored):
+        n_rows, users, products, predictions = scored
+        starts = np.concatenate([[0], np.flatnonzero(users[1:] != users[:-1]) + 1])
+        ends = np.append(starts[1:], n_rows)
+        best_k, predNone, _ = F1Optimizer.maximize_expectation_batch(
+            [predictions[start:end] for start, end in zip(starts, ends)]
+        )
+        for start, end, k, none in zip(starts, ends, best_k, predNone):
+            order = np.argsort(-predictions[start:end], kind="stable")[:k]
+            baskets[users[start]] = (products[start + order].tolist(), bool(none))
+        return scored
+
+    # A failing stage forwards its error to the end of the pipeline, the others are then stopped
+    stats, stop = {}, threading.Event()
+    chunks, scored, optimized = queue.Queue(queue_size), queue.Queue(queue_size), queue.Queue()
+    threads = [
+        threading.Thread(target=_run_stage, args=("read", lambda table: table,
+                                                  iter_user_chunks(test_set_path, columns, chunk_rows), chunks,
+                                                  stats, stop, True)),
+        threading.Thread(target=_run_stage, args=("score", score, _drain(chunks), scored, stats, stop)),
+        threading.Thread(target=_run_stage, args=("optimize", optimize, _drain(scored), optimized, stats, stop)),
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    try:
+        for _ in _drain(optimized):
+            pass
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+
+    elapsed = time.perf_counter() - start
+    stats["total"] = {"rows": stats["read"]["rows"], "seconds": elapsed,
+                      "rows_per_sec": stats["read"]["rows"] / elapsed if elapsed else float("nan")}
+    return baskets, stats
+
+
+def load_model(model_path, n_threads=None):
+    """
+    Loads an XGBoost JSON model, or a compiled .npz model (see stump_model_compiler).
+    """
+    if model_path.endswith(".npz"):
+        return CompiledStumpModel.load(model_path)
+
+    import xgboost as xgb
+
+    booster = xgb.Booster()
+    booster.load_model(model_path)
+    if n_threads:
+        booster.set_param({"nthread": n_threads})
+    return booster
+
+
+def main():
+    root_dir = os.getenv('ROOT_DIR', '')
+    model_path = os.getenv("MODEL_PATH", os.path.join(root_dir, 'models', 'final_xgb_model.json'))
+    test_set_path = os.getenv("TEST_SET_PATH", os.path.join(root_dir, "final-dataset-generator", "featured_test_set"))
+    train_set_path = os.getenv("TRAIN_SET_PATH",
+                               os.path.join(root_dir, "final-dataset-generator", "final_prior_train_set"))
+    orders_file_path = os.getenv("ORDERS_FILE_PATH")
+    n_threads = int(os.getenv("SCORING_THREADS", os.cpu_count()))
+    chunk_rows = int(os.getenv("SCORING_CHUNK_ROWS", 500_000))
+
+    if not orders_file_path:
+        raise ValueError("Please set ORDERS_FILE_PATH in environment variables.")
+
+    model = load_model(model_path, n_threads)
+
+    # The model was trained on every column of the training set but the label, in that order
+    feature_names = getattr(model, "feature_names", None)
+    if not feature_names:
+        train_manifest = read_manifest(train_set_path)
+        feature_names = [col for col in train_manifest["columns"] if col != train_manifest["label"]]
+
+    baskets, stats = score_test_set(test_set_path, model, feature_names, chunk_rows=chunk_rows)
+    for stage, stage_stats in stats.items():
+        print(f"{stage}: {stage_stats['rows']} rows in {stage_stats['seconds']:.1f}s "
+              f"({stage_stats['rows_per_sec']:,.0f} rows/s)")
+
+    orders_df = pd.read_csv(orders_file_path, usecols=["order_id", "user_id", "eval_set"])
+    user_orders = orders_df[orders_df["eval_set"] == "test"][["order_id", "user_id"]]
+
+    output_path = input("Please provide the output file path (e.g., cloud storage path or local path): ")
+    write_submission(baskets, user_orders, os.path.join(output_path, "submission.csv"))
+
+
+if __name__ == "__main__":
+    main()
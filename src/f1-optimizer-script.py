@@ -1,6 +1,15 @@
+import os
+import json
+import time
+import pickle
+import hashlib
+import platform
+import tracemalloc
+import warnings
 import numpy as np
 import pandas as pd
 import matplotlib.pylab as plt
+from collections import OrderedDict
 from datetime import datetime
 
 '''
@@ -14,50 +23,184 @@ under label independence assumption by means of dynamic programming in O(n²).
 '''
 
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+ENGINES = ("python", "numba")
+_compiled_kernel = None
+
+
+def _expectations_kernel(P, pNone, DP_S, DP_SNone):
+    # P sorted in descending order, float64 and contiguous so numba can compile it as is.
+    # DP_S / DP_SNone (length 2n+1) hold E[1/i] and E[1/(i+1)] over the labels after p_n and are updated in place.
+    n = P.shape[0]
+    DP_C = np.zeros((n + 2, n + 1))
+
+    DP_C[0, 0] = 1.0
+    for j in range(1, n):
+        DP_C[0, j] = (1.0 - P[j - 1]) * DP_C[0, j - 1]
+
+    for i in range(1, n + 1):
+        DP_C[i, i] = DP_C[i - 1, i - 1] * P[i - 1]
+        for j in range(i + 1, n + 1):
+            DP_C[i, j] = P[j - 1] * DP_C[i - 1, j - 1] + (1.0 - P[j - 1]) * DP_C[i, j - 1]
+
+    expectations = np.zeros((2, n + 1))
+    for k in range(n, -1, -1):
+        f1 = 0.
+        f1None = 0.
+        for k1 in range(n + 1):
+            f1 += 2 * k1 * DP_C[k1, k] * DP_S[k + k1]
+            f1None += 2 * k1 * DP_C[k1, k] * DP_SNone[k + k1]
+        for i in range(1, 2 * k - 1):
+            DP_S[i] = (1 - P[k - 1]) * DP_S[i] + P[k - 1] * DP_S[i + 1]
+            DP_SNone[i] = (1 - P[k - 1]) * DP_SNone[i] + P[k - 1] * DP_SNone[i + 1]
+        expectations[0, k] = f1None + 2 * pNone / (2 + k)
+        expectations[1, k] = f1
+
+    return expectations
+
+
+def _harmonic_init(n):
+    # no labels after p_n: DP_S[i] = 1/i and DP_SNone[i] = 1/(i+1)
+    DP_S = np.zeros((2 * n + 1,))
+    DP_SNone = np.zeros((2 * n + 1,))
+    DP_S[1:] = 1. / np.arange(1., 2 * n + 1)
+    DP_SNone[1:] = 1. / (np.arange(1., 2 * n + 1) + 1)
+    return DP_S, DP_SNone
+
+
+def _tail_count_init(tail, n):
+    # labels after p_n are summarized by their count T (Poisson-binomial over tail):
+    # DP_S[i] = E[1/(i+T)], DP_SNone[i] = E[1/(i+1+T)].
+    # The distribution of T is truncated far beyond its mean, the dropped mass is returned as well.
+    lam = tail.sum()
+    if lam <= 0:
+        return _harmonic_init(n) + (0.,)
+
+    t_max = min(tail.shape[0], int(np.ceil(lam + 12 * np.sqrt(lam) + 20)))
+    count = np.zeros((t_max + 1,))
+    count[0] = 1.0
+    for p in tail:
+        count[1:] = (1 - p) * count[1:] + p * count[:-1]
+        count[0] *= 1 - p
+
+    i = np.arange(1, 2 * n + 2)[:, None]
+    expected_inverse = (count[None, :] / (i + np.arange(t_max + 1)[None, :])).sum(axis=1)
+
+    DP_S = np.zeros((2 * n + 1,))
+    DP_SNone = np.zeros((2 * n + 1,))
+    DP_S[1:] = expected_inverse[:-1]
+    DP_SNone[1:] = expected_inverse[1:]
+    return DP_S, DP_SNone, max(0., 1. - count.sum())
+
+
+def _resolve_engine(engine):
+    if engine not in ENGINES:
+        raise ValueError("Unknown engine '{}', expected one of {}".format(engine, ENGINES))
+    if engine == "numba" and numba is None:
+        warnings.warn("numba is not installed, falling back to the python engine")
+        return "python"
+    return engine
+
+
+def _get_kernel(engine):
+    global _compiled_kernel
+    if _resolve_engine(engine) == "python":
+        return _expectations_kernel
+    if _compiled_kernel is None:
+        _compiled_kernel = numba.njit(cache=True)(_expectations_kernel)
+    return _compiled_kernel
+
+
+class F1Cache():
+    '''
+    LRU cache of maximize_expectation results keyed by the sorted posteriors rounded to `decimals`
+    and pNone, so baskets whose posteriors barely moved after a model update are not solved again.
+    The cache holds at most maxsize entries and is optionally persisted to `path` with save().
+    '''
+
+    def __init__(self, maxsize=1000000, decimals=4, path=None):
+        self.maxsize = maxsize
+        self.decimals = decimals
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def key(self, P, pNone=None):
+        P = np.round(np.sort(np.asarray(P, dtype=np.float64))[::-1], self.decimals) + 0.
+        digest = hashlib.blake2b(P.tobytes(), digest_size=16)
+        digest.update(b"None" if pNone is None else np.round(np.float64(pNone), self.decimals).tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, result):
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries),
+                "hit_rate": self.hits / lookups if lookups else 0.}
+
+    def save(self, path=None):
+        path = path or self.path
+        with open(path, "wb") as f:
+            pickle.dump({"decimals": self.decimals, "entries": list(self._entries.items())}, f)
+
+    def load(self, path):
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        if state["decimals"] != self.decimals:
+            warnings.warn("Ignoring cache {} built with decimals={}".format(path, state["decimals"]))
+            return
+        for key, result in state["entries"]:
+            self.put(key, result)
+
+
 class F1Optimizer():
-    def __init__(self):
-        pass
+    def __init__(self, engine="python"):
+        self.engine = _resolve_engine(engine)
 
-    @staticmethod
-    def get_expectations(P, pNone=None):
-        expectations = []
-        P = np.sort(P)[::-1]
+    def expectations(self, P, pNone=None):
+        return F1Optimizer.get_expectations(P, pNone, engine=self.engine)
+
+    def maximize(self, P, pNone=None):
+        return F1Optimizer.maximize_expectation(P, pNone, engine=self.engine)
 
-        n = np.array(P).shape[0]
-        DP_C = np.zeros((n + 2, n + 1))
+    @staticmethod
+    def get_expectations(P, pNone=None, engine="python"):
+        P = np.ascontiguousarray(np.sort(P)[::-1], dtype=np.float64)
         if pNone is None:
             pNone = (1.0 - P).prod()
 
-        DP_C[0][0] = 1.0
-        for j in range(1, n):
-            DP_C[0][j] = (1.0 - P[j - 1]) * DP_C[0, j - 1]
-
-        for i in range(1, n + 1):
-            DP_C[i, i] = DP_C[i - 1, i - 1] * P[i - 1]
-            for j in range(i + 1, n + 1):
-                DP_C[i, j] = P[j - 1] * DP_C[i - 1, j - 1] + (1.0 - P[j - 1]) * DP_C[i, j - 1]
-
-        DP_S = np.zeros((2 * n + 1,))
-        DP_SNone = np.zeros((2 * n + 1,))
-        for i in range(1, 2 * n + 1):
-            DP_S[i] = 1. / (1. * i)
-            DP_SNone[i] = 1. / (1. * i + 1)
-        for k in range(n + 1)[::-1]:
-            f1 = 0
-            f1None = 0
-            for k1 in range(n + 1):
-                f1 += 2 * k1 * DP_C[k1][k] * DP_S[k + k1]
-                f1None += 2 * k1 * DP_C[k1][k] * DP_SNone[k + k1]
-            for i in range(1, 2 * k - 1):
-                DP_S[i] = (1 - P[k - 1]) * DP_S[i] + P[k - 1] * DP_S[i + 1]
-                DP_SNone[i] = (1 - P[k - 1]) * DP_SNone[i] + P[k - 1] * DP_SNone[i + 1]
-            expectations.append([f1None + 2 * pNone / (2 + k), f1])
-
-        return np.array(expectations[::-1]).T
+        DP_S, DP_SNone = _harmonic_init(P.shape[0])
+        return _get_kernel(engine)(P, float(pNone), DP_S, DP_SNone)
 
     @staticmethod
-    def maximize_expectation(P, pNone=None):
-        expectations = F1Optimizer.get_expectations(P, pNone)
+    def maximize_expectation(P, pNone=None, engine="python", cache=None):
+        if cache is not None:
+            key = cache.key(P, pNone)
+            result = cache.get(key)
+            if result is not None:
+                return result
+
+        expectations = F1Optimizer.get_expectations(P, pNone, engine)
 
         ix_max = np.unravel_index(expectations.argmax(), expectations.shape)
         max_f1 = expectations[ix_max]
@@ -65,6 +208,182 @@ class F1Optimizer():
         predNone = True if ix_max[0] == 0 else False
         best_k = ix_max[1]
 
+        if cache is not None:
+            cache.put(key, (best_k, predNone, max_f1))
+        return best_k, predNone, max_f1
+
+    @staticmethod
+    def maximize_expectation_approx(P, pNone=None, max_k=None, min_prob=0., start_k=16, engine="python"):
+        '''
+        Approximate maximize_expectation that only evaluates predictions built from a prefix of P.
+
+        Candidates below min_prob, or beyond the first max_k, are never predicted. The DP runs on a
+        window of the top candidates, starting with start_k and doubling while the optimum could
+        still lie beyond it. Labels outside the window are folded into DP_S through the distribution
+        of their count, so the expectations of the evaluated predictions stay exact and a window of
+        size K costs O(K²) plus a linear pass over the remaining candidates.
+
+        The window stops growing once an upper bound on E[F1] of every longer prediction
+        (Jensen on 2TP/(k+TP)) falls below the best expectation found.
+        Returns best_k, predNone, max_f1 and f1_bound, a bound on how much E[F1] is given up
+        against the exact optimum by the predictions that were never evaluated.
+        '''
+        P = np.ascontiguousarray(np.sort(P)[::-1], dtype=np.float64)
+        n = P.shape[0]
+        if pNone is None:
+            pNone = (1.0 - P).prod()
+        pNone = float(pNone)
+
+        limit = int((P >= min_prob).sum())
+        if max_k is not None:
+            limit = min(limit, max_k)
+        window = min(max(start_k, 1), limit)
+
+        kernel = _get_kernel(engine)
+        cum_P = np.cumsum(P)
+        while True:
+            DP_S, DP_SNone, truncated_mass = _tail_count_init(P[window:], window)
+            expectations = kernel(P[:window], pNone, DP_S, DP_SNone)
+
+            ix_max = np.unravel_index(expectations.argmax(), expectations.shape)
+            max_f1 = expectations[ix_max]
+
+            if window < n:
+                k = np.arange(window + 1, n + 1)
+                m = cum_P[window:]
+                outside = max((2 * m / (k + m)).max(), (2 * (m + pNone) / (k + 1 + m + pNone)).max())
+            else:
+                outside = -np.inf
+
+            if window >= limit or outside <= max_f1:
+                break
+            window = min(2 * window, limit)
+
+        predNone = True if ix_max[0] == 0 else False
+        best_k = ix_max[1]
+        f1_bound = max(0., outside - max_f1) + truncated_mass
+
+        return best_k, predNone, max_f1, f1_bound
+
+    @staticmethod
+    def get_expectations_batch(P, lengths, pNone):
+        '''
+        Same dynamic program as get_expectations, evaluated for a whole bucket of baskets at once.
+
+        P is a (B, n) array of posteriors sorted in descending order and right-padded with zeros,
+        lengths holds the real basket sizes and pNone the per-basket p(None|x).
+        Zero padding leaves DP_C and DP_S of the real prefix untouched, so columns k <= lengths[b]
+        are exactly the scalar expectations; the padded columns are set to -inf.
+        Returns a (B, 2, n + 1) array.
+        '''
+        B, n = P.shape
+        Q = 1.0 - P
+        rows = np.arange(n + 2)
+
+        DP_C = np.zeros((B, n + 2, n + 1))
+        DP_C[:, 0, 0] = 1.0
+        for j in range(1, n + 1):
+            p = P[:, j - 1:j]
+            DP_C[:, 1:, j] = p * DP_C[:, :-1, j - 1] + Q[:, j - 1:j] * DP_C[:, 1:, j - 1]
+            DP_C[:, 0, j] = Q[:, j - 1] * DP_C[:, 0, j - 1]
+
+        DP_S = np.zeros((B, 2 * n + 2))
+        DP_SNone = np.zeros((B, 2 * n + 2))
+        DP_S[:, 1:] = 1. / np.arange(1, 2 * n + 2)
+        DP_SNone[:, 1:] = 1. / (np.arange(1, 2 * n + 2) + 1)
+
+        expectations = np.empty((B, 2, n + 1))
+        for k in range(n, -1, -1):
+            weights = 2 * rows[:k + 1] * DP_C[:, :k + 1, k]
+            f1 = (weights * DP_S[:, k:2 * k + 1]).sum(axis=1)
+            f1None = (weights * DP_SNone[:, k:2 * k + 1]).sum(axis=1)
+            if k > 1:
+                p = P[:, k - 1:k]
+                DP_S[:, 1:2 * k - 1] = Q[:, k - 1:k] * DP_S[:, 1:2 * k - 1] + p * DP_S[:, 2:2 * k]
+                DP_SNone[:, 1:2 * k - 1] = Q[:, k - 1:k] * DP_SNone[:, 1:2 * k - 1] + p * DP_SNone[:, 2:2 * k]
+            expectations[:, 0, k] = f1None + 2 * pNone / (2 + k)
+            expectations[:, 1, k] = f1
+
+        padded = np.arange(n + 1)[None, :] > lengths[:, None]
+        expectations[np.broadcast_to(padded[:, None, :], expectations.shape)] = -np.inf
+        return expectations
+
+    @staticmethod
+    def maximize_expectation_batch(list_of_P, pNone=None, max_cells=2 ** 24, cache=None):
+        '''
+        Batched counterpart of maximize_expectation.
+
+        Baskets are sorted by size and grouped into buckets whose padded DP_C tables hold at most
+        max_cells entries, so a handful of vectorized passes replaces one Python DP per basket.
+        pNone is None (estimated per basket), a scalar or one value per basket.
+        With an F1Cache only the baskets missing from it are solved.
+        Returns the arrays best_k, predNone and max_f1 in the order of list_of_P.
+        '''
+        if cache is not None:
+            return F1Optimizer._maximize_expectation_batch_cached(list_of_P, pNone, max_cells, cache)
+
+        list_of_P = [np.sort(np.asarray(P, dtype=np.float64))[::-1] for P in list_of_P]
+        size = len(list_of_P)
+        lengths = np.array([P.shape[0] for P in list_of_P], dtype=np.int64)
+
+        if pNone is None:
+            pNone = np.array([(1.0 - P).prod() for P in list_of_P])
+        else:
+            pNone = np.broadcast_to(np.asarray(pNone, dtype=np.float64), (size,))
+
+        best_k = np.zeros(size, dtype=np.int64)
+        predNone = np.zeros(size, dtype=bool)
+        max_f1 = np.zeros(size)
+
+        order = np.argsort(lengths, kind='stable')
+        start = 0
+        while start < size:
+            # the longest basket of a bucket is its last one, grow the bucket while it fits
+            n = lengths[order[start]]
+            stop = start + 1
+            while stop < size and (stop - start + 1) * (lengths[order[stop]] + 2) ** 2 <= max_cells:
+                n = lengths[order[stop]]
+                stop += 1
+
+            ix = order[start:stop]
+            P = np.zeros((ix.shape[0], n))
+            for row, i in enumerate(ix):
+                P[row, :lengths[i]] = list_of_P[i]
+
+            expectations = F1Optimizer.get_expectations_batch(P, lengths[ix], pNone[ix])
+            flat = expectations.reshape(ix.shape[0], -1).argmax(axis=1)
+            predNone[ix] = flat // (n + 1) == 0
+            best_k[ix] = flat % (n + 1)
+            max_f1[ix] = expectations.reshape(ix.shape[0], -1)[np.arange(ix.shape[0]), flat]
+            start = stop
+
+        return best_k, predNone, max_f1
+
+    @staticmethod
+    def _maximize_expectation_batch_cached(list_of_P, pNone, max_cells, cache):
+        size = len(list_of_P)
+        pNones = [None] * size if pNone is None else np.broadcast_to(np.asarray(pNone, dtype=np.float64), (size,))
+        keys = [cache.key(P, p) for P, p in zip(list_of_P, pNones)]
+
+        best_k = np.zeros(size, dtype=np.int64)
+        predNone = np.zeros(size, dtype=bool)
+        max_f1 = np.zeros(size)
+
+        missing = []
+        for i, key in enumerate(keys):
+            result = cache.get(key)
+            if result is None:
+                missing.append(i)
+            else:
+                best_k[i], predNone[i], max_f1[i] = result
+
+        if missing:
+            missing_pNone = None if pNone is None else np.asarray(pNones)[missing]
+            results = F1Optimizer.maximize_expectation_batch([list_of_P[i] for i in missing], missing_pNone, max_cells)
+            for i, k, none, f1 in zip(missing, *results):
+                best_k[i], predNone[i], max_f1[i] = k, none, f1
+                cache.put(keys[i], (k, bool(none), f1))
+
         return best_k, predNone, max_f1
 
     @staticmethod
@@ -119,31 +438,111 @@ def save_plot(P, filename='expected_f1.png'):
 
 
 
-def timeit(P):
-    s = datetime.now()
-    F1Optimizer.maximize_expectation(P)
-    e = datetime.now()
-    return (e-s).microseconds / 1E6
-
-
-def benchmark(n=100, filename='runtimes.png'):
-    results = pd.DataFrame(index=np.arange(1,n+1))
-    results['runtimes'] = 0
-
-    for i in range(1,n+1):
-        runtimes = []
-        for j in range(5):
-            runtimes.append(timeit(np.sort(np.random.rand(i))[::-1]))
-        results.iloc[i-1] = np.mean(runtimes)
-
-    x = results.index
-    y = results.runtimes
-    results['quadratic fit'] = np.poly1d(np.polyfit(x, y, deg=2))(x)
+BENCHMARK_CASES = {
+    "scalar": lambda baskets: [F1Optimizer.maximize_expectation(P) for P in baskets],
+    "numba": lambda baskets: [F1Optimizer.maximize_expectation(P, engine="numba") for P in baskets],
+    "approx": lambda baskets: [F1Optimizer.maximize_expectation_approx(P) for P in baskets],
+    "batch": lambda baskets: F1Optimizer.maximize_expectation_batch(baskets),
+}
+
+
+def timeit(P, engine="python"):
+    s = time.perf_counter()
+    F1Optimizer.maximize_expectation(P, engine=engine)
+    return time.perf_counter() - s
+
+
+def load_posteriors(path, column="prediction"):
+    # posteriors of a scored set (csv or parquet), used to sample realistic baskets
+    if path.endswith(".csv"):
+        return pd.read_csv(path, usecols=[column])[column].to_numpy(dtype=np.float64)
+    return pd.read_parquet(path, columns=[column])[column].to_numpy(dtype=np.float64)
+
+
+def sample_baskets(n, size, rng, posteriors=None):
+    # without model output, Beta(0.35, 4) mimics its shape: most candidates well below 0.1, a few above 0.5
+    if posteriors is None:
+        return [rng.beta(0.35, 4.0, size=n) for _ in range(size)]
+    return [rng.choice(posteriors, size=n, replace=posteriors.shape[0] < n) for _ in range(size)]
+
+
+def benchmark(sizes=(10, 30, 100, 300, 1000), cases=("scalar", "numba", "approx", "batch"), repeats=5, warmup=1,
+              baskets=4, posteriors=None, seed=0, output_file="f1_benchmark.json"):
+    '''
+    Times every optimizer case on the same random baskets of each size n.
+
+    Each repeat solves `baskets` baskets of size n; timings are reported per basket.
+    The first `warmup` repeats (numba compilation, caches) are reported apart from the median/p95,
+    peak memory is measured with tracemalloc in an extra untimed run.
+    Results and environment details are written to output_file as JSON and returned.
+    '''
+    rng = np.random.default_rng(seed)
+    results = []
+    for n in sizes:
+        runs = [sample_baskets(n, baskets, rng, posteriors) for _ in range(warmup + repeats)]
+        for case in cases:
+            solve = BENCHMARK_CASES[case]
+            runtimes = []
+            for run in runs:
+                s = time.perf_counter()
+                solve(run)
+                runtimes.append((time.perf_counter() - s) / baskets)
+
+            tracemalloc.start()
+            solve(runs[-1])
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            timed = np.array(runtimes[warmup:])
+            results.append({
+                "case": case,
+                "n": int(n),
+                "baskets": baskets,
+                "repeats": repeats,
+                "warmup_s": float(np.mean(runtimes[:warmup])) if warmup else None,
+                "median_s": float(np.median(timed)),
+                "p95_s": float(np.percentile(timed, 95)),
+                "mean_s": float(timed.mean()),
+                "peak_memory_bytes": int(peak_memory),
+            })
+            print("{case:>7} n={n:<5} median={median_s:.6f}s p95={p95_s:.6f}s peak={peak_memory_bytes}B".format(**results[-1]))
+
+    report = {
+        "created": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "numba": numba.__version__ if numba is not None else None,
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "seed": seed,
+        "posteriors": "model output" if posteriors is not None else "beta(0.35, 4)",
+        "results": results,
+    }
+    if output_file is not None:
+        with open(output_file, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def plot_benchmark(report, filename='runtimes.png'):
+    results = pd.DataFrame(report["results"]).pivot(index="n", columns="case", values="median_s")
 
     plt.style.use('ggplot')
     plt.figure()
-    results.plot()
-    plt.title('Expectation Maximization Runtimes', fontsize=12)
+    results.plot(logy=True)
+    plt.title('Expectation Maximization Runtimes (median per basket)', fontsize=12)
     plt.xlabel('n = |P|')
     plt.ylabel('time in seconds')
-    plt.gcf().savefig(filename)
\ No newline at end of file
+    plt.gcf().savefig(filename)
+
+
+def main():
+    posteriors_path = os.getenv("BENCHMARK_POSTERIORS_PATH")
+    output_file = os.getenv("BENCHMARK_OUTPUT_FILE", "f1_benchmark.json")
+
+    posteriors = load_posteriors(posteriors_path) if posteriors_path else None
+    benchmark(posteriors=posteriors, output_file=output_file)
+
+
+if __name__ == "__main__":
+    main()
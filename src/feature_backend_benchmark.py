@@ -0,0 +1,209 @@
+import os
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+from pyspark.sql import SparkSession
+import polars_feature_generator as polars_backend
+import instacart_feature_transformation_script as spark_backend
+from final_dataset_generator import load_datasets, load_datasets_polars, build_test_set
+
+# Key columns of every compared feature set
+FEATURE_SET_KEYS = {
+    "user_features": ["user_id"],
+    "product_features": ["product_id"],
+    "user_product_features": ["user_id", "product_id"],
+    "time_features": ["order_id"],
+    "train_set": None,
+    "test_set": ["user_id", "product_id"],
+}
+
+PRODUCT_WORDS = ["Organic", "Asian", "Gluten Free", "Banana", "Milk", "Yogurt", "Chips", "Water", "Bread", "Cheese"]
+
+
+def generate_instacart_like_dataset(output_dir, n_users=2000, n_products=5000, seed=0):
+    """
+    Writes a synthetic data set with the layout of the Instacart CSVs.
+
+    Users place 4 to 100 orders, products follow a Zipf-like popularity and users tend to rebuy their own
+    products, so streaks, one-shot orders and reorders all occur.
+
+    Parameters:
+    output_dir (str): Directory of the CSVs.
+    n_users (int): Number of users.
+    n_products (int): Number of products.
+    seed (int): Random seed.
+
+    Returns:
+    tuple: Paths of orders.csv, order_products__prior.csv, products.csv and order_products__train.csv.
+    """
+    rng = np.random.default_rng(seed)
+    popularity = 1.0 / np.arange(1, n_products + 1) ** 0.9
+    popularity /= popularity.sum()
+
+    orders, prior_rows, train_rows = [], [], []
+    order_id = 1
+    for user_id in range(1, n_users + 1):
+        n_orders = int(rng.integers(4, 101))
+        favourites = rng.choice(n_products, size=int(rng.integers(5, 40)), replace=False, p=popularity) + 1
+        eval_set = "train" if rng.random() < 0.7 else "test"
+        seen = set()
+        for order_number in range(1, n_orders + 1):
+            is_last = order_number == n_orders
+            orders.append((order_id, user_id, "prior" if not is_last else eval_set, order_number,
+                           int(rng.integers(0, 7)), int(rng.integers(0, 24)),
+                           np.nan if order_number == 1 else float(rng.integers(1, 31))))
+
+            basket_size = int(rng.geometric(0.1))
+            n_favourites = int(rng.binomial(basket_size, 0.6))
+            basket = set(rng.choice(favourites, size=min(n_favourites, len(favourites)), replace=False).tolist())
+            basket.update((rng.choice(n_products, size=basket_size - len(basket), p=popularity) + 1).tolist()
+                          if basket_size > len(basket) else [])
+
+            if not (is_last and eval_set == "test"):
+                rows = train_rows if is_last else prior_rows
+                for position, product_id in enumerate(rng.permutation(sorted(basket)).tolist(), start=1):
+                    rows.append((order_id, product_id, position, int(product_id in seen)))
+            seen.update(basket)
+            order_id += 1
+
+    names = [" ".join(rng.choice(PRODUCT_WORDS, size=2, replace=False)) + f" {product_id}"
+             for product_id in range(1, n_products + 1)]
+    products = pd.DataFrame({"product_id": np.arange(1, n_products + 1), "product_name": names,
+                             "aisle_id": rng.integers(1, 135, n_products),
+                             "department_id": rng.integers(1, 22, n_products)})
+
+    order_products_columns = ["order_id", "product_id", "add_to_cart_order", "reordered"]
+    paths = tuple(os.path.join(output_dir, name) for name in
+                  ["orders.csv", "order_products__prior.csv", "products.csv", "order_products__train.csv"])
+    pd.DataFrame(orders, columns=["order_id", "user_id", "eval_set", "order_number", "order_dow",
+                                  "order_hour_of_day", "days_since_prior_order"]).to_csv(paths[0], index=False)
+    pd.DataFrame(prior_rows, columns=order_products_columns).to_csv(paths[1], index=False)
+    products.to_csv(paths[2], index=False)
+    pd.DataFrame(train_rows, columns=order_products_columns).to_csv(paths[3], index=False)
+    return paths
+
+
+def run_spark_backend(paths):
+    """
+    Runs the Spark feature generation, including the session start-up.
+
+    Returns:
+    tuple: (dict of feature set name -> pd.DataFrame, elapsed seconds).
+    """
+    start = time.perf_counter()
+    spark = SparkSession.builder.appName("feature_backend_benchmark").getOrCreate()
+
+    fet_gen = None
+    try:
+        final_train_product_orders, prior_product_orders, final_train_orders_df, test_orders_df, products_df = \
+            load_datasets(spark, *paths)
+        fet_gen = spark_backend.FeatureGenerator(final_train_product_orders, final_train_orders_df, products_df)
+        test_set = build_test_set(test_orders_df, fet_gen.generate_candidate_index())
+
+        frames = {
+            "user_features": fet_gen.generate_user_related_features(),
+            "product_features": fet_gen.generate_product_related_features(),
+            "user_product_features": fet_gen.generate_user_product_related_features(),
+            "time_features": fet_gen.generate_time_related_features(),
+            "train_set": fet_gen.generate_all_types_of_features(),
+        }
+        frames["test_set"] = spark_backend.generate_test_set_features(
+            frames["user_features"], frames["product_features"], frames["user_product_features"],
+            frames["time_features"], test_set
+        )
+        frames = {name: df.toPandas() for name, df in frames.items()}
+        elapsed = time.perf_counter() - start
+    finally:
+        # The session is stopped whatever happens, the frames are already collected
+        if fet_gen is not None:
+            fet_gen.unpersist()
+        spark.stop()
+    return frames, elapsed
+
+
+def run_polars_backend(paths):
+    """
+    Runs the Polars feature generation.
+
+    Returns:
+    tuple: (dict of feature set name -> pd.DataFrame, elapsed seconds).
+    """
+    start = time.perf_counter()
+
+    final_train_product_orders, prior_product_orders, final_train_orders_df, test_orders_df, products_df = \
+        load_datasets_polars(*paths)
+    fet_gen = polars_backend.FeatureGenerator(final_train_product_orders, final_train_orders_df, products_df)
+    test_set = build_test_set(test_orders_df, fet_gen.generate_candidate_index())
+
+    frames = {
+        "user_features": fet_gen.generate_user_related_features(),
+        "product_features": fet_gen.generate_product_related_features(),
+        "user_product_features": fet_gen.generate_user_product_related_features(),
+        "time_features": fet_gen.generate_time_related_features(),
+        "train_set": fet_gen.generate_all_types_of_features(),
+    }
+    frames["test_set"] = polars_backend.generate_test_set_features(
+        frames["user_features"], frames["product_features"], frames["user_product_features"],
+        frames["time_features"], test_set
+    )
+    frames = {name: df.to_pandas() for name, df in frames.items()}
+    return frames, time.perf_counter() - start
+
+
+def compare_feature_sets(expected, actual, keys=None, rtol=1e-6):
+    """
+    Compares two feature sets row for row, after sorting both on the key columns (every column when None).
+
+    Returns:
+    list: Descriptions of the differences, empty when the feature sets match.
+    """
+    if list(expected.columns) != list(actual.columns):
+        return [f"columns differ: {list(expected.columns)} != {list(actual.columns)}"]
+    if len(expected) != len(actual):
+        return [f"row counts differ: {len(expected)} != {len(actual)}"]
+
+    keys = keys or list(expected.columns)
+    expected = expected.sort_values(keys, kind="stable", na_position="first").reset_index(drop=True)
+    actual = actual.sort_values(keys, kind="stable", na_position="first").reset_index(drop=True)
+
+    differences = []
+    for column in expected.columns:
+        left = expected[column].to_numpy(dtype=np.float64)
+        right = actual[column].to_numpy(dtype=np.float64)
+        mismatched = ~np.isclose(left, right, rtol=rtol, equal_nan=True)
+        if mismatched.any():
+            differences.append(f"{column}: {int(mismatched.sum())} rows differ")
+    return differences
+
+
+def main():
+    # Synthetic data is generated when no directory with the Instacart CSVs is given
+    data_dir = os.getenv("BENCHMARK_DATA_DIR")
+    n_users = int(os.getenv("BENCHMARK_N_USERS", 2000))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if data_dir:
+            paths = tuple(os.path.join(data_dir, name) for name in
+                          ["orders.csv", "order_products__prior.csv", "products.csv", "order_products__train.csv"])
+        else:
+            paths = generate_instacart_like_dataset(tmp_dir, n_users=n_users)
+
+        polars_frames, polars_time = run_polars_backend(paths)
+        spark_frames, spark_time = run_spark_backend(paths)
+
+    print(f"spark: {spark_time:.1f}s, polars: {polars_time:.1f}s ({spark_time / polars_time:.1f}x)")
+
+    mismatches = {}
+    for name, keys in FEATURE_SET_KEYS.items():
+        differences = compare_feature_sets(spark_frames[name], polars_frames[name], keys)
+        print(f"{name}: {len(spark_frames[name])} rows, " + ("match" if not differences else "; ".join(differences)))
+        if differences:
+            mismatches[name] = differences
+
+    if mismatches:
+        raise RuntimeError(f"Polars and Spark feature sets differ: {mismatches}")
+
+
+if __name__ == "__main__":
+    main()
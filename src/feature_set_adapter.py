@@ -0,0 +1,162 @@
+import shutil
+import tempfile
+import threading
+import numpy as np
+import pyarrow.parquet as pq
+from feature_set_io import read_feature_set
+
+
+def h2o_predict(model, frame, label):
+    """
+    Predicts an H2OFrame with a binomial H2O model.
+
+    The positive class probability and the label are exported side by side by the H2O cluster as Parquet,
+    so they stay aligned whatever the row order of the frame, and read back as NumPy arrays.
+
+    Parameters:
+    model: Trained binomial H2O model.
+    frame (H2OFrame): Frame to predict.
+    label (str): Label column of the frame.
+
+    Returns:
+    tuple: (predicted probabilities, labels), as float64 NumPy arrays.
+    """
+    import h2o
+
+    scored = model.predict(frame)["p1"].cbind(frame[label])
+    export_dir = tempfile.mkdtemp(prefix="h2o-predictions-")
+    try:
+        h2o.export_file(scored, f"{export_dir}/predictions", format="parquet", force=True)
+        table = pq.read_table(f"{export_dir}/predictions")
+        preds = table.column("p1").to_numpy(zero_copy_only=False).astype(np.float64)
+        y_true = table.column(label).to_numpy(zero_copy_only=False).astype(np.float64)
+    finally:
+        h2o.remove(scored)
+        shutil.rmtree(export_dir, ignore_errors=True)
+    return preds, y_true
+
+
+class FeatureSetAdapter:
+    """
+    A feature set loaded once and handed to XGBoost, LightGBM and H2O.
+
+    The Parquet files are read once with pyarrow into a single float32 matrix (NaN for missing values)
+    and a label vector, which every library reads in place:
+    - XGBoost builds a QuantileDMatrix (histogram bins only) from it and predicts on it with inplace_predict,
+    - LightGBM bins it into a Dataset without copying it, and predicts on it,
+    - H2O parses the same Parquet files in its own cluster, so it never goes through Python, and its
+      predictions come back as Parquet read into NumPy instead of through pandas.
+    Every library data set is built on first use and then shared, by the models trained concurrently too.
+    """
+
+    def __init__(self, path, feature_names=None, label=None):
+        """
+        Parameters:
+        path (str): Directory of a feature set written by feature_set_io.
+        feature_names (list, optional): Feature columns, in model order. Defaults to every column of the
+                                        manifest but the label.
+        label (str, optional): Label column. Defaults to the label of the manifest.
+        """
+        table, manifest = read_feature_set(path)
+        self.path = path
+        self.label_name = label if label is not None else manifest["label"]
+        self.feature_names = list(feature_names) if feature_names is not None else \
+            [col for col in manifest["columns"] if col != self.label_name]
+        if self.label_name is None:
+            raise ValueError(f"{path} has no label, pass the label column")
+
+        missing = [col for col in self.feature_names + [self.label_name] if col not in manifest["columns"]]
+        if missing:
+            raise NameError(f"{missing} not found in the feature set")
+
+        # Columns are dropped from the table once copied, so the table and the matrix are not both held
+        self.X = np.empty((table.num_rows, len(self.feature_names)), dtype=np.float32)
+        self.label = table.column(self.label_name).to_numpy(zero_copy_only=False).astype(np.float32)
+        table = table.select(self.feature_names)
+        for i in range(len(self.feature_names)):
+            self.X[:, i] = table.column(0).to_numpy(zero_copy_only=False)
+            table = table.remove_column(0)
+
+        # URIs of the files, for H2O to read them as they are
+        self._files = [f"{path.rstrip('/')}/{file.rsplit('/', 1)[-1]}" for file in manifest["files"]]
+        self._data_sets = {}
+        self._lock = threading.Lock()
+
+    @property
+    def num_rows(self):
+        return self.X.shape[0]
+
+    def _cached(self, key, build):
+        # Built once, even when several threads ask for it
+        with self._lock:
+            if key not in self._data_sets:
+                self._data_sets[key] = build()
+            return self._data_sets[key]
+
+    def to_dmatrix(self, mode="quantile", max_bin=256, ref=None, nthread=-1):
+        """
+        XGBoost matrix of the set.
+
+        Parameters:
+        mode (str): "quantile" for a QuantileDMatrix, "dmatrix" for an in-memory DMatrix.
+        max_bin (int): Bins per feature of the quantile matrix, must match the max_bin training parameter.
+        ref (xgb.DMatrix, optional): Training matrix whose bins an evaluation QuantileDMatrix reuses.
+        nthread (int): Threads used to build the matrix.
+
+        Returns:
+        xgb.DMatrix: The matrix.
+        """
+        import xgboost as xgb
+
+        if mode not in ("quantile", "dmatrix"):
+            raise ValueError("mode must be one of ['quantile', 'dmatrix']")
+
+        def build():
+            if mode == "quantile":
+                return xgb.QuantileDMatrix(self.X, label=self.label, feature_names=self.feature_names,
+                                           missing=np.nan, max_bin=max_bin, ref=ref, nthread=nthread)
+            return xgb.DMatrix(self.X, label=self.label, feature_names=self.feature_names, missing=np.nan,
+                               nthread=nthread)
+
+        return self._cached(("xgboost", mode, max_bin, id(ref)), build)
+
+    def to_lgb_dataset(self, reference=None, params=None):
+        """
+        LightGBM Dataset of the set, binned from the shared matrix.
+
+        Parameters:
+        reference (lgb.Dataset, optional): Training Dataset whose bins a validation Dataset reuses.
+        params (dict, optional): Dataset parameters, e.g. max_bin.
+
+        Returns:
+        lgb.Dataset: The constructed Dataset.
+        """
+        import lightgbm as lgb
+
+        def build():
+            return lgb.Dataset(self.X, label=self.label, feature_name=self.feature_names, reference=reference,
+                               params=params).construct()
+
+        return self._cached(("lightgbm", id(reference), tuple(sorted((params or {}).items()))), build)
+
+    def to_h2o_frame(self):
+        """
+        H2OFrame of the set, parsed by the H2O cluster from the Parquet files, with a categorical label.
+
+        Returns:
+        H2OFrame: The frame, with the feature and label columns.
+        """
+        import h2o
+
+        def build():
+            frame = h2o.import_file(self._files)[self.feature_names + [self.label_name]]
+            frame[self.label_name] = frame[self.label_name].asfactor()
+            return frame
+
+        return self._cached(("h2o",), build)
+
+    def predict_h2o(self, model):
+        """
+        Predicts the set with a binomial H2O model, see h2o_predict.
+        """
+        return h2o_predict(model, self.to_h2o_frame(), self.label_name)
@@ -0,0 +1,102 @@
+import os
+import numpy as np
+import pyarrow.parquet as pq
+import xgboost as xgb
+from feature_set_io import read_manifest
+
+# How load_dmatrix builds the matrix
+DMATRIX_MODES = ("quantile", "external", "dmatrix")
+
+
+class FeatureSetIter(xgb.DataIter):
+    """
+    Feeds a feature set written by feature_set_io to XGBoost batch by batch, every file of its manifest
+    in turn, so the whole set is never held in memory as one table.
+    """
+
+    def __init__(self, path, feature_names=None, label=None, batch_rows=None, cache_prefix=None):
+        """
+        Parameters:
+        path (str): Directory of the feature set.
+        feature_names (list, optional): Feature columns, in model order. Defaults to every column of the
+                                        manifest but the label.
+        label (str, optional): Label column. Defaults to the label of the manifest, None for unlabelled sets.
+        batch_rows (int, optional): Rows per batch. Defaults to one batch per file.
+        cache_prefix (str, optional): Cache files prefix, for external memory DMatrix.
+        """
+        self.manifest = read_manifest(path)
+        self.label = label if label is not None else self.manifest["label"]
+        self.feature_names = list(feature_names) if feature_names is not None else \
+            [col for col in self.manifest["columns"] if col != self.label]
+        self.batch_rows = batch_rows
+
+        missing = [col for col in self.feature_names + [self.label] if col is not None
+                   and col not in self.manifest["columns"]]
+        if missing:
+            raise NameError(f"{missing} not found in the feature set")
+
+        self._batches = None
+        super().__init__(cache_prefix=cache_prefix)
+
+    def _iter_batches(self):
+        columns = self.feature_names + ([self.label] if self.label is not None else [])
+        for file in self.manifest["files"]:
+            with self.manifest["filesystem"].open_input_file(file) as f:
+                parquet_file = pq.ParquetFile(f)
+                batches = parquet_file.iter_batches(batch_size=self.batch_rows, columns=columns) \
+                    if self.batch_rows else [parquet_file.read(columns=columns)]
+                for batch in batches:
+                    if batch.num_rows:
+                        yield batch
+
+    def next(self, input_data):
+        if self._batches is None:
+            self._batches = self._iter_batches()
+
+        batch = next(self._batches, None)
+        if batch is None:
+            return False
+
+        data = np.empty((batch.num_rows, len(self.feature_names)), dtype=np.float32)
+        for i, name in enumerate(self.feature_names):
+            data[:, i] = batch.column(name).to_numpy(zero_copy_only=False)
+        label = batch.column(self.label).to_numpy(zero_copy_only=False) if self.label is not None else None
+
+        input_data(data=data, label=label, feature_names=self.feature_names)
+        return True
+
+    def reset(self):
+        self._batches = None
+
+
+def load_dmatrix(path, mode="quantile", feature_names=None, label=None, batch_rows=None, max_bin=256, ref=None,
+                 cache_dir=None, nthread=-1):
+    """
+    Builds an XGBoost matrix from a feature set, chunk by chunk.
+
+    Parameters:
+    path (str): Directory of the feature set.
+    mode (str): "quantile" for a QuantileDMatrix (only the histogram bins are kept in memory, for
+                tree_method hist), "external" for an external memory DMatrix cached under cache_dir,
+                "dmatrix" for an in-memory DMatrix.
+    feature_names, label, batch_rows: See FeatureSetIter.
+    max_bin (int): Bins per feature of the quantile matrix, must match the max_bin training parameter.
+    ref (xgb.DMatrix, optional): Training matrix whose bins an evaluation QuantileDMatrix reuses.
+    cache_dir (str, optional): Directory of the external memory cache. Defaults to the working directory.
+    nthread (int): Threads used to build the matrix.
+
+    Returns:
+    xgb.DMatrix: The matrix.
+    """
+    if mode not in DMATRIX_MODES:
+        raise ValueError(f"mode must be one of {list(DMATRIX_MODES)}")
+
+    if mode == "external":
+        cache_prefix = os.path.join(cache_dir or os.getcwd(), "xgb-cache")
+        return xgb.DMatrix(FeatureSetIter(path, feature_names, label, batch_rows, cache_prefix=cache_prefix),
+                           missing=np.nan, nthread=nthread)
+
+    iterator = FeatureSetIter(path, feature_names, label, batch_rows)
+    if mode == "quantile":
+        return xgb.QuantileDMatrix(iterator, missing=np.nan, max_bin=max_bin, ref=ref, nthread=nthread)
+    return xgb.DMatrix(iterator, missing=np.nan, nthread=nthread)
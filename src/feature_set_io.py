@@ -0,0 +1,139 @@
+import os
+import json
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+
+# Written next to the Parquet files of every feature set, lists them with the column order and types
+MANIFEST_FILE = "_manifest.json"
+
+
+def _manifest(columns, dtypes, files, label, compression, num_rows=None, sorted_by=None):
+    return {
+        "format": "parquet",
+        "compression": compression,
+        "columns": list(columns),
+        "dtypes": dict(zip(columns, dtypes)),
+        "label": label,
+        "files": files,
+        "num_rows": num_rows,
+        "sorted_by": sorted_by or [],
+    }
+
+
+def write_feature_set(df, path, label=None, num_files=None, compression="zstd"):
+    """
+    Writes a Spark feature set as compressed Parquet files in parallel, followed by its manifest.
+
+    Feature sets with a user_id column are written user by user: every user is in a single file, sorted
+    by user_id, so they can be streamed in user-aligned chunks (see batch_scorer).
+
+    Parameters:
+    df (DataFrame): The feature set, its column order is kept.
+    path (str): Output directory (any Hadoop-compatible path).
+    label (str, optional): Name of the label column, recorded in the manifest.
+    num_files (int, optional): Number of files. Defaults to spark.sql.shuffle.partitions for feature sets
+                               with a user_id column, to the number of partitions of df otherwise.
+    compression (str): Parquet codec.
+
+    Returns:
+    dict: The manifest.
+    """
+    if label is not None and label not in df.columns:
+        raise NameError(f"'{label}' not found in the feature set")
+
+    sorted_by = ["user_id"] if "user_id" in df.columns else []
+    if sorted_by:
+        df = (df.repartition(num_files, "user_id") if num_files is not None else df.repartition("user_id")) \
+            .sortWithinPartitions("user_id")
+    elif num_files is not None:
+        df = df.repartition(num_files)
+    df.write.mode("overwrite").option("compression", compression).parquet(path)
+
+    spark = df.sparkSession
+    jvm_path = spark._jvm.org.apache.hadoop.fs.Path(path)
+    fs = jvm_path.getFileSystem(spark._jsc.hadoopConfiguration())
+    files = sorted(
+        status.getPath().getName() for status in fs.listStatus(jvm_path)
+        if status.getPath().getName().endswith(".parquet") and not status.getPath().getName().startswith(("_", "."))
+    )
+
+    manifest = _manifest(df.columns, [dtype for _, dtype in df.dtypes], files, label, compression,
+                         sorted_by=sorted_by)
+    stream = fs.create(spark._jvm.org.apache.hadoop.fs.Path(f"{path.rstrip('/')}/{MANIFEST_FILE}"), True)
+    stream.write(bytearray(json.dumps(manifest, indent=2).encode("utf-8")))
+    stream.close()
+    return manifest
+
+
+def write_feature_set_polars(df, path, label=None, rows_per_file=1_000_000, compression="zstd"):
+    """
+    Polars counterpart of write_feature_set (local paths), writing one file per rows_per_file rows.
+
+    Returns:
+    dict: The manifest.
+    """
+    if label is not None and label not in df.columns:
+        raise NameError(f"'{label}' not found in the feature set")
+
+    sorted_by = ["user_id"] if "user_id" in df.columns else []
+    if sorted_by:
+        df = df.sort(sorted_by, maintain_order=True)
+
+    os.makedirs(path, exist_ok=True)
+    files = []
+    for i, offset in enumerate(range(0, max(df.height, 1), rows_per_file)):
+        files.append(f"part-{i:05d}.parquet")
+        df.slice(offset, rows_per_file).write_parquet(os.path.join(path, files[-1]), compression=compression)
+
+    manifest = _manifest(df.columns, [str(dtype) for dtype in df.dtypes], files, label, compression, df.height,
+                         sorted_by)
+    with open(os.path.join(path, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def _filesystem(path):
+    if "://" in path:
+        return pafs.FileSystem.from_uri(path)
+    return pafs.LocalFileSystem(), os.path.abspath(path)
+
+
+def read_manifest(path):
+    """
+    Reads the manifest of the feature set written to path.
+
+    Returns:
+    dict: The manifest, with "files" resolved to paths on its "filesystem" (a pyarrow FileSystem).
+    """
+    fs, root = _filesystem(path)
+    try:
+        with fs.open_input_stream(f"{root.rstrip('/')}/{MANIFEST_FILE}") as f:
+            manifest = json.loads(f.read().decode("utf-8"))
+    except FileNotFoundError:
+        raise FileNotFoundError(f"No {MANIFEST_FILE} in {path}, was it written by feature_set_io?")
+
+    manifest["files"] = [f"{root.rstrip('/')}/{name}" for name in manifest["files"]]
+    manifest["filesystem"] = fs
+    return manifest
+
+
+def read_feature_set(path, columns=None):
+    """
+    Reads a feature set from its manifest, every file in parallel.
+
+    Parameters:
+    path (str): Directory of the feature set.
+    columns (list, optional): Columns to read. Defaults to every column, in the manifest order.
+
+    Returns:
+    tuple: (pyarrow.Table, manifest).
+    """
+    manifest = read_manifest(path)
+    columns = columns if columns is not None else manifest["columns"]
+
+    missing = [col for col in columns if col not in manifest["columns"]]
+    if missing:
+        raise NameError(f"{missing} not found in the feature set")
+
+    table = pq.read_table(manifest["files"], columns=columns, filesystem=manifest["filesystem"], use_threads=True)
+    return table.select(columns), manifest
@@ -0,0 +1,231 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from f1_optimizer_script import F1Optimizer, F1Cache
+
+# Shared-memory views (and the optional F1 cache) attached once per worker process
+_shared_arrays = {}
+_worker_cache = None
+
+
+def load_scored_set(path, user_col="user_id", product_col="product_id", prob_col="prediction", order_col="order_id"):
+    """
+    Loads the scored test set (one row per user/product candidate) from Parquet or CSV.
+
+    Parameters:
+    path (str): A Parquet file/directory or a CSV file.
+    user_col, product_col, prob_col (str): Names of the user, product and probability columns.
+    order_col (str): Optional order id column, kept when present.
+
+    Returns:
+    pd.DataFrame: The table with columns user_id, product_id, prediction (and order_id if present).
+    """
+    if path.endswith(".csv"):
+        scored_set = pd.read_csv(path)
+    else:
+        scored_set = pd.read_parquet(path)
+
+    columns = {user_col: "user_id", product_col: "product_id", prob_col: "prediction"}
+    if order_col in scored_set.columns:
+        columns[order_col] = "order_id"
+
+    missing = [col for col in columns if col not in scored_set.columns]
+    if missing:
+        raise NameError(f"{missing} not found in the scored set")
+
+    return scored_set[list(columns)].rename(columns=columns)
+
+
+class _RecordingF1Cache(F1Cache):
+    """
+    Worker-side F1Cache that records the entries it solves, so only those are sent back to the parent.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.added = []
+        super().__init__(*args, **kwargs)
+        # Entries loaded from the persisted cache are already in the parent's
+        self.added = []
+
+    def put(self, key, result):
+        super().put(key, result)
+        self.added.append((key, result))
+
+
+def _to_shared_memory(array):
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+    return shm
+
+
+def _attach_shared_arrays(specs, cache_path=None):
+    global _worker_cache
+    for key, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _shared_arrays[key] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    if cache_path is not None:
+        _worker_cache = _RecordingF1Cache(path=cache_path)
+
+
+def _optimize_users(first, last):
+    """
+    Runs the batched F1 optimizer for users first..last-1 of the shared arrays.
+
+    Returns:
+    tuple: (first, predNone, best_k, max_f1, selected, cache stats, cache entries) where selected holds
+           the row positions of the chosen products, user after user, and cache entries the (key, result)
+           pairs of the users missing from the cache.
+    """
+    offsets = _shared_arrays["offsets"][1]
+    probs = _shared_arrays["probs"][1]
+
+    orders = []
+    for user in range(first, last):
+        P = probs[offsets[user]:offsets[user + 1]]
+        orders.append(np.argsort(-P, kind="stable"))
+
+    if _worker_cache is not None:
+        _worker_cache.hits = _worker_cache.misses = 0
+        _worker_cache.added = []
+    best_k, predNone, max_f1 = F1Optimizer.maximize_expectation_batch(
+        [probs[offsets[user]:offsets[user + 1]] for user in range(first, last)], cache=_worker_cache
+    )
+
+    selected = [offsets[user] + order[:k] for user, order, k in zip(range(first, last), orders, best_k)]
+    selected = np.concatenate(selected) if selected else np.zeros(0, dtype=np.int64)
+    stats = _worker_cache.stats() if _worker_cache is not None else None
+    added = _worker_cache.added if _worker_cache is not None else []
+    return first, predNone, best_k, max_f1, selected, stats, added
+
+
+def make_chunks(offsets, n_chunks):
+    """
+    Splits users into contiguous chunks of roughly equal O(n²) optimizer cost.
+
+    Returns:
+    list: (first, last) user index ranges.
+    """
+    sizes = np.diff(offsets).astype(np.float64)
+    cost = np.cumsum((sizes + 2) ** 2)
+    if cost.shape[0] == 0:
+        return []
+
+    bounds = np.searchsorted(cost, np.linspace(0, cost[-1], n_chunks + 1)[1:-1], side="right")
+    bounds = np.unique(np.concatenate(([0], bounds, [sizes.shape[0]])))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def optimize_baskets(scored_set, n_workers=None, chunks_per_worker=8, cache_path=None):
+    """
+    Selects the F1-optimal basket of every user with a pool of worker processes.
+
+    Candidates are sorted by user and their probabilities are placed in shared memory, so
+    workers only receive (first, last) user ranges instead of pickled DataFrames.
+
+    Parameters:
+    scored_set (pd.DataFrame): Columns user_id, product_id and prediction.
+    n_workers (int, optional): Number of processes. Defaults to the number of cores.
+    chunks_per_worker (int): Chunks submitted per worker, to balance uneven users.
+    cache_path (str, optional): Persisted F1Cache. Workers read it, new results are added to it
+                                and it is saved back once all baskets are solved.
+
+    Returns:
+    dict: user_id -> (list of product ids, predict None flag).
+    """
+    n_workers = n_workers or os.cpu_count()
+
+    scored_set = scored_set.sort_values("user_id", kind="stable")
+    user_ids, first_rows = np.unique(scored_set["user_id"].to_numpy(), return_index=True)
+    offsets = np.append(first_rows, len(scored_set)).astype(np.int64)
+    probs = scored_set["prediction"].to_numpy(dtype=np.float64)
+    product_ids = scored_set["product_id"].to_numpy()
+
+    shms = {"probs": _to_shared_memory(probs), "offsets": _to_shared_memory(offsets)}
+    specs = {
+        "probs": (shms["probs"].name, probs.shape, probs.dtype),
+        "offsets": (shms["offsets"].name, offsets.shape, offsets.dtype),
+    }
+
+    cache = F1Cache(path=cache_path) if cache_path is not None else None
+    baskets = {}
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_attach_shared_arrays,
+                                 initargs=(specs, cache_path)) as executor:
+            futures = [executor.submit(_optimize_users, first, last)
+                       for first, last in make_chunks(offsets, n_workers * chunks_per_worker)]
+
+            for future in as_completed(futures):
+                first, predNone, best_k, max_f1, selected, stats, added = future.result()
+                position = 0
+                for i, (k, none) in enumerate(zip(best_k, predNone)):
+                    baskets[user_ids[first + i]] = (product_ids[selected[position:position + k]].tolist(), bool(none))
+                    position += k
+
+                if cache is not None:
+                    cache.hits += stats["hits"]
+                    cache.misses += stats["misses"]
+                    # Keys are hashed by the workers, and only their misses are new to the cache
+                    for key, result in added:
+                        cache.put(key, result)
+    finally:
+        for shm in shms.values():
+            shm.close()
+            shm.unlink()
+
+    if cache is not None:
+        cache.save()
+        print(f"F1 cache: {cache.stats()}")
+    return baskets
+
+
+def write_submission(baskets, user_orders, output_file):
+    """
+    Writes the order_id -> products submission file.
+
+    Parameters:
+    baskets (dict): user_id -> (list of product ids, predict None flag).
+    user_orders (pd.DataFrame): Columns order_id and user_id of the orders to predict.
+    output_file (str): Path of the CSV to write.
+    """
+    rows = []
+    for order_id, user_id in zip(user_orders["order_id"], user_orders["user_id"]):
+        products, predNone = baskets.get(user_id, ([], True))
+        tokens = (["None"] if predNone else []) + [str(int(product)) for product in products]
+        rows.append((int(order_id), " ".join(tokens) if tokens else "None"))
+
+    pd.DataFrame(rows, columns=["order_id", "products"]).to_csv(output_file, index=False)
+
+
+def main():
+    scored_set_path = os.getenv("SCORED_TEST_SET_PATH")
+    orders_file_path = os.getenv("ORDERS_FILE_PATH")
+    n_workers = int(os.getenv("N_WORKERS", os.cpu_count()))
+    cache_path = os.getenv("F1_CACHE_PATH")
+
+    if not scored_set_path:
+        raise ValueError("Please set SCORED_TEST_SET_PATH in environment variables.")
+
+    scored_set = load_scored_set(scored_set_path)
+
+    if "order_id" in scored_set.columns:
+        user_orders = scored_set[["order_id", "user_id"]].drop_duplicates()
+    elif orders_file_path:
+        orders_df = pd.read_csv(orders_file_path, usecols=["order_id", "user_id", "eval_set"])
+        user_orders = orders_df[orders_df["eval_set"] == "test"][["order_id", "user_id"]]
+    else:
+        raise ValueError("The scored set has no order_id column, please set ORDERS_FILE_PATH.")
+
+    start = time.time()
+    baskets = optimize_baskets(scored_set[["user_id", "product_id", "prediction"]], n_workers=n_workers,
+                               cache_path=cache_path)
+    print(f"Optimized {len(baskets)} baskets with {n_workers} workers in {time.time() - start:.1f}s")
+
+    output_path = input("Please provide the output file path (e.g., cloud storage path or local path): ")
+    write_submission(baskets, user_orders, os.path.join(output_path, "submission.csv"))
+
+
+if __name__ == "__main__":
+    main()
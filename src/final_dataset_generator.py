@@ -1,73 +1,203 @@
 import os
+import json
+import logging
 import numpy as np
 import pandas as pd
 from pyspark.sql import SparkSession
 import pyspark.sql.functions as F
-from instacart_feature_transformation_script import FeatureGenerator, generate_test_set_features
+import polars as pl
+import polars_feature_generator as polars_backend
+from instacart_feature_transformation_script import (FeatureGenerator, generate_test_set_features, assemble_training_set,
+                                                     select_candidates, generate_time_constants,
+                                                     DEFAULT_PRODUCT_ATTRIBUTES)
+from incremental_feature_store import IncrementalFeatureStore
+from raw_data_cache import RAW_TABLES, read_raw_tables, read_raw_tables_polars
+from feature_set_io import write_feature_set, write_feature_set_polars, read_feature_set
+from online_feature_store import build_online_store
+
+# Per-entity feature tables loaded into the online store
+ONLINE_FEATURE_TABLES = ["user_features", "product_features", "user_product_features"]
+
+
+def load_datasets(spark, orders_file_path, prior_product_orders_file_path, products_file_path,
+                  train_product_orders_file_path, cache_path=None, days_since_type="float"):
+    """
+    Reads the Instacart tables with their typed schemas and splits them into the frames the feature
+    generation needs.
+
+    Parameters:
+    cache_path (str, optional): Columnar cache of the CSVs, created on first use (see raw_data_cache).
+    days_since_type (str): "float" or "double" for days_since_prior_order.
+
+    Returns:
+    tuple: (train + prior order products, prior order products, train + prior orders, test orders, products).
+    """
+    # Load datasets
+    tables = read_raw_tables(spark, dict(zip(RAW_TABLES, [orders_file_path, prior_product_orders_file_path,
+                                                          products_file_path, train_product_orders_file_path])),
+                             cache_path=cache_path, days_since_type=days_since_type)
+    orders_df = tables["orders"]
+    prior_product_orders = tables["order_products__prior"]
+    products_df = tables["products"]
+    train_product_orders = tables["order_products__train"]
 
+    # Union of train product orders and prior product orders
+    final_train_product_orders = train_product_orders.union(prior_product_orders)
 
-def main():
-    # Initialize Spark session
-    spark = SparkSession.builder.appName("instamart_analysis") \
-        .config("spark.driver.memory", "25g") \
-        .getOrCreate()
+    # Filter orders into training and test sets
+    final_train_orders_df = orders_df.filter(F.col("eval_set") != 'test').drop('eval_set')
+    test_orders_df = orders_df.filter(F.col("eval_set") == 'test').select("order_id", "user_id")
+
+    return final_train_product_orders, prior_product_orders, final_train_orders_df, test_orders_df, products_df
+
+
+def load_datasets_polars(orders_file_path, prior_product_orders_file_path, products_file_path,
+                         train_product_orders_file_path, cache_path=None, days_since_type="float"):
+    """
+    Polars counterpart of load_datasets, returning LazyFrames with the same columns and types.
+    """
+    tables = read_raw_tables_polars(dict(zip(RAW_TABLES, [orders_file_path, prior_product_orders_file_path,
+                                                          products_file_path, train_product_orders_file_path])),
+                                    cache_path=cache_path, days_since_type=days_since_type)
+    orders_df = tables["orders"]
+    prior_product_orders = tables["order_products__prior"]
+    products_df = tables["products"]
+    train_product_orders = tables["order_products__train"]
 
+    final_train_product_orders = pl.concat([train_product_orders, prior_product_orders])
+
+    final_train_orders_df = orders_df.filter(pl.col("eval_set") != 'test').drop('eval_set')
+    test_orders_df = orders_df.filter(pl.col("eval_set") == 'test').select("order_id", "user_id")
+
+    return final_train_product_orders, prior_product_orders, final_train_orders_df, test_orders_df, products_df
+
+
+def build_test_set(test_orders_df, candidate_index):
+    # Candidates of a test order: every product of the user's prior orders, looked up in the index by user
+    if isinstance(test_orders_df, pl.LazyFrame):
+        return polars_backend.select_candidates(candidate_index, test_orders_df)
+
+    return select_candidates(candidate_index, test_orders_df)
+
+
+def run_polars_backend(orders_file_path, prior_product_orders_file_path, products_file_path,
+                       train_product_orders_file_path, cache_path=None, days_since_type="float",
+                       product_attributes=None, online_store_path=None):
+    """
+    Generates the train and test feature sets in process with the Polars backend, without starting Spark.
+    """
+    (final_train_product_orders, prior_product_orders, final_train_orders_df, test_orders_df,
+     products_df) = load_datasets_polars(orders_file_path, prior_product_orders_file_path, products_file_path,
+                                         train_product_orders_file_path, cache_path, days_since_type)
+
+    fet_gen = polars_backend.FeatureGenerator(final_train_product_orders, final_train_orders_df, products_df,
+                                              product_attributes=product_attributes)
+    final_prior_train_set = fet_gen.generate_all_types_of_features()
+
+    test_set = build_test_set(test_orders_df, fet_gen.generate_candidate_index())
+    featured_test_set = polars_backend.generate_test_set_features(
+        fet_gen.generate_user_related_features(), fet_gen.generate_product_related_features(),
+        fet_gen.generate_user_product_related_features(), fet_gen.generate_time_related_features(), test_set
+    )
+
+    output_path = input("Please provide the output file path (e.g., cloud storage path or local path): ")
+
+    # Same layout as the Spark job: Parquet files and a manifest per data set
+    write_feature_set_polars(final_prior_train_set, os.path.join(output_path, "final_prior_train_set"), label="reordered")
+    write_feature_set_polars(featured_test_set, os.path.join(output_path, "featured_test_set"))
+
+    if online_store_path:
+        build_online_store(online_store_path, fet_gen.generate_user_related_features(),
+                           fet_gen.generate_product_related_features(), fet_gen.generate_user_product_related_features(),
+                           polars_backend.generate_time_constants(fet_gen.generate_time_related_features()))
+
+
+def main():
     # Get file paths from environment variables
     orders_file_path = os.getenv("ORDERS_FILE_PATH")
     prior_product_orders_file_path = os.getenv("PRIOR_PRODUCT_ORDERS_FILE_PATH")
     products_file_path = os.getenv("PRODUCTS_FILE_PATH")
     train_product_orders_file_path = os.getenv("TRAIN_PRODUCT_ORDERS_FILE_PATH")
+    # Optional incremental mode: keep features in a store and only merge in the new orders
+    feature_store_path = os.getenv("FEATURE_STORE_PATH")
+    new_orders_file_path = os.getenv("NEW_ORDERS_FILE_PATH")
+    # "spark" (default) or "polars" to compute the features in process on a single machine
+    feature_backend = os.getenv("FEATURE_BACKEND", "spark")
+    # Optional Parquet copy of the CSVs, written by the first run and read by the next ones
+    raw_data_cache_path = os.getenv("RAW_DATA_CACHE_PATH")
+    days_since_type = os.getenv("DAYS_SINCE_PRIOR_ORDER_TYPE", "float")
+    # Number of Parquet files of each output feature set, defaults to Spark's partitioning
+    feature_set_num_files = int(os.getenv("FEATURE_SET_NUM_FILES")) if os.getenv("FEATURE_SET_NUM_FILES") else None
+    # Extra product attributes as JSON, e.g. {"vegan": "vegan", "kosher": "kosher"}
+    product_attributes = {**DEFAULT_PRODUCT_ATTRIBUTES, **json.loads(os.getenv("PRODUCT_ATTRIBUTES", "{}"))}
+    # Estimated size under which the generator broadcasts its product, day and hour tables, -1 disables it.
+    # Defaults to spark.sql.autoBroadcastJoinThreshold
+    broadcast_threshold = int(os.getenv("BROADCAST_THRESHOLD_BYTES")) if os.getenv("BROADCAST_THRESHOLD_BYTES") else None
+    # Optional local directory of the online feature store (see online_feature_store), rebuilt by every run
+    online_store_path = os.getenv("ONLINE_STORE_PATH")
+
+    # The generator logs the physical join strategy of every feature family
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
 
     if not all([orders_file_path, prior_product_orders_file_path, products_file_path, train_product_orders_file_path]):
         raise ValueError("Please set all the required file paths in environment variables.")
 
-    # Load datasets
-    orders_df = spark.read.csv(orders_file_path, header=True)
-    prior_product_orders = spark.read.csv(prior_product_orders_file_path, header=True)
-    products_df = spark.read.csv(products_file_path, header=True)
-    train_product_orders = spark.read.csv(train_product_orders_file_path, header=True)
-
-    # Type casting for prior product orders dataframe
-    prior_product_orders = prior_product_orders.select(
-        [F.col(col).cast("float").alias(col) for col in prior_product_orders.columns]
-    )
+    if feature_backend not in ("spark", "polars"):
+        raise ValueError(f"Unknown FEATURE_BACKEND '{feature_backend}', expected 'spark' or 'polars'.")
 
-    # Convert string column to float for orders dataframe
-    orders_df = orders_df.select(
-        [F.col(col).cast("float").alias(col) if col != 'eval_set' else F.col(col).alias(col) for col in orders_df.columns]
-    )
-
-    # Type casting for train product orders
-    train_product_orders = train_product_orders.select(
-        [F.col(col).cast("float").alias(col) for col in prior_product_orders.columns]
-    )
+    if feature_backend == "polars":
+        if feature_store_path:
+            raise ValueError("FEATURE_STORE_PATH is only supported by the spark backend.")
+        run_polars_backend(orders_file_path, prior_product_orders_file_path, products_file_path,
+                           train_product_orders_file_path, raw_data_cache_path, days_since_type, product_attributes,
+                           online_store_path)
+        return
 
-    # Union of train product orders and prior product orders
-    final_train_product_orders = train_product_orders.union(prior_product_orders)
+    # Initialize Spark session
+    spark = SparkSession.builder.appName("instamart_analysis") \
+        .config("spark.driver.memory", "25g") \
+        .getOrCreate()
 
-    # Filter orders into training and test sets
-    final_train_orders_df = orders_df.filter(F.col("eval_set") != 'test').drop('eval_set')
-    test_orders_df = orders_df.filter(F.col("eval_set") == 'test').select("order_id", "user_id")
+    (final_train_product_orders, prior_product_orders, final_train_orders_df, test_orders_df,
+     products_df) = load_datasets(spark, orders_file_path, prior_product_orders_file_path, products_file_path,
+                                  train_product_orders_file_path, raw_data_cache_path, days_since_type)
 
     # Feature generation
-    fet_gen = FeatureGenerator(final_train_product_orders, final_train_orders_df, products_df)
-
-    result_df = fet_gen.generate_user_related_features()
-    result_prod_df = fet_gen.generate_product_related_features()
-    result_user_prod_df = fet_gen.generate_user_product_related_features()
-    result_time_df = fet_gen.generate_time_related_features()
-
-    # Generate all features for the training set
-    final_prior_train_set = fet_gen.generate_all_types_of_features()
-
-    # Create test set from training data
-    test_set = (
-        test_orders_df.select("user_id")
-            .join(final_train_orders_df, on='user_id', how='left')
-            .select("user_id", "order_id")
-            .join(prior_product_orders.select("order_id", "product_id"), on='order_id', how='left')
-            .select("user_id", "product_id").distinct()
-    )
+    if feature_store_path:
+        store = IncrementalFeatureStore(spark, feature_store_path, product_attributes=product_attributes)
+        if new_orders_file_path and store.exists():
+            new_orders_df = spark.read.csv(new_orders_file_path, header=True).select(F.col("user_id").cast("int"))
+            store.refresh(final_train_product_orders, final_train_orders_df, products_df, new_orders_df)
+        else:
+            store.build(final_train_product_orders, final_train_orders_df, products_df)
+
+        result_df, result_prod_df, result_user_prod_df, result_time_df = store.load_features(final_train_orders_df)
+
+        # Generate all features for the training set
+        final_prior_train_set = assemble_training_set(final_train_product_orders, result_df, result_prod_df,
+                                                      result_user_prod_df, result_time_df)
+
+        # The stored user x product features hold every pair of the user's history
+        candidate_index = (
+            result_user_prod_df.select("user_id", "product_id")
+            .repartition("user_id")
+            .sortWithinPartitions("user_id", "product_id")
+        )
+    else:
+        fet_gen = FeatureGenerator(final_train_product_orders, final_train_orders_df, products_df,
+                                   product_attributes=product_attributes, broadcast_threshold=broadcast_threshold)
+
+        result_df = fet_gen.generate_user_related_features()
+        result_prod_df = fet_gen.generate_product_related_features()
+        result_user_prod_df = fet_gen.generate_user_product_related_features()
+        result_time_df = fet_gen.generate_time_related_features()
+
+        # Generate all features for the training set
+        final_prior_train_set = fet_gen.generate_all_types_of_features()
+        candidate_index = fet_gen.generate_candidate_index()
+
+    # Create test set from the candidate index
+    test_set = build_test_set(test_orders_df, candidate_index)
 
     # Feature engineering for the test set
     featured_test_set = generate_test_set_features(result_df, result_prod_df, result_user_prod_df, result_time_df, test_set)
@@ -75,18 +205,19 @@ def main():
     # Ask user for output path
     output_path = input("Please provide the output file path (e.g., cloud storage path or local path): ")
 
-    # Write final datasets to the output path
-    final_prior_train_set.coalesce(1).write.csv(os.path.join(output_path, "final_prior_train_set.csv"))
-    featured_test_set.coalesce(1).write.csv(os.path.join(output_path, "featured_test_set.csv"))
-
-    # Save columns to text files
-    with open(os.path.join(output_path, "train_set_columns.txt"), 'w') as f:
-        for column in final_prior_train_set.columns:
-            f.write('%s,' % column)
-
-    with open(os.path.join(output_path, "test_set_columns.txt"), 'w') as f:
-        for column in featured_test_set.columns:
-            f.write('%s,' % column)
+    # Write final datasets to the output path, in parallel, with a manifest listing the files
+    write_feature_set(final_prior_train_set, os.path.join(output_path, "final_prior_train_set"), label="reordered",
+                      num_files=feature_set_num_files)
+    write_feature_set(featured_test_set, os.path.join(output_path, "featured_test_set"),
+                      num_files=feature_set_num_files)
+
+    # The per-entity tables go through Parquet, the online store is then built from the local copies
+    if online_store_path:
+        for name, df in zip(ONLINE_FEATURE_TABLES, [result_df, result_prod_df, result_user_prod_df]):
+            write_feature_set(df, os.path.join(output_path, name), num_files=feature_set_num_files)
+        build_online_store(online_store_path,
+                           *[read_feature_set(os.path.join(output_path, name))[0] for name in ONLINE_FEATURE_TABLES],
+                           generate_time_constants(result_time_df))
 
 
 if __name__ == "__main__":
@@ -1,8 +1,12 @@
 import os
 import time
-import csv
 import xgboost as xgb
 from instacart_model_trainer_script import ModelTrainer
+from feature_set_io import read_manifest
+from feature_set_dmatrix import load_dmatrix
+from feature_set_adapter import FeatureSetAdapter
+from model_scheduler import run_models
+from mlflow_logger import BackgroundMlflowLogger
 
 # Function to calculate elapsed time
 def get_time(start):
@@ -19,25 +23,24 @@ def main():
     dataset_version = "1.2"  # dataset . split method
     model_version = "1.1.1"  # algorithm . param version . used dataset 
     read_as_xgb_dmatrix = True
+    # Load the training set once in memory and share it with every library (XGBoost, LightGBM, H2O)
+    read_as_feature_set_adapter = False
     train_xgb_gbm = True
     train_xgb_rf = False
+    tune_xgb_gbm = False
+    # "quantile" (histogram bins only, the default), "external" (cached on disk) or "dmatrix"
+    dmatrix_mode = os.getenv("DMATRIX_MODE", "quantile")
+    external_memory_cache_dir = os.getenv("EXTERNAL_MEMORY_CACHE_DIR")
 
-    # Load feature names
-    train_features_name = []
-    with open(os.path.join(root_dir, "final-dataset-generator", "train_set_columns.txt"), "r") as f:
-        csv_reader = csv.reader(f)
-        for row in csv_reader:
-            train_features_name = row
-    train_features_name.remove('')
+    # Feature sets written by final_dataset_generator, described by their manifests
+    train_set_path = os.path.join(root_dir, "final-dataset-generator", "final_prior_train_set")
+    test_set_path = os.path.join(root_dir, "final-dataset-generator", "featured_test_set")
 
-    test_features_name = []
-    with open(os.path.join(root_dir, "final-dataset-generator", "test_set_columns.txt"), "r") as f:
-        csv_reader = csv.reader(f)
-        for row in csv_reader:
-            test_features_name = row
-    test_features_name.remove('')
+    train_manifest = read_manifest(train_set_path)
+    label_column = train_manifest["label"]
+    train_features_name = [col for col in train_manifest["columns"] if col != label_column]
 
-    train_label_index = train_features_name.index('reordered')
+    test_features_name = list(read_manifest(test_set_path)["columns"])
 
     # Modify features names in test set
     for i in range(len(test_features_name)):
@@ -70,15 +73,42 @@ def main():
         'objective': 'binary:logistic'
     }
 
-    if read_as_xgb_dmatrix:
-        train_features_name.remove('reordered')
-        # test_features_name.remove('reordered')
-        dtrain_2 = xgb.DMatrix(os.path.join(root_dir, "final-dataset-generator", "final_prior_train_set.csv", "part-00000-12859daa-f746-4f84-a1f1-4d24e43087a3-c000.csv"), nthread=-1, feature_names=train_features_name)
+    if read_as_feature_set_adapter:
+        dtrain_2 = FeatureSetAdapter(train_set_path, feature_names=train_features_name, label=label_column)
+    elif read_as_xgb_dmatrix:
+        # Built file by file from the manifest, the training set is never loaded as a whole
+        dtrain_2 = load_dmatrix(train_set_path, mode=dmatrix_mode, feature_names=train_features_name,
+                                label=label_column, max_bin=params.get('max_bin', 256),
+                                cache_dir=external_memory_cache_dir)
 
-    # Train the XGBoost GBM model
+    # Train the selected models concurrently, sharing the cores and the training matrix
+    # Their runs are logged in the background by one logger
+    logger = BackgroundMlflowLogger("final_instacart_training")
+    model_specs = []
     if train_xgb_gbm:
-        model_trainer = ModelTrainer("final_instacart_training", dtrain_2)
-        xgb_gbm = model_trainer.train_xgb_gbm("c391e8337f10ceb5870cb639159539f5e3497fbf", dataset_version, model_version, params)
+        model_specs.append({"name": "xgb_gbm", "trainer": ModelTrainer("final_instacart_training", dtrain_2,
+                                                                       logger=logger),
+                            "method": "train_xgb_gbm", "params": params})
+    if train_xgb_rf:
+        model_specs.append({"name": "xgb_rf", "trainer": ModelTrainer("final_instacart_training", dtrain_2,
+                                                                      logger=logger),
+                            "method": "train_xgb_rf", "params": params})
+
+    if model_specs:
+        models, comparison = run_models(model_specs, "c391e8337f10ceb5870cb639159539f5e3497fbf", dataset_version,
+                                        model_version,
+                                        memory_budget_gb=float(os.getenv("MEMORY_BUDGET_GB", 0)) or None)
+        print(comparison)
+
+    # Search the GBM parameters, every trial shares the quantized training matrix
+    if tune_xgb_gbm:
+        model_trainer = ModelTrainer("final_instacart_tuning", dtrain_2)
+        xgb_gbm, trials = model_trainer.tune_xgb_gbm("c391e8337f10ceb5870cb639159539f5e3497fbf", dataset_version,
+                                                     model_version, n_trials=int(os.getenv("N_TRIALS", 32)))
+        model_trainer.flush()
+
+    # Wait for the runs still being logged
+    logger.flush()
 
     # Additional code can be added for other models as needed, such as XGBoost RF, LightGBM, H2O, etc.
 
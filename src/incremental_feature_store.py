@@ -0,0 +1,309 @@
+import os
+import tempfile
+import pyspark.sql.functions as F
+from pyspark.sql import SparkSession, Window
+from pyspark.sql.types import LongType, DoubleType
+from instacart_feature_transformation_script import FeatureGenerator
+
+# Column order of FeatureGenerator.generate_product_related_features
+PRODUCT_FEATURE_COLUMNS = [
+    "product_id", "product_mean_of_position", "number_of_user_purchased_item", "number_of_product_co_occurred",
+    "mean_of_co_ocuured_product_per_order", "min_of_co_ocuured_product_per_order",
+    "max_of_co_ocuured_product_per_order", "Total_streak_of_this_product", "mean_of_streaks_of_this_product",
+    "min_of_streaks_of_this_product", "max_of_streaks_of_this_product",
+]
+
+
+class IncrementalFeatureStore:
+    """
+    Partitioned feature store that keeps the FeatureGenerator outputs up to date by recomputing
+    only the users with new orders.
+
+    User and user x product features only depend on the user's own history, so they are rebuilt
+    from the history of the affected users. Product features are aggregates over users: they are
+    derived from a per-user x product state (counts, sums, min/max, streak statistics, day of
+    week counts) in which only the affected users' rows are replaced, and only the products those
+    users bought are re-aggregated. Every table is partitioned by `bucket = key % num_buckets`
+    and a refresh rewrites only the buckets of the affected keys.
+    """
+
+    def __init__(self, spark, store_path, num_buckets=64, streak_thresholds=(5, 3, 2), product_attributes=None):
+        """
+        Parameters:
+        spark (SparkSession): The active Spark session.
+        store_path (str): Root directory of the store (any Hadoop-compatible path).
+        num_buckets (int): Number of partitions of every table. Defaults to 64.
+        streak_thresholds (tuple): Streak lengths of the prob_of_reordered_N features.
+        product_attributes (dict, optional): Product attributes of the user features, see FeatureGenerator.
+        """
+        self.spark = spark
+        self.store_path = store_path.rstrip("/")
+        self.num_buckets = num_buckets
+        self.streak_thresholds = tuple(streak_thresholds)
+        self.product_attributes = product_attributes
+
+    def _path(self, *names):
+        return "/".join((self.store_path,) + names)
+
+    def _fs_path(self, path):
+        jvm_path = self.spark._jvm.org.apache.hadoop.fs.Path(path)
+        return jvm_path, jvm_path.getFileSystem(self.spark._jsc.hadoopConfiguration())
+
+    def exists(self):
+        path, fs = self._fs_path(self._path("product_features", "_SUCCESS"))
+        return fs.exists(path)
+
+    def _with_bucket(self, df, key):
+        return df.withColumn("bucket", F.pmod(F.col(key).cast("long"), F.lit(self.num_buckets)))
+
+    def _user_product_state(self, generator):
+        # Mergeable per user x product aggregates from which every product feature is derived
+        df_with_order_stats = (
+            generator.generate_enriched_product_orders()
+            .filter(F.col("user_id").isNotNull())
+            .groupBy("user_id", "product_id")
+            .agg(F.count("order_id").alias("n_rows"),
+                 F.sum("add_to_cart_order").alias("position_sum"),
+                 F.count("add_to_cart_order").alias("position_count"),
+                 F.max((F.col("basket_size") == 1).cast("int")).alias("has_one_shot"),
+                 F.sum(F.col("basket_size") - 1).alias("co_sum"),
+                 F.min(F.col("basket_size") - 1).alias("co_min"),
+                 F.max(F.col("basket_size") - 1).alias("co_max"),
+                 *[F.sum((F.col("order_dow") == dow).cast("int")).alias(f"dow_{dow}") for dow in range(7)])
+        )
+
+        df_with_streak_stats = (
+            generator.generate_streak_lengths()
+            .groupBy("user_id", "product_id")
+            .agg(F.count("grp").alias("streak_count"),
+                 F.sum("length_of_streaks").alias("streak_sum"),
+                 F.min("length_of_streaks").alias("streak_min"),
+                 F.max("length_of_streaks").alias("streak_max"),
+                 *[F.sum((F.col("length_of_streaks") >= threshold).cast("int")).alias(f"streak_ge_{threshold}")
+                   for threshold in self.streak_thresholds])
+        )
+
+        return df_with_order_stats.join(df_with_streak_stats, on=["user_id", "product_id"], how="left")
+
+    def _product_features(self, user_product_state):
+        return (
+            user_product_state.groupBy("product_id")
+            .agg((F.sum("position_sum") / F.sum("position_count")).alias("product_mean_of_position"),
+                 F.sum("has_one_shot").alias("number_of_user_purchased_item"),
+                 F.sum("co_sum").alias("number_of_product_co_occurred"),
+                 (F.sum("co_sum") / F.sum("n_rows")).alias("mean_of_co_ocuured_product_per_order"),
+                 F.min("co_min").alias("min_of_co_ocuured_product_per_order"),
+                 F.max("co_max").alias("max_of_co_ocuured_product_per_order"),
+                 F.sum("streak_count").alias("Total_streak_of_this_product"),
+                 (F.sum("streak_sum") / F.sum("streak_count")).alias("mean_of_streaks_of_this_product"),
+                 F.min("streak_min").alias("min_of_streaks_of_this_product"),
+                 F.max("streak_max").alias("max_of_streaks_of_this_product"),
+                 *[(F.sum(f"streak_ge_{threshold}") / F.sum("streak_count")).alias(f"prob_of_reordered_{threshold}")
+                   for threshold in self.streak_thresholds],
+                 *[F.sum(f"dow_{dow}").alias(f"distrib_count_of_dow_{dow}_p_prod") for dow in range(7)],
+                 F.sum("n_rows").alias("product_row_count"))
+        )
+
+    def _write(self, name, df, key):
+        self._with_bucket(df, key).write.mode("overwrite").partitionBy("bucket").parquet(self._path(name))
+
+    def _merge(self, name, new_df, key, affected_keys):
+        """
+        Replaces the rows of affected_keys in table `name` by new_df, rewriting only their buckets.
+
+        The merged buckets are written to a staging directory first and then swapped in, so the
+        table is never read and overwritten by the same job.
+        """
+        affected_keys = self._with_bucket(affected_keys, key).cache()
+        buckets = [row.bucket for row in affected_keys.select("bucket").distinct().collect()]
+
+        merged = (
+            self.spark.read.parquet(self._path(name))
+            .filter(F.col("bucket").isin(buckets))
+            .join(F.broadcast(affected_keys.select(key)), on=key, how="left_anti")
+            .unionByName(self._with_bucket(new_df, key))
+        )
+        staging = self._path("_staging", name)
+        merged.write.mode("overwrite").partitionBy("bucket").parquet(staging)
+
+        for bucket in buckets:
+            source, fs = self._fs_path(f"{staging}/bucket={bucket}")
+            target, _ = self._fs_path(self._path(name, f"bucket={bucket}"))
+            fs.delete(target, True)
+            if fs.exists(source):
+                fs.rename(source, target)
+
+        staging_path, fs = self._fs_path(staging)
+        fs.delete(staging_path, True)
+        affected_keys.unpersist()
+
+    def build(self, prior_product_orders, prior_orders_df, products_df):
+        """
+        Computes every table of the store from the full history.
+        """
+        generator = FeatureGenerator(prior_product_orders, prior_orders_df, products_df,
+                                     streak_thresholds=self.streak_thresholds,
+                                     product_attributes=self.product_attributes)
+        user_product_state = self._user_product_state(generator)
+
+        self._write("user_features", generator.generate_user_related_features(), "user_id")
+        self._write("user_product_features", generator.generate_user_product_related_features(), "user_id")
+        self._write("user_product_state", user_product_state, "user_id")
+        self._write("product_features", self._product_features(self.spark.read.parquet(self._path("user_product_state"))
+                                                                .drop("bucket")), "product_id")
+        generator.unpersist()
+
+    def refresh(self, prior_product_orders, prior_orders_df, products_df, new_orders_df):
+        """
+        Merges newly arrived orders into the store.
+
+        Parameters:
+        prior_product_orders (DataFrame): Full order-product history, including the new orders.
+        prior_orders_df (DataFrame): Full order history, including the new orders.
+        products_df (DataFrame): The products table.
+        new_orders_df (DataFrame): The new orders (at least a user_id column).
+        """
+        affected_users = new_orders_df.select("user_id").distinct().cache()
+
+        affected_orders_df = prior_orders_df.join(F.broadcast(affected_users), on="user_id", how="left_semi")
+        affected_product_orders = prior_product_orders.join(
+            affected_orders_df.select("order_id"), on="order_id", how="left_semi"
+        )
+        generator = FeatureGenerator(affected_product_orders, affected_orders_df, products_df,
+                                     streak_thresholds=self.streak_thresholds,
+                                     product_attributes=self.product_attributes)
+
+        user_product_state = self._user_product_state(generator).cache()
+        affected_products = user_product_state.select("product_id").distinct()
+
+        self._merge("user_features", generator.generate_user_related_features(), "user_id", affected_users)
+        self._merge("user_product_features", generator.generate_user_product_related_features(), "user_id",
+                    affected_users)
+        self._merge("user_product_state", user_product_state, "user_id", affected_users)
+
+        affected_products = affected_products.localCheckpoint(eager=True)
+        product_features = self._product_features(
+            self.spark.read.parquet(self._path("user_product_state")).drop("bucket")
+            .join(affected_products, on="product_id", how="left_semi")
+        )
+        self._merge("product_features", product_features, "product_id", affected_products)
+
+        user_product_state.unpersist()
+        generator.unpersist()
+        affected_users.unpersist()
+
+    def load_features(self, prior_orders_df):
+        """
+        Reads the stored features back in the layout of FeatureGenerator.
+
+        Time related features only depend on the (small) orders table and are recomputed here.
+
+        Returns:
+        tuple: (user features, product features, user x product features, time related features).
+        """
+        total_orders = prior_orders_df.select("order_id").distinct().count()
+
+        result_df = self.spark.read.parquet(self._path("user_features")).drop("bucket")
+        result_usr_prod_df = self.spark.read.parquet(self._path("user_product_features")).drop("bucket")
+
+        product_columns = (
+            PRODUCT_FEATURE_COLUMNS
+            + [f"prob_of_reordered_{threshold}" for threshold in self.streak_thresholds]
+            + [f"distrib_count_of_dow_{dow}_p_prod" for dow in range(7)]
+            + ["prob_of_being_reordered"]
+        )
+        result_product_df = (
+            self.spark.read.parquet(self._path("product_features"))
+            .withColumn("prob_of_being_reordered", F.col("product_row_count") / total_orders)
+            .select(product_columns)
+        )
+        long_cols = [field.name for field in result_product_df.schema.fields if isinstance(field.dataType, LongType)]
+        columns_to_cast = {col_name: F.col(col_name).cast(DoubleType()) for col_name in long_cols}
+        result_product_df = result_product_df.withColumns(columns_to_cast)
+
+        result_time_df = FeatureGenerator(None, prior_orders_df, None).generate_time_related_features()
+
+        return result_df, result_product_df, result_usr_prod_df, result_time_df
+
+
+def check_refresh(spark, prior_product_orders, prior_orders_df, products_df, store_path, new_users_fraction=0.1,
+                  seed=0, **store_options):
+    """
+    Builds a store without the last order of a sample of users, refreshes it with these orders and compares
+    it with a store built from the full history.
+
+    Parameters:
+    spark (SparkSession): The active Spark session.
+    prior_product_orders, prior_orders_df, products_df: Full history, see IncrementalFeatureStore.build.
+    store_path (str): Directory of the two stores.
+    new_users_fraction (float): Fraction of users whose last order arrives with the refresh.
+    seed (int): Seed of the user sample.
+    store_options: Other IncrementalFeatureStore parameters.
+
+    Returns:
+    dict: Table name -> differences (see feature_backend_benchmark.compare_feature_sets), empty lists when
+          the refreshed store matches.
+    """
+    from feature_backend_benchmark import FEATURE_SET_KEYS, compare_feature_sets
+
+    last_orders = Window.partitionBy("user_id").orderBy(F.col("order_number").desc())
+    new_orders_df = (
+        prior_orders_df.join(prior_orders_df.select("user_id").distinct().sample(fraction=new_users_fraction, seed=seed),
+                             on="user_id", how="left_semi")
+        .withColumn("rank", F.row_number().over(last_orders))
+        .filter(F.col("rank") == 1)
+        .select("order_id", "user_id")
+        .cache()
+    )
+    old_orders_df = prior_orders_df.join(new_orders_df.select("order_id"), on="order_id", how="left_anti")
+    old_product_orders = prior_product_orders.join(new_orders_df.select("order_id"), on="order_id", how="left_anti")
+
+    refreshed = IncrementalFeatureStore(spark, f"{store_path.rstrip('/')}/refreshed", **store_options)
+    refreshed.build(old_product_orders, old_orders_df, products_df)
+    refreshed.refresh(prior_product_orders, prior_orders_df, products_df, new_orders_df)
+
+    rebuilt = IncrementalFeatureStore(spark, f"{store_path.rstrip('/')}/rebuilt", **store_options)
+    rebuilt.build(prior_product_orders, prior_orders_df, products_df)
+
+    names = ["user_features", "product_features", "user_product_features", "time_features"]
+    differences = {}
+    for name, expected, actual in zip(names, rebuilt.load_features(prior_orders_df),
+                                      refreshed.load_features(prior_orders_df)):
+        differences[name] = compare_feature_sets(expected.toPandas(), actual.select(expected.columns).toPandas(),
+                                                 FEATURE_SET_KEYS[name])
+    new_orders_df.unpersist()
+    return differences
+
+
+def main():
+    # Checks a refresh against a full build, on synthetic data unless a directory with the Instacart CSVs is given
+    from feature_backend_benchmark import generate_instacart_like_dataset
+    from final_dataset_generator import load_datasets
+
+    data_dir = os.getenv("CHECK_DATA_DIR")
+    n_users = int(os.getenv("CHECK_N_USERS", 500))
+
+    spark = SparkSession.builder.appName("incremental_feature_store_check").getOrCreate()
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            if data_dir:
+                paths = tuple(os.path.join(data_dir, name) for name in
+                              ["orders.csv", "order_products__prior.csv", "products.csv", "order_products__train.csv"])
+            else:
+                paths = generate_instacart_like_dataset(tmp_dir, n_users=n_users)
+
+            final_train_product_orders, _, final_train_orders_df, _, products_df = load_datasets(spark, *paths)
+            differences = check_refresh(spark, final_train_product_orders, final_train_orders_df, products_df,
+                                        os.path.join(tmp_dir, "store"))
+    finally:
+        # Stopped even when the check fails, so the session is never leaked
+        spark.stop()
+
+    for name, table_differences in differences.items():
+        print(f"{name}: " + ("match" if not table_differences else "; ".join(table_differences)))
+    if any(differences.values()):
+        raise RuntimeError(f"Refreshed store differs from a full build: {differences}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,331 +1,415 @@
+import re
 import time
+import logging
 import pyspark
 import numpy as np
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession, Window
 from pyspark.sql import functions as F
-from pyspark.sql.types import LongType, DoubleType , StringType
+from pyspark.sql.types import LongType, DoubleType
+
+# Product attributes tagged from the product name: attribute -> case-insensitive regular expression
+DEFAULT_PRODUCT_ATTRIBUTES = {"organic": "organic", "asian": "asian", "gluten_free": "gluten free"}
+
+# Attributes combined into the count_of_asian_org_items / mean_of_asian_org_items features, every other
+# attribute gets its own count_of_<attribute>_items / mean_of_<attribute>_items features
+COMBINED_PRODUCT_ATTRIBUTES = ("organic", "asian", "gluten_free")
+
+# Physical join operators reported by the join strategy log
+JOIN_OPERATORS = ("BroadcastHashJoin", "BroadcastNestedLoopJoin", "SortMergeJoin", "ShuffledHashJoin", "CartesianProduct")
+
+logger = logging.getLogger(__name__)
 
 
 # How often user has reordered
 class FeatureGenerator:
     
-    def __init__(self,prior_product_orders,prior_orders_df,products_df):
+    def __init__(self,prior_product_orders,prior_orders_df,products_df,storage_level=StorageLevel.MEMORY_AND_DISK,
+                 streak_thresholds=(5,3,2),product_attributes=None,broadcast_threshold=None):
         
         self.prior_product_orders = prior_product_orders
         self.prior_orders_df = prior_orders_df
         self.products_df= products_df
+        self.product_attributes = dict(product_attributes if product_attributes is not None else DEFAULT_PRODUCT_ATTRIBUTES)
+        # Streak lengths of the prob_of_reordered_N features
+        self.streak_thresholds = tuple(streak_thresholds)
+        # Storage level of the shared intermediate frames, None disables persisting
+        self.storage_level = storage_level
+        # Estimated size in bytes under which a bounded right side of a join is broadcast, None reads
+        # spark.sql.autoBroadcastJoinThreshold and a negative value disables it
+        self.broadcast_threshold = broadcast_threshold
+        self._frames = {}
+        # Scalars (counts) computed once, kept apart from the frames so unpersist() only sees DataFrames
+        self._values = {}
 
-
-    def generate_user_related_features(self):
+    def _memoize(self, name, build, persist=False, log_joins=False):
+        
+        # Every frame is built once per generator, repeated calls return the same DataFrame
+        if name not in self._frames:
+            df = build()
+            if persist and self.storage_level is not None:
+                df = df.persist(self.storage_level)
+            if log_joins:
+                self._log_join_strategies(name, df)
+            self._frames[name] = df
+        return self._frames[name]
+    
+    def _memoize_value(self, name, build):
         
-        df_with_num_of_reord = (
-            self.prior_product_orders.select("reordered", "order_id")
-            .join(self.prior_orders_df.select("user_id", "order_id"), how="left", on="order_id")
-            .select("user_id", "reordered")
-            .groupBy("user_id")
-            .agg(F.count(F.col("reordered")).alias("frequency_of_reorder"))
-        )
+        # Same as _memoize for scalars computed by a Spark job, e.g. a count
+        if name not in self._values:
+            self._values[name] = build()
+        return self._values[name]
+    
+    def _estimated_size(self, df, max_rows=None):
+        
+        # Optimizer estimate of the frame size. Aggregates are estimated from their input, so callers
+        # that know a bound on the number of rows (e.g. 7 days of the week) pass it as max_rows
+        try:
+            size = int(str(df._jdf.queryExecution().optimizedPlan().stats().sizeInBytes()))
+        except Exception:
+            return None
+        if max_rows is not None:
+            size = min(size, max_rows * df._jdf.schema().defaultSize())
+        return size
+    
+    def _broadcast_threshold(self, df):
         
-   
-        # Time of the day user visits
-        df_with_time_of_day_usr_visits = (
-            self.prior_orders_df.select("user_id", "order_hour_of_day", "order_id")
-            .groupBy("user_id", "order_hour_of_day")
-            .agg(F.count("order_id").alias("frequency"))
-            .groupBy("user_id")
-            .agg(F.max("frequency").alias("maximum_frquency"))
-        )
+        if self.broadcast_threshold is not None:
+            return self.broadcast_threshold
+        return int(df._jdf.sparkSession().sessionState().conf().autoBroadcastJoinThreshold())
+    
+    def _join(self, left, right, on, how="left", max_rows=None):
+        
+        # Only dimension-like sides, whose caller knows a row bound (products, days of the week, hours), are
+        # hinted. Every other join is left to Spark, which applies its own threshold to its own estimate
+        if max_rows is not None:
+            threshold = self._broadcast_threshold(right)
+            size = self._estimated_size(right, max_rows)
+            if threshold >= 0 and size is not None and size <= threshold:
+                logger.debug("Broadcasting %s bytes joined on %s", size, on)
+                right = F.broadcast(right)
+        return left.join(right, on=on, how=how)
+    
+    def _num_products(self):
         
-        # Does the user order Asian, gluten-free, or organic items
-        df_with_does_usr_asian_gluten_orga_items_ord = (
-            self.prior_product_orders.select("order_id", "product_id")
-            .join(self.products_df.select("product_id", "product_name"), on="product_id", how='left')
-            .join(self.prior_orders_df.select("user_id", "order_id"), on="order_id", how='left')
-            .groupBy("user_id", "order_id")
-            .agg(F.collect_list("product_name").alias("list_of_products"))
-            .withColumn("normalized_list", F.expr("transform(list_of_products, x -> lower(x))"))
-            .withColumn("contains_or_not", 
-                        F.expr("exists(normalized_list,x -> x like '%organic%')") |
-                        F.expr("exists(normalized_list, x -> x like '%asian%')") |
-                        F.expr("exists(normalized_list, x -> x like '%gluten free%')")
-            )
-            .groupBy("user_id")
-            .agg(
-                F.sum(F.col("contains_or_not").cast("int")).alias("count_of_asian_org_items"),
-                F.mean(F.col("contains_or_not").cast("int")).alias("mean_of_asian_org_items")
+        return self._memoize_value("num_products", lambda: self.products_df.count())
+    
+    def _log_join_strategies(self, name, df):
+        
+        # Physical plan only, nothing is executed
+        plan = df._jdf.queryExecution().executedPlan().toString()
+        counts = {operator: len(re.findall(rf"\b{operator}\b", plan)) for operator in JOIN_OPERATORS}
+        logger.info("%s joins: %s", name, ", ".join(f"{operator}={count}" for operator, count in counts.items() if count)
+                    or "none")
+        if counts["SortMergeJoin"] or counts["ShuffledHashJoin"] or counts["CartesianProduct"]:
+            logger.debug("%s physical plan:\n%s", name, plan)
+    
+    def unpersist(self):
+        
+        for df in self._frames.values():
+            if df.is_cached:
+                df.unpersist()
+        self._frames = {}
+
+    def generate_enriched_product_orders(self):
+        
+        # Order-product rows with their order attributes and basket size, shared by every feature
+        return self._memoize("enriched_product_orders", lambda: (
+            self.prior_product_orders.join(
+                self.prior_orders_df.select("order_id", "user_id", "order_number", "order_dow", "order_hour_of_day"),
+                on="order_id", how="left")
+            .withColumn("basket_size", F.count(F.col("product_id")).over(Window.partitionBy("order_id")))
+        ), persist=True)
+    
+    def generate_product_attributes(self):
+        
+        # One 0/1 flag per attribute for each of the (few) products, null when the name is missing
+        def build():
+            
+            flags = {name: F.col("product_name").rlike(f"(?i){pattern}").cast("int")
+                     for name, pattern in self.product_attributes.items()}
+            combined = [flags[name] for name in COMBINED_PRODUCT_ATTRIBUTES if name in flags]
+            if not combined:
+                is_asian_org_item = F.lit(None).cast("int")
+            else:
+                is_asian_org_item = combined[0] if len(combined) == 1 else F.greatest(*combined)
+            
+            return (
+                self.products_df
+                .select("product_id", is_asian_org_item.alias("is_asian_org_item"),
+                        *[flags[name].alias(f"is_{name}_item") for name in self._extra_product_attributes()])
             )
-        )
         
-        # Feature based on order size
-        df_with_fets_of_ord_size = (
-            self.prior_product_orders.select("product_id", "order_id")
-            .join(self.prior_orders_df.select("user_id", "order_id"), on="order_id", how="left")
-            .groupBy("user_id", 'order_id')
-            .agg(F.count(F.col("product_id")).alias("count_of_product"))
-            .groupBy("user_id")
-            .agg(F.max(F.col("count_of_product")).alias("max_count_of_products"),
-                 F.min(F.col("count_of_product")).alias("min_count_of_products"),
-                 F.mean(F.col("count_of_product")).alias("mean_count_of_products"))
-        )
+        return self._memoize("product_attributes", build)
+    
+    def _extra_product_attributes(self):
+        
+        return [name for name in self.product_attributes if name not in COMBINED_PRODUCT_ATTRIBUTES]
+    
+    def generate_order_stats(self):
         
-        # How many of the user’s orders contained no previously purchased items
-        df_with_freq_ord_that_hasnt_prev_purch_items = (
-            self.prior_product_orders.select("order_id", "reordered")
-            .join(self.prior_orders_df.select("order_id", "user_id"), on='order_id', how='left')
+        # One row per order of the statistics the user features are built from
+        return self._memoize("order_stats", lambda: (
+            self._join(self.generate_enriched_product_orders(), self.generate_product_attributes(), on="product_id",
+                       max_rows=self._num_products())
             .groupBy("user_id", "order_id")
-            .agg(F.collect_list(F.col("reordered")).alias("reordered_array"))
-            .withColumn("doesnt_contains_reordered", F.when(F.array_contains("reordered_array", 1), 0).otherwise(1))
-            .groupBy("user_id")
-            .agg(
-                F.sum("doesnt_contains_reordered").alias("count_ord_no_prev_purchased_items"),
-                F.mean("doesnt_contains_reordered").alias("mean_ord_no_prev_purchased_items")    
-            )
-        )
-
-        result_df = (
-            df_with_num_of_reord
-            .join(df_with_does_usr_asian_gluten_orga_items_ord, on="user_id", how='left')
-            .join(df_with_fets_of_ord_size, on="user_id", how='left')
-            .join(df_with_freq_ord_that_hasnt_prev_purch_items, on="user_id", how='left')
-        )
-        long_cols = [field.name for field in result_df.schema.fields if isinstance(field.dataType, LongType)]
-        columns_to_cast = {col_name: F.col(col_name).cast(DoubleType()) for col_name in long_cols}
-        result_df = result_df.withColumns(columns_to_cast)
-        return result_df
+            .agg(F.count(F.col("reordered")).alias("count_of_reordered"),
+                 F.count(F.col("product_id")).alias("count_of_product"),
+                 F.max(F.when(F.col("reordered") == 1, 1).otherwise(0)).alias("contains_reordered"),
+                 # Does the order contain Asian, gluten-free, or organic items
+                 F.max(F.col("is_asian_org_item")).alias("contains_or_not"),
+                 *[F.max(F.col(f"is_{name}_item")).alias(f"contains_{name}") for name in self._extra_product_attributes()])
+        ), persist=True)
+    
+    def generate_user_product_stats(self):
         
-    def generate_product_related_features(self):
-                
-        # How often the item has been purchased
-        df_with_freq_purch = (
-            self.prior_product_orders.select("product_id", "order_id")
-            .groupBy("product_id")
-            .agg(F.count(F.col("order_id")).alias("product_count"))
-        )
+        # One row per user and product, shared by the user x product and product features
+        return self._memoize("user_product_stats", lambda: (
+            self.generate_enriched_product_orders()
+            .groupBy("user_id", "product_id")
+            .agg(F.count("order_id").alias("num_of_ord_purch_p_prod"),
+                 F.mean(F.col("add_to_cart_order")).alias("prod_mean_of_position_p_user"),
+                 F.sum(F.col("basket_size") - 1).alias("num_of_prod_co_ocrd_p_usr_p_prod"),
+                 F.max(F.when(F.col("basket_size") == 1, 1).otherwise(0)).alias("has_user_purchased_one_shot"))
+        ), persist=True)
+    
+    def generate_candidate_index(self):
+        
+        # Distinct products of every user, clustered and sorted by user, test candidates are then
+        # a lookup of the test users in it (see select_candidates)
+        return self._memoize("candidate_index", lambda: (
+            self.generate_user_product_stats().select("user_id", "product_id")
+            .repartition("user_id")
+            .sortWithinPartitions("user_id", "product_id")
+        ), persist=True)
+    
+    def generate_total_orders(self):
         
-        # Position of product
-        df_with_avg_position_of_prod = (
-            self.prior_product_orders.select("product_id", "add_to_cart_order")
-            .groupBy("product_id")
-            .agg(F.mean(F.col("add_to_cart_order")).alias("product_mean_of_position"))
-        )
+        return self._memoize_value("total_orders", lambda: self.prior_orders_df.select("order_id").distinct().count())
+
+    def generate_user_related_features(self):
         
-        # How many users buy it as a "one-shot" item
-        df_with_freq_one_shot_ord_prods = (
-            self.prior_product_orders.select("order_id", "product_id")
-            .groupBy("order_id")
-            .agg(F.collect_list("product_id").alias("list_of_products"))
-            .withColumn("is_one_shot_order", F.when(F.size(F.col("list_of_products")) == 1, 1).otherwise(0))
-            .withColumn("product_id", F.explode(F.col("list_of_products")))
-            .join(self.prior_orders_df.select("user_id", "order_id"), on="order_id", how='left')
-            .groupBy("product_id", "user_id")
-            .agg(F.collect_list(F.col("is_one_shot_order")).alias("is_one_shot_order_list"))
-            .withColumn("has_user_purchased_one_shot", F.when(F.array_contains("is_one_shot_order_list", 1), 1).otherwise(0))
-            .groupBy("product_id")
-            .agg(F.sum(F.col("has_user_purchased_one_shot")).alias("number_of_user_purchased_item"))
-        )
+        def build():
+            
+            result_df = (
+                self.generate_order_stats()
+                .groupBy("user_id")
+                .agg(
+                    # How often user has reordered
+                    F.sum(F.col("count_of_reordered")).alias("frequency_of_reorder"),
+                    # Does the user order Asian, gluten-free, or organic items
+                    F.sum(F.col("contains_or_not")).alias("count_of_asian_org_items"),
+                    F.mean(F.col("contains_or_not")).alias("mean_of_asian_org_items"),
+                    # Feature based on order size
+                    F.max(F.col("count_of_product")).alias("max_count_of_products"),
+                    F.min(F.col("count_of_product")).alias("min_count_of_products"),
+                    F.mean(F.col("count_of_product")).alias("mean_count_of_products"),
+                    # How many of the user’s orders contained no previously purchased items
+                    F.sum(1 - F.col("contains_reordered")).alias("count_ord_no_prev_purchased_items"),
+                    F.mean(1 - F.col("contains_reordered")).alias("mean_ord_no_prev_purchased_items"),
+                    # Same for every other configured product attribute
+                    *[agg for name in self._extra_product_attributes()
+                      for agg in (F.sum(F.col(f"contains_{name}")).alias(f"count_of_{name}_items"),
+                                  F.mean(F.col(f"contains_{name}")).alias(f"mean_of_{name}_items"))]
+                )
+            )
+            long_cols = [field.name for field in result_df.schema.fields if isinstance(field.dataType, LongType)]
+            columns_to_cast = {col_name: F.col(col_name).cast(DoubleType()) for col_name in long_cols}
+            return result_df.withColumns(columns_to_cast)
         
-        # Statistics on the number of items that co-occur with this item
-        df_with_freq_co_ocrd = (
-            self.prior_product_orders
-            .select("product_id", "order_id")
-            .alias("df1")
-            .join(self.prior_product_orders.select("product_id", "order_id").withColumnRenamed("product_id", "product_id_1").alias("df2"),
-                  (F.col("df1.order_id") == F.col("df2.order_id")) & (F.col("df1.product_id") != F.col("df2.product_id_1")),
-                  "left")
-            .groupBy("df1.product_id")
-            .agg(F.count(F.col("df2.product_id_1")).alias("number_of_product_co_occurred"))
-        )
+        return self._memoize("user_features", build, log_joins=True)
         
-        # Average number of items that co-occur with this item in a single order
-        df_with_avg_num_item_co_ocrd_in_ord = (
-            self.prior_product_orders.select("product_id", "order_id").alias("ppo1")
-            .join(self.prior_product_orders.select("product_id", "order_id").alias("ppo2"),
-                  (F.col("ppo1.order_id") == F.col("ppo2.order_id")) & (F.col("ppo1.product_id") != F.col("ppo2.product_id")),
-                  how='left')
-            .groupBy("ppo1.product_id", "ppo1.order_id")
-            .agg(F.count(F.col("ppo2.product_id")).alias("count_of_co_ocuured_product_per_order"))
-            .groupBy("ppo1.product_id")
-            .agg(F.mean(F.col("count_of_co_ocuured_product_per_order")).alias("mean_of_co_ocuured_product_per_order"),
-                 F.min(F.col("count_of_co_ocuured_product_per_order")).alias("min_of_co_ocuured_product_per_order"),
-                 F.max(F.col("count_of_co_ocuured_product_per_order")).alias("max_of_co_ocuured_product_per_order"))
-        )
+    def generate_product_related_features(self):
         
-        # Stats on the order streak
-        df_with_flag = (
-            self.prior_product_orders.select("product_id", "order_id")
-            .join(self.prior_orders_df.select("user_id", "order_number", "order_id"), how='left', on='order_id')
-            .withColumn("next_order_number", F.lead(F.col("order_number"), 1).over(Window.partitionBy("user_id", "product_id").orderBy("order_number")))
-            .withColumn("is_streak_continued_flag", F.when(F.col("next_order_number") - F.col("order_number") == 1, 1).otherwise(0))
-        )
+        def build():
+            
+            total_orders = self.generate_total_orders()
+            
+            df_with_product_stats = (
+                self.generate_enriched_product_orders()
+                .withColumn("count_of_co_ocuured_product_per_order", F.col("basket_size") - 1)
+                .groupBy("product_id")
+                .agg(
+                    # Position of product
+                    F.mean(F.col("add_to_cart_order")).alias("product_mean_of_position"),
+                    # Statistics on the number of items that co-occur with this item,
+                    # every other product of an order co-occurs with it: basket size - 1
+                    F.sum(F.col("count_of_co_ocuured_product_per_order")).alias("number_of_product_co_occurred"),
+                    F.mean(F.col("count_of_co_ocuured_product_per_order")).alias("mean_of_co_ocuured_product_per_order"),
+                    F.min(F.col("count_of_co_ocuured_product_per_order")).alias("min_of_co_ocuured_product_per_order"),
+                    F.max(F.col("count_of_co_ocuured_product_per_order")).alias("max_of_co_ocuured_product_per_order"),
+                    # Probability it is reordered after the first order
+                    (F.count(F.col("user_id")) / total_orders).alias("prob_of_being_reordered"),
+                    # Distribution of the day of week it is ordered
+                    *[F.sum((F.col("order_dow") == dow).cast("int")).alias(f"distrib_count_of_dow_{dow}_p_prod")
+                      for dow in range(7)]
+                )
+            )
+            
+            # How many users buy it as a "one-shot" item
+            df_with_freq_one_shot_ord_prods = (
+                self.generate_user_product_stats()
+                .groupBy("product_id")
+                .agg(F.sum(F.col("has_user_purchased_one_shot")).alias("number_of_user_purchased_item"))
+            )
+            
+            # Stats on the order streak and probability of being reordered within N orders,
+            # every threshold is one more column of the same aggregation
+            df_with_stats_of_streaks = (
+                self.generate_streak_lengths().select("product_id", "length_of_streaks", "grp")
+                .groupBy("product_id")
+                .agg(F.count('grp').alias("Total_streak_of_this_product"),
+                     F.mean("length_of_streaks").alias("mean_of_streaks_of_this_product"),
+                     F.min("length_of_streaks").alias("min_of_streaks_of_this_product"),
+                     F.max("length_of_streaks").alias("max_of_streaks_of_this_product"),
+                     *[(F.sum(F.when(F.col("length_of_streaks") >= threshold, 1).otherwise(0))
+                        / F.count("length_of_streaks")).alias(f"prob_of_reordered_{threshold}")
+                       for threshold in self.streak_thresholds])
+            )
+            
+            num_products = self._num_products()
+            result_product_df = (
+                self._join(
+                    self._join(df_with_product_stats, df_with_freq_one_shot_ord_prods, on="product_id",
+                               max_rows=num_products),
+                    df_with_stats_of_streaks, on="product_id", max_rows=num_products
+                )
+                .select("product_id", "product_mean_of_position", "number_of_user_purchased_item",
+                        "number_of_product_co_occurred", "mean_of_co_ocuured_product_per_order",
+                        "min_of_co_ocuured_product_per_order", "max_of_co_ocuured_product_per_order",
+                        "Total_streak_of_this_product", "mean_of_streaks_of_this_product",
+                        "min_of_streaks_of_this_product", "max_of_streaks_of_this_product",
+                        *[f"prob_of_reordered_{threshold}" for threshold in self.streak_thresholds],
+                        *[f"distrib_count_of_dow_{dow}_p_prod" for dow in range(7)],
+                        "prob_of_being_reordered")
+            )
+    
+            long_cols = [field.name for field in result_product_df.schema.fields if isinstance(field.dataType, LongType)]
+            columns_to_cast = {col_name: F.col(col_name).cast(DoubleType()) for col_name in long_cols}
+            return result_product_df.withColumns(columns_to_cast)
         
-        w1 = Window.partitionBy("user_id", "product_id").orderBy("order_number")
-        w2 = Window.partitionBy("user_id", "product_id", "is_streak_continued_flag").orderBy("order_number")
+        return self._memoize("product_features", build, log_joins=True)
         
-        df_with_streak_length = (
-            df_with_flag.withColumn("grp", F.row_number().over(w1) - F.row_number().over(w2))
-            .groupBy("user_id", "product_id", "grp")
-            .agg(F.count("order_number").alias("length_of_streaks"))
-        )
+    def generate_basket_sizes(self):
         
-        df_with_stats_of_streaks = (
-            df_with_streak_length.select("product_id", "length_of_streaks", "grp")
-            .groupBy("product_id")
-            .agg(F.count('grp').alias("Total_streak_of_this_product"),
-                 F.mean("length_of_streaks").alias("mean_of_streaks_of_this_product"),
-                 F.min("length_of_streaks").alias("min_of_streaks_of_this_product"),
-                 F.max("length_of_streaks").alias("max_of_streaks_of_this_product"))
-        )
+        # Number of products in every order
+        return self._memoize("basket_sizes", lambda: (
+            self.generate_enriched_product_orders()
+            .groupBy("order_id")
+            .agg(F.max(F.col("basket_size")).alias("basket_size"))
+        ))
         
-        # Probability of being reordered within N orders
-        df_with_prob_greater_5 = (
-            df_with_streak_length.withColumn("is_streak_length_greater_than_5", F.when(F.col("length_of_streaks") >= 5, 1).otherwise(0))
-            .groupBy("product_id")
-            .agg(F.count("length_of_streaks").alias("total_streaks"),
-                 F.sum("is_streak_length_greater_than_5").alias("total_streaks_greater_than_5"))
-            .withColumn("prob_of_reordered_5", F.col("total_streaks_greater_than_5") / F.col("total_streaks"))
-            .select("product_id", "prob_of_reordered_5")
-        )
+    def generate_streak_flags(self):
         
-        df_with_prob_greater_2 = (
-            df_with_streak_length.withColumn("is_streak_length_greater_than_2", F.when(F.col("length_of_streaks") >= 2, 1).otherwise(0))
-            .groupBy("product_id")
-            .agg(F.count("length_of_streaks").alias("total_streaks"),
-                 F.sum("is_streak_length_greater_than_2").alias("total_streaks_greater_than_2"))
-            .withColumn("prob_of_reordered_2", F.col("total_streaks_greater_than_2") / F.col("total_streaks"))
-            .select("product_id", "prob_of_reordered_2")
-        )
+        def build():
+            
+            # One ordered window per user and product. A row continues a streak when the product is
+            # bought again in the next order; grp is the streak id of the original two-window
+            # formulation (row number minus row number within the flag) and island the id of the
+            # run of consecutive orders (order number minus row number)
+            w = Window.partitionBy("user_id", "product_id").orderBy("order_number")
+            
+            return (
+                self.generate_enriched_product_orders().select("user_id", "product_id", "order_number")
+                .withColumn("is_streak_continued_flag",
+                            F.when(F.lead(F.col("order_number"), 1).over(w) - F.col("order_number") == 1, 1).otherwise(0))
+                .withColumn("row_number", F.row_number().over(w))
+                .withColumn("continued_count", F.sum("is_streak_continued_flag").over(w))
+                .withColumn("grp", F.when(F.col("is_streak_continued_flag") == 1, F.col("row_number") - F.col("continued_count"))
+                                    .otherwise(F.col("continued_count")))
+                .withColumn("island", F.col("order_number") - F.col("row_number"))
+            )
         
-        df_with_prob_greater_3 = (
-            df_with_streak_length.withColumn("is_streak_length_greater_than_3", F.when(F.col("length_of_streaks") >= 3, 1).otherwise(0))
-            .groupBy("product_id")
-            .agg(F.count("length_of_streaks").alias("total_streaks"),
-                 F.sum("is_streak_length_greater_than_3").alias("total_streaks_greater_than_3"))
-            .withColumn("prob_of_reordered_3", F.col("total_streaks_greater_than_3") / F.col("total_streaks"))
-            .select("product_id", "prob_of_reordered_3")
-        )
+        return self._memoize("streak_flags", build, persist=True)
         
-        # Distribution of the day of week it is ordered
-        pivoted_prior_orders_df = (
-            self.prior_orders_df.select("order_id", "order_dow")
-            .groupBy("order_id")
-            .pivot("order_dow")
-            .agg(F.lit(1)).na.fill(0)
-        )
+    def generate_streak_lengths(self):
         
-        df_with_count_of_dow_p_prod = (
-            self.prior_product_orders.select("order_id", "product_id")
-            .join(pivoted_prior_orders_df, on="order_id", how='left')
-            .groupBy("product_id")
-            .agg(F.sum("0").alias("distrib_count_of_dow_0_p_prod"),
-                 F.sum("1").alias("distrib_count_of_dow_1_p_prod"),
-                 F.sum("2").alias("distrib_count_of_dow_2_p_prod"),
-                 F.sum("3").alias("distrib_count_of_dow_3_p_prod"),
-                 F.sum("4").alias("distrib_count_of_dow_4_p_prod"),
-                 F.sum("5").alias("distrib_count_of_dow_5_p_prod"),
-                 F.sum("6").alias("distrib_count_of_dow_6_p_prod"))
-        )
+        # Length of the order streaks of every product per user
+        return self._memoize("streak_lengths", lambda: (
+            self.generate_streak_flags()
+            .groupBy("user_id", "product_id", "grp")
+            .agg(F.count("order_number").alias("length_of_streaks"))
+        ))
         
-        # Probability it is reordered after the first order
-        total_orders = self.prior_orders_df.select("order_id").distinct().count()
+    def generate_current_streaks(self):
         
-        df_with_prob_reord = (
-            self.prior_orders_df.select("order_id", "user_id")
-            .join(self.prior_product_orders.select("product_id", "order_id"), on="order_id", how='left')
-            .groupBy("product_id", "user_id")
-            .agg(F.count("order_id").alias("order_count"))
-            .groupBy("product_id")
-            .agg(((F.sum("order_count") / total_orders).alias("prob_of_being_reordered")))
-        )
+        def build():
+            
+            # Length of the run of consecutive orders ending at the user's last order, 0 when the
+            # user didn't buy the product in that order
+            df_with_last_order = (
+                self.prior_orders_df.select("user_id", "order_number")
+                .groupBy("user_id")
+                .agg(F.max("order_number").alias("last_order_number"))
+            )
+            
+            df_with_last_streak = (
+                self.generate_streak_flags()
+                .withColumn("last_island", F.max("island").over(Window.partitionBy("user_id", "product_id")))
+                .groupBy("user_id", "product_id")
+                .agg(F.max("order_number").alias("last_purchase_order_number"),
+                     F.sum(F.when(F.col("island") == F.col("last_island"), 1).otherwise(0)).alias("length_of_last_streak"))
+            )
+            
+            return (
+                df_with_last_streak.join(df_with_last_order, on="user_id", how="left")
+                .withColumn("current_streak_p_usr_p_prod",
+                            F.when(F.col("last_purchase_order_number") == F.col("last_order_number"),
+                                   F.col("length_of_last_streak")).otherwise(0))
+                .select("user_id", "product_id", "current_streak_p_usr_p_prod")
+            )
         
-        result_product_df = (
-            df_with_avg_position_of_prod
-            .join(df_with_freq_one_shot_ord_prods, on="product_id", how='left')
-            .join(df_with_freq_co_ocrd, on="product_id", how='left')
-            .join(df_with_avg_num_item_co_ocrd_in_ord, on = 'product_id', how="left")
-            .join(df_with_stats_of_streaks, on="product_id", how='left')
-            .join(df_with_prob_greater_5, on="product_id", how="left")
-            .join(df_with_prob_greater_3, on="product_id", how="left")
-            .join(df_with_prob_greater_2, on="product_id", how="left")
-            .join(df_with_count_of_dow_p_prod, on="product_id", how="left")
-            .join(df_with_prob_reord, on="product_id", how="left")
-        )
-
-        long_cols = [field.name for field in result_product_df.schema.fields if isinstance(field.dataType, LongType)]
-        columns_to_cast = {col_name: F.col(col_name).cast(DoubleType()) for col_name in long_cols}
-        result_product_df = result_product_df.withColumns(columns_to_cast)
-        return result_product_df
+        return self._memoize("current_streaks", build)
         
     def generate_user_product_related_features(self):
         
-        # Number of orders in which the user purchases the item
-        df_with_num_of_order_p_product = (
-            self.prior_product_orders.select("order_id", "product_id")
-            .join(self.prior_orders_df.select("order_id", "user_id"), how='left', on='order_id')
-            .groupBy("user_id", "product_id")
-            .agg(F.count("order_id").alias("num_of_ord_purch_p_prod"))
-        )
-        
-        # Position in the cart
-        df_with_position_cart_p_usr_p_prod = (
-            self.prior_product_orders.select("product_id", "add_to_cart_order", "order_id")
-            .join(self.prior_orders_df.select("user_id", "order_id"), how='left', on='order_id')
-            .groupBy("user_id", "product_id")
-            .agg(F.mean(F.col("add_to_cart_order")).alias("prod_mean_of_position_p_user"))
-        )
+        def build():
+            
+            # Number of orders in which the user purchases the item, position in the cart,
+            # co-occurrence statistics and the streak the user is currently on
+            result_usr_prod_df = (
+                self.generate_user_product_stats().join(self.generate_current_streaks(), on=["user_id", "product_id"], how="left")
+                .select("user_id", "product_id", "num_of_ord_purch_p_prod", "prod_mean_of_position_p_user",
+                        "num_of_prod_co_ocrd_p_usr_p_prod", "current_streak_p_usr_p_prod")
+            )
+            long_cols = [field.name for field in result_usr_prod_df.schema.fields if isinstance(field.dataType, LongType)]
+            columns_to_cast = {col_name: F.col(col_name).cast(DoubleType()) for col_name in long_cols}
+            return result_usr_prod_df.withColumns(columns_to_cast)
         
-        # Co-occurrence statistics
-        df_with_co_ocrd_stats_p_user_p_prod = (
-            self.prior_product_orders.select("product_id", "order_id").alias("df1")
-            .join(self.prior_orders_df.select("user_id", "order_id"), on='order_id', how='left')
-            .join(self.prior_product_orders.select("product_id", "order_id").withColumnRenamed("product_id", "product_id_1").alias("df2"),
-                  (F.col("df1.order_id") == F.col("df2.order_id")) & (F.col("df1.product_id") != F.col("df2.product_id_1")),
-                  "left")
-            .groupBy("user_id", "df1.product_id")
-            .agg(F.count(F.col("df2.product_id_1")).alias("num_of_prod_co_ocrd_p_usr_p_prod"))
-        )
-
-        result_usr_prod_df = (
-            df_with_num_of_order_p_product
-            .join(df_with_position_cart_p_usr_p_prod,
-                  on = ['user_id','product_id'], how="left"
-                 )
-            .join(df_with_co_ocrd_stats_p_user_p_prod,
-                  on = ['user_id','product_id'], how="left"
-                 )
-        )   
-        long_cols = [field.name for field in result_usr_prod_df.schema.fields if isinstance(field.dataType, LongType)]
-        columns_to_cast = {col_name: F.col(col_name).cast(DoubleType()) for col_name in long_cols}
-        result_usr_prod_df = result_usr_prod_df.withColumns(columns_to_cast)
-        return result_usr_prod_df
+        return self._memoize("user_product_features", build, log_joins=True)
 
     def generate_time_related_features(self):
-        # Counts by day of the week
-        result_df = self.generate_user_related_features()
-        
-        df_with_count_of_dow = (
-            self.prior_orders_df.select("order_id", "order_dow")
-            .groupBy("order_dow")
-            .agg(F.count("order_id").alias("total_ord_count_p_dow"))
-        )
         
-        # Counts by hour of the day
-        df_with_count_of_ohod = (
-            self.prior_orders_df.select("order_id", "order_hour_of_day")
-            .groupBy("order_hour_of_day")
-            .agg(F.count("order_id").alias("total_ord_count_p_ohod"))
-        )
+        def build():
             
-        result_time_df = (
-            self.prior_orders_df.select("user_id","order_id","order_dow","order_hour_of_day")
-            .join(df_with_count_of_dow, on="order_dow", how="left")
-            .join(df_with_count_of_ohod, on="order_hour_of_day", how="left")
-        ).withColumnsRenamed({"order_dow":"dow","order_hour_of_day":"hour_of_day"})
-        
+            # Counts by day of the week
+            df_with_count_of_dow = (
+                self.prior_orders_df.select("order_id", "order_dow")
+                .groupBy("order_dow")
+                .agg(F.count("order_id").alias("total_ord_count_p_dow"))
+            )
+            
+            # Counts by hour of the day
+            df_with_count_of_ohod = (
+                self.prior_orders_df.select("order_id", "order_hour_of_day")
+                .groupBy("order_hour_of_day")
+                .agg(F.count("order_id").alias("total_ord_count_p_ohod"))
+            )
+                
+            result_time_df = (
+                self._join(
+                    self._join(self.prior_orders_df.select("user_id","order_id","order_dow","order_hour_of_day"),
+                               df_with_count_of_dow, on="order_dow", max_rows=7),
+                    df_with_count_of_ohod, on="order_hour_of_day", max_rows=24
+                )
+            ).withColumnsRenamed({"order_dow":"dow","order_hour_of_day":"hour_of_day"})
+            
+            long_cols = [field.name for field in result_time_df.schema.fields if isinstance(field.dataType, LongType)]
+            columns_to_cast = {col_name: F.col(col_name).cast(DoubleType()) for col_name in long_cols}
+            return result_time_df.withColumns(columns_to_cast)
         
-        long_cols = [field.name for field in result_time_df.schema.fields if isinstance(field.dataType, LongType)]
-        columns_to_cast = {col_name: F.col(col_name).cast(DoubleType()) for col_name in long_cols}
-        result_time_df = result_time_df.withColumns(columns_to_cast)
-        return result_time_df
+        return self._memoize("time_features", build, log_joins=True)
 
 
     def generate_all_types_of_features(self):
@@ -335,29 +419,47 @@ class FeatureGenerator:
         result_product_df = self.generate_product_related_features()
         result_usr_df = self.generate_user_related_features()
             
-        final_prior_ord_train_df = (
-            self.prior_product_orders.drop("add_to_cart_order")
-            .join(
-                result_time_df , on = 'order_id',how='left'
-            ).drop('order_id',"dow","hour_of_day")
-            .join(
-                result_usr_df , on = 'user_id',how='left'
-            )
-            .join(
-                result_product_df, on = 'product_id' , how = 'left'
-            )
-            .join(
-                result_usr_prod_df , on = ['user_id','product_id'] , how='left'
-            )
-            
-        )
-        long_cols = [field.name for field in final_prior_ord_train_df.schema.fields if isinstance(field.dataType, StringType)]
-        columns_to_cast = {col_name: F.col(col_name).cast(DoubleType()) for col_name in long_cols}
-        final_prior_ord_train_df = final_prior_ord_train_df.withColumns(columns_to_cast)
+        return self._memoize("all_features", lambda: assemble_training_set(
+            self.prior_product_orders, result_usr_df, result_product_df, result_usr_prod_df, result_time_df
+        ), log_joins=True)
 
-        return final_prior_ord_train_df
+        
+def assemble_training_set(prior_product_orders,user_stats_df,prods_stats_df,user_prod_stats_df,time_related_stats):
+    
+    final_prior_ord_train_df = (
+        prior_product_orders.drop("add_to_cart_order")
+        .join(
+            time_related_stats , on = 'order_id',how='left'
+        ).drop('order_id',"dow","hour_of_day")
+        .join(
+            user_stats_df , on = 'user_id',how='left'
+        )
+        .join(
+            prods_stats_df, on = 'product_id' , how = 'left'
+        )
+        .join(
+            user_prod_stats_df , on = ['user_id','product_id'] , how='left'
+        )
+        
+    )
+    return final_prior_ord_train_df
 
         
+def select_candidates(candidate_index, users_df):
+    
+    # Every product the given users bought before: the candidate pairs of their next order
+    return candidate_index.join(F.broadcast(users_df.select("user_id").distinct()), on="user_id", how="left_semi")
+
+
+def generate_time_constants(time_related_stats):
+    
+    # Mean number of orders per day of the week and per hour of the day, both in one job
+    return tuple(time_related_stats.agg(
+        F.count("order_id") / F.countDistinct("dow"),
+        F.count("order_id") / F.countDistinct("hour_of_day")
+    ).first())
+
+
 def generate_test_set_features(user_stats_df,prods_stats_df,user_prod_stats_df,time_related_stats,test_set):
         
     user_df_list = [user_stats_df,user_prod_stats_df]
@@ -383,24 +485,27 @@ def generate_test_set_features(user_stats_df,prods_stats_df,user_prod_stats_df,t
         raise NameError("'product_id' not found in test_set")
         
     else:
-        mean_dow_value = time_related_stats.groupBy("dow").agg(
-            F.mean("total_ord_count_p_dow")
-        ).collect()[0][0]
-        
-        mean_ohod_value = time_related_stats.groupBy("hour_of_day").agg(
-            F.mean("total_ord_count_p_ohod")
-        ).collect()[0][0]
+        mean_dow_value, mean_ohod_value = generate_time_constants(time_related_stats)
         
+        # Candidates come from the user x product features, so that join is a keyed lookup; product
+        # features are small and broadcast
+        keys = ["user_id", "product_id"]
         result_test_df = (
-              
             test_set.join(
-                user_stats_df, on = 'user_id', how = 'inner'
+                user_prod_stats_df, on = keys, how = 'inner'
             )
             .join(
-                prods_stats_df, on = 'product_id', how = 'inner'
+                user_stats_df, on = 'user_id', how = 'inner'
             )
             .join(
-                user_prod_stats_df, on = ['user_id','product_id'], how = 'inner'
+                F.broadcast(prods_stats_df), on = 'product_id', how = 'inner'
+            )
+            .select(
+                *keys,
+                *[col for col in test_set.columns if col not in keys],
+                *[col for col in user_stats_df.columns if col not in keys],
+                *[col for col in prods_stats_df.columns if col not in keys],
+                *[col for col in user_prod_stats_df.columns if col not in keys]
             )
             .withColumns({
                           "time_mean_dow_count":F.lit(mean_dow_value),
@@ -0,0 +1,224 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+from functools import lru_cache
+from mlflow import MlflowClient
+from mlflow.entities import Metric, Param, RunTag
+
+# Most entities a single MlflowClient.log_batch call accepts
+MAX_BATCH_METRICS = 1000
+MAX_BATCH_PARAMS = 100
+MAX_BATCH_TAGS = 100
+
+# Stops the worker
+_STOP = object()
+
+
+@lru_cache(maxsize=None)
+def environment_snapshot():
+    """
+    Exports the running environment once per process: `conda env export`, or `pip freeze` without conda.
+
+    Returns:
+    tuple: (file name, content, sha256 hex digest of the content).
+    """
+    try:
+        content = subprocess.run(["conda", "env", "export"], capture_output=True, text=True, check=True).stdout
+        file_name = "conda.yaml"
+    except (OSError, subprocess.CalledProcessError):
+        content = subprocess.run([sys.executable, "-m", "pip", "freeze"], capture_output=True, text=True).stdout
+        file_name = "requirements.txt"
+    return file_name, content, hashlib.sha256(content.encode()).hexdigest()
+
+
+class BackgroundMlflowLogger:
+    """
+    Logs to MLflow from a background thread, so a training call returns as soon as its model is ready.
+
+    Every call queues its write and returns. The worker takes everything queued at once and sends the
+    metrics, parameters and tags of each run in as few log_batch requests as possible, in the order they
+    were queued with the artifacts, models and run ends. Runs are addressed by id through an MlflowClient,
+    so models trained in several threads log to their own runs. flush() waits for the pending writes and
+    raises the errors met meanwhile.
+    """
+
+    def __init__(self, experiment_name, tracking_uri=None):
+        """
+        Parameters:
+        experiment_name (str): The name of the MLflow experiment, created when missing.
+        tracking_uri (str, optional): Tracking server or store, e.g. "file:///tmp/mlruns". Defaults to the
+                                      MLflow tracking URI.
+        """
+        self.client = MlflowClient(tracking_uri)
+        experiment = self.client.get_experiment_by_name(experiment_name)
+        self.experiment_id = experiment.experiment_id if experiment is not None \
+            else self.client.create_experiment(experiment_name)
+
+        # Private directory of the files written before being logged, removed by close()
+        self.temp_dir = tempfile.mkdtemp(prefix="mlflow-logger-")
+        self._queue = queue.Queue()
+        self._errors = []
+        self._errors_lock = threading.Lock()
+        self._worker = threading.Thread(target=self._work, name="mlflow-logger", daemon=True)
+        self._worker.start()
+        atexit.register(self.close)
+
+    def start_run(self, tags=None):
+        """
+        Creates a run, the only synchronous call as its id is assigned by the tracking store.
+
+        Returns:
+        str: The run id, passed to the other calls.
+        """
+        tags = {name: str(value) for name, value in (tags or {}).items()}
+        return self.client.create_run(self.experiment_id, tags=tags).info.run_id
+
+    def log_params(self, run_id, params):
+        self._queue.put(("params", run_id, [Param(name, str(value)) for name, value in params.items()]))
+
+    def log_metrics(self, run_id, metrics, step=0):
+        timestamp = int(time.time() * 1000)
+        self._queue.put(("metrics", run_id, [Metric(name, float(value), timestamp, step)
+                                             for name, value in metrics.items()]))
+
+    def set_tags(self, run_id, tags):
+        self._queue.put(("tags", run_id, [RunTag(name, str(value)) for name, value in tags.items()]))
+
+    def log_dict(self, run_id, dictionary, artifact_file):
+        """
+        Logs a dictionary as a JSON artifact. It is serialized by the worker and must not change meanwhile.
+        """
+        self._queue.put(("dict", run_id, (dictionary, artifact_file)))
+
+    def log_artifact(self, run_id, local_path, artifact_path=None):
+        self._queue.put(("artifact", run_id, (local_path, artifact_path)))
+
+    def log_model(self, run_id, flavor, model, artifact_path):
+        """
+        Saves a model with an MLflow flavor module (e.g. mlflow.xgboost) and logs it under artifact_path.
+        """
+        self._queue.put(("model", run_id, (flavor, model, artifact_path)))
+
+    def log_environment(self, run_id):
+        """
+        Logs the environment snapshot of the process, exported on first use, and tags the run with its hash.
+        """
+        file_name, content, digest = environment_snapshot()
+        path = os.path.join(self.temp_dir, "environment", digest, file_name)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(content)
+        self.set_tags(run_id, {"environment_hash": digest})
+        self.log_artifact(run_id, path)
+
+    def end_run(self, run_id, status="FINISHED"):
+        self._queue.put(("end", run_id, status))
+
+    def flush(self):
+        """
+        Waits until every queued write is done.
+
+        Raises:
+        RuntimeError: With the writes that failed since the last flush.
+        """
+        self._queue.join()
+        with self._errors_lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            raise RuntimeError(f"{len(errors)} MLflow writes failed: " + "; ".join(errors))
+
+    def close(self):
+        """
+        Flushes, stops the worker and removes the temporary files.
+        """
+        if not self._worker.is_alive():
+            return
+        try:
+            self.flush()
+        finally:
+            self._queue.put(_STOP)
+            self._worker.join()
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+            atexit.unregister(self.close)
+
+    def _work(self):
+        while True:
+            items = [self._queue.get()]
+            # Everything queued meanwhile is written together
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = any(item is _STOP for item in items)
+            try:
+                self._write([item for item in items if item is not _STOP])
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+            if stop:
+                return
+
+    def _write(self, items):
+        # Metrics, params and tags are gathered per run until an artifact, model or run end has to be
+        # written after them
+        batches = {}
+        for kind, run_id, payload in items:
+            if kind in ("metrics", "params", "tags"):
+                batch = batches.setdefault(run_id, {"metrics": [], "params": {}, "tags": {}})
+                if kind == "metrics":
+                    batch["metrics"].extend(payload)
+                else:
+                    batch[kind].update((entity.key, entity) for entity in payload)
+                continue
+
+            self._write_batches(batches)
+            batches = {}
+            self._try(kind, run_id, self._write_one, kind, run_id, payload)
+        self._write_batches(batches)
+
+    def _write_batches(self, batches):
+        for run_id, batch in batches.items():
+            metrics, params, tags = batch["metrics"], list(batch["params"].values()), list(batch["tags"].values())
+            while metrics or params or tags:
+                self._try("log_batch", run_id, self.client.log_batch, run_id, metrics=metrics[:MAX_BATCH_METRICS],
+                          params=params[:MAX_BATCH_PARAMS], tags=tags[:MAX_BATCH_TAGS])
+                metrics, params, tags = \
+                    metrics[MAX_BATCH_METRICS:], params[MAX_BATCH_PARAMS:], tags[MAX_BATCH_TAGS:]
+
+    def _write_one(self, kind, run_id, payload):
+        if kind == "dict":
+            dictionary, artifact_file = payload
+            path = os.path.join(tempfile.mkdtemp(dir=self.temp_dir), os.path.basename(artifact_file))
+            with open(path, "w") as f:
+                json.dump(dictionary, f, indent=2, default=str)
+            self.client.log_artifact(run_id, path, os.path.dirname(artifact_file) or None)
+            shutil.rmtree(os.path.dirname(path))
+        elif kind == "artifact":
+            self.client.log_artifact(run_id, *payload)
+        elif kind == "model":
+            flavor, model, artifact_path = payload
+            path = os.path.join(tempfile.mkdtemp(dir=self.temp_dir), "model")
+            flavor.save_model(model, path)
+            self.client.log_artifacts(run_id, path, artifact_path)
+            shutil.rmtree(os.path.dirname(path))
+        elif kind == "end":
+            self.client.set_terminated(run_id, payload)
+
+    def _try(self, kind, run_id, fn, *args, **kwargs):
+        # A failed write is reported by the next flush, the following ones still go through
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            with self._errors_lock:
+                self._errors.append(f"{kind} of run {run_id}: {e}")
@@ -2,38 +2,234 @@
 import time
 import os
 import gc
-import json
+import threading
+import numpy as np
 import mlflow
 import h2o
 import xgboost as xgb
 import lightgbm as lgb
-from sklearn.metrics import precision_score, recall_score, f1_score, roc_auc_score, log_loss
+from model_evaluation import evaluate, log_evaluation
+from mlflow_logger import BackgroundMlflowLogger
+from feature_set_adapter import FeatureSetAdapter, h2o_predict
 from h2o.estimators.glm import H2OGeneralizedLinearEstimator
 from h2o.estimators import H2OGradientBoostingEstimator
+from concurrent.futures import ThreadPoolExecutor
+
+# Default search space of ModelTrainer.tune_xgb_gbm: (low, high, scale) ranges or lists of choices
+XGB_SEARCH_SPACE = {
+    'eta': (0.01, 0.3, 'log'),
+    'subsample': (0.1, 1.0, 'linear'),
+    'colsample_bytree': (0.1, 1.0, 'linear'),
+    'colsample_bylevel': (0.1, 1.0, 'linear'),
+    'min_child_weight': (1, 500, 'log'),
+    'gamma': (0, 500, 'linear'),
+    'lambda': (0, 100, 'linear'),
+    'alpha': (0, 100, 'linear'),
+    'max_depth': [1, 2, 4, 6],
+}
+
+# XGBoost evaluation metrics where higher is better ("ndcg@5" style variants included), as XGBoost's early
+# stopping defines them
+MAXIMIZED_METRICS = ('auc', 'aucpr', 'pre', 'map', 'ndcg')
+
+
+def is_maximized_metric(metric):
+    """
+    Whether higher values of an XGBoost evaluation metric are better.
+    """
+    return metric.split('@')[0] in MAXIMIZED_METRICS
+
+
+def sample_params(search_space, rng):
+    """
+    Draws one configuration from a search space.
+
+    Parameters:
+    search_space (dict): name -> list of choices, or (low, high, scale) with scale 'linear', 'log' or 'int'.
+    rng (np.random.Generator): Random generator.
+
+    Returns:
+    dict: The sampled parameters.
+    """
+    params = {}
+    for name, space in search_space.items():
+        if isinstance(space, list):
+            params[name] = space[rng.integers(len(space))]
+            continue
+
+        low, high, scale = space
+        if scale == 'log':
+            params[name] = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+        elif scale == 'int':
+            params[name] = int(rng.integers(low, high + 1))
+        elif scale == 'linear':
+            params[name] = float(rng.uniform(low, high))
+        else:
+            raise ValueError(f"Unknown scale '{scale}' for '{name}', expected 'linear', 'log' or 'int'")
+    return params
+
+
+class MedianPruner:
+    """
+    Shared by concurrent trials: a trial is pruned when its evaluation score at a step is worse than the
+    median score of the other trials at that step.
+    """
+
+    def __init__(self, n_startup_trials=5, n_warmup_steps=20, minimize=True):
+        """
+        Parameters:
+        n_startup_trials (int): Trials that must have reached a step before pruning at that step.
+        n_warmup_steps (int): Boosting rounds before any pruning.
+        minimize (bool): Whether lower scores are better.
+        """
+        self.n_startup_trials = n_startup_trials
+        self.n_warmup_steps = n_warmup_steps
+        self.minimize = minimize
+        self._scores = {}
+        self._lock = threading.Lock()
+
+    def report(self, trial, step, score):
+        """
+        Records the score of a trial at a step.
+
+        Returns:
+        bool: True when the trial should stop.
+        """
+        with self._lock:
+            others = [other_score for other, other_score in self._scores.setdefault(step, {}).items()
+                      if other != trial]
+            self._scores[step][trial] = score
+
+        if step < self.n_warmup_steps or len(others) < self.n_startup_trials:
+            return False
+        median = np.median(others)
+        return bool(score > median if self.minimize else score < median)
+
+
+class _PruningCallback(xgb.callback.TrainingCallback):
+
+    def __init__(self, pruner, trial, data_name, metric_name):
+        self.pruner = pruner
+        self.trial = trial
+        self.data_name = data_name
+        self.metric_name = metric_name
+        self.pruned = False
+        super().__init__()
+
+    def after_iteration(self, model, epoch, evals_log):
+        # Returning True stops the training
+        self.pruned = self.pruner.report(self.trial, epoch, evals_log[self.data_name][self.metric_name][-1])
+        return self.pruned
+
 
 class ModelTrainer:
     
-    def __init__(self, experiment_name, train_set, test_set=None, target_column='reordered'):
+    def __init__(self, experiment_name, train_set, test_set=None, target_column='reordered', eval_user_ids=None,
+                 logger=None):
         """
         Initializes the ModelTrainer with the experiment name, training set, and optional test set.
         
         Parameters:
         experiment_name (str): The name of the MLflow experiment.
-        train_set (H2OFrame): The training dataset.
-        test_set (H2OFrame, optional): The test dataset. Defaults to None.
+        train_set (FeatureSetAdapter, or xgb.DMatrix / lgb.Dataset / H2OFrame): The training dataset. A
+                   FeatureSetAdapter is loaded once and converted for every library, the others are
+                   used as they are by the methods of their library.
+        test_set (same type as train_set, optional): The test dataset. Defaults to None.
         target_column (str): The name of the target column. Defaults to 'reordered'.
+        eval_user_ids (array-like, optional): User of every row of the evaluated set (test_set, or
+                                              train_set without one), to also log the mean basket F1.
+        logger (BackgroundMlflowLogger, optional): Logger of the runs, shared by the trainers of one
+                                                   experiment. Defaults to a new logger of experiment_name.
         """
+        if test_set is not None and isinstance(train_set, FeatureSetAdapter) != isinstance(test_set, FeatureSetAdapter):
+            raise ValueError("train_set and test_set must both be FeatureSetAdapters or both library data sets")
+
         self.train_set = train_set
         self.test_set = test_set
         self.exp_name = experiment_name
         self.target_column = target_column  # Store the target column name
-        mlflow.set_experiment(self.exp_name)
+        self.eval_user_ids = eval_user_ids
+        self._local = threading.local()  # Evaluation report of the last model trained by each thread
+        # Runs are logged in the background, training calls return as soon as their model is ready
+        self.logger = logger or BackgroundMlflowLogger(self.exp_name)
 
-    def __log_details(self, y_true, preds, prev_commit_hash, params, model=None):
+    @property
+    def last_report(self):
         """
-        Logs detailed information about the model's performance, environment, and dataset to MLflow.
+        Evaluation report (see model_evaluation.evaluate) of the last model trained by the calling thread.
+        """
+        return getattr(self._local, "report", None)
+
+    def flush(self):
+        """
+        Waits until the runs of the trained models are fully logged to MLflow.
+        """
+        self.logger.flush()
+
+    def __start_run(self, dataset_version, model_version, algorithm):
+        return self.logger.start_run(tags={"dataset_version": dataset_version, "model_version": model_version,
+                                           "algorithm": algorithm})
+
+    def __data_sets(self, library, **kwargs):
+        """
+        Training and test sets of a library, converted from FeatureSetAdapters on first use and then shared.
         
         Parameters:
+        library (str): "xgboost", "lightgbm" or "h2o".
+        kwargs: Conversion parameters, see FeatureSetAdapter.to_dmatrix and to_lgb_dataset.
+        
+        Returns:
+        tuple: (training set, test set or None).
+        """
+        if not isinstance(self.train_set, FeatureSetAdapter):
+            return self.train_set, self.test_set
+
+        if library == "xgboost":
+            train_set = self.train_set.to_dmatrix(**kwargs)
+            return train_set, self.test_set.to_dmatrix(ref=train_set, **kwargs) if self.test_set is not None else None
+        if library == "lightgbm":
+            train_set = self.train_set.to_lgb_dataset(**kwargs)
+            return train_set, self.test_set.to_lgb_dataset(reference=train_set, **kwargs) \
+                if self.test_set is not None else None
+        return self.train_set.to_h2o_frame(), self.test_set.to_h2o_frame() if self.test_set is not None else None
+
+    def __h2o_columns(self):
+        # Feature and label columns of the H2O frames
+        if isinstance(self.train_set, FeatureSetAdapter):
+            return self.train_set.feature_names, self.train_set.label_name
+        return self.train_set.drop(self.target_column).columns, self.target_column
+
+    def __predict(self, model, **kwargs):
+        """
+        Predicts the evaluated set (test_set, or train_set without one).
+        
+        Returns:
+        tuple: (predictions, labels), as NumPy arrays.
+        """
+        data_set = self.test_set if self.test_set is not None else self.train_set
+
+        if isinstance(data_set, FeatureSetAdapter):
+            # In place on the shared matrix
+            if isinstance(model, xgb.Booster):
+                return model.inplace_predict(data_set.X, **kwargs), data_set.label
+            if isinstance(model, lgb.Booster):
+                return model.predict(data_set.X, **kwargs), data_set.label
+            return data_set.predict_h2o(model)
+
+        if isinstance(model, xgb.Booster):
+            return model.predict(data_set, **kwargs), data_set.get_label()
+        if isinstance(model, lgb.Booster):
+            # Needs a Dataset built with free_raw_data=False
+            return model.predict(data_set.get_data(), **kwargs), data_set.get_label()
+        return h2o_predict(model, data_set, self.target_column)
+
+    def __log_details(self, run_id, y_true, preds, prev_commit_hash, params, model=None):
+        """
+        Logs detailed information about the model's performance, environment, and dataset to MLflow, and
+        ends the run.
+        
+        Parameters:
+        run_id (str): The MLflow run.
         y_true (array-like): True values for the target variable.
         preds (array-like): Predicted values.
         prev_commit_hash (str): The commit hash for version control reference.
@@ -41,37 +237,33 @@ class ModelTrainer:
         model (object, optional): The trained model. Defaults to None.
         
         Logs:
-        - Precision, recall, F1 score, AUC, and log loss.
+        - Precision, recall, F1 score, AUC, log loss, best F1 threshold and mean basket F1, with the
+          full report (curves included) as evaluation.json.
         - Commit URL, environment, and dataset details.
         """
         try:
             # Log parameters
             if params is not None:
-                mlflow.log_params(params)
+                self.logger.log_params(run_id, params)
             else:
-                mlflow.log_param("params", None)
+                self.logger.log_params(run_id, {"params": None})
 
-            # Log metrics
-            pred_logits = [1 if pred >= 0.5 else 0 for pred in preds]
-            mlflow.log_metric("precision", precision_score(y_true, pred_logits))
-            mlflow.log_metric("recall", recall_score(y_true, pred_logits))
-            mlflow.log_metric("f1", f1_score(y_true, pred_logits))
-            mlflow.log_metric("AUC", roc_auc_score(y_true, preds))
-            mlflow.log_metric("logloss", log_loss(y_true, preds))
+            # Log metrics, all derived from one sort of the predictions
+            self._local.report = evaluate(y_true, preds, user_ids=self.eval_user_ids)
+            log_evaluation(self._local.report, logger=self.logger, run_id=run_id)
 
             # Log script URL with version 
             commit_url = "https://github.com/d-sutariya/instacart_next_basket_prediction/tree/" + prev_commit_hash
-            mlflow.log_param("repository url", commit_url)
+            self.logger.log_params(run_id, {"repository url": commit_url})
 
-            # Log environment 
-            os.system("conda env export > conda.yaml")
-            mlflow.log_artifact("conda.yaml")
+            # Log environment, exported once per process
+            self.logger.log_environment(run_id)
 
             # Log dataset 
             dataset_path = "https://www.kaggle.com/datasets/deepsutariya/instacart-exp-data" 
-            mlflow.log_param("dataset url", dataset_path)
+            self.logger.log_params(run_id, {"dataset url": dataset_path})
 
-            mlflow.end_run()
+            self.logger.end_run(run_id)
 
         except Exception as e:
             raise RuntimeError(f"Error logging model details: {str(e)}")
@@ -90,39 +282,30 @@ class ModelTrainer:
         h2o_model: The trained H2O GLM model.
         """
         try:
+            train_set, _ = self.__data_sets("h2o")
+            x, y = self.__h2o_columns()
             start = time.time()
             
             h2o_logistic_model = H2OGeneralizedLinearEstimator(family='binomial') \
-                                .train(x=self.train_set.drop("reordered").columns, y='reordered', training_frame=self.train_set)
+                                .train(x=x, y=y, training_frame=train_set)
             duration = time.time() - start
             
-            with mlflow.start_run():
-                mlflow.h2o.log_model(h2o_logistic_model, "h2o_logistic_model")
-                mlflow.log_param("family", "binomial")
-                mlflow.log_param("alpha", h2o_logistic_model.get_params()['alpha'])
-                mlflow.log_param("lambda", h2o_logistic_model.get_params()['lambda'])
-                
-                mlflow.log_param("training_time", duration)
-                mlflow.set_tag("dataset_version", dataset_version)
-                mlflow.set_tag("model_version", model_version)
-                mlflow.set_tag("algorithm", "h2o_glm")
-                
-                progress = h2o_logistic_model.scoring_history().to_dict()
-                with open("loss_history.json", "w") as f:
-                    json.dump(progress, f)
-                mlflow.log_artifact("loss_history.json")
-                
-                if self.test_set is not None:
-                    preds = h2o_logistic_model.predict(self.test_set).as_data_frame(use_multi_thread=True)['p1']
-                    y_true = self.test_set['reordered'].as_data_frame(use_multi_thread=True)
-                else:
-                    preds = h2o_logistic_model.predict(self.train_set).as_data_frame(use_multi_thread=True)['p1']
-                    y_true = self.train_set['reordered'].as_data_frame(use_multi_thread=True)
-
-                self.__log_details(y_true, preds, prev_commit_hash, params)
-                
-                del y_true, preds
-                gc.collect()
+            run_id = self.__start_run(dataset_version, model_version, "h2o_glm")
+            self.logger.log_model(run_id, mlflow.h2o, h2o_logistic_model, "h2o_logistic_model")
+            self.logger.log_params(run_id, {"family": "binomial",
+                                            "alpha": h2o_logistic_model.get_params()['alpha'],
+                                            "lambda": h2o_logistic_model.get_params()['lambda'],
+                                            "training_time": duration})
+
+            progress = h2o_logistic_model.scoring_history().to_dict()
+            self.logger.log_dict(run_id, progress, "loss_history.json")
+
+            preds, y_true = self.__predict(h2o_logistic_model)
+
+            self.__log_details(run_id, y_true, preds, prev_commit_hash, params)
+
+            del y_true, preds
+            gc.collect()
 
             return h2o_logistic_model
         
@@ -149,43 +332,34 @@ class ModelTrainer:
             if params is None:
                 params = {'distribution': 'bernoulli'}
             
+            train_set, test_set = self.__data_sets("h2o")
+            x, y = self.__h2o_columns()
             start = time.time()
             
-            if self.test_set is not None:
+            if test_set is not None:
                 h2o_gbm = H2OGradientBoostingEstimator(**params) \
-                          .train(x=self.train_set.drop("reordered").columns,
-                                 y='reordered',
-                                 training_frame=self.train_set,
-                                 validation_frame=self.test_set)
+                          .train(x=x,
+                                 y=y,
+                                 training_frame=train_set,
+                                 validation_frame=test_set)
             else:
                 h2o_gbm = H2OGradientBoostingEstimator(**params) \
-                          .train(x=self.train_set.drop("reordered").columns,
-                                 y='reordered',
-                                 training_frame=self.train_set)
+                          .train(x=x,
+                                 y=y,
+                                 training_frame=train_set)
 
             duration = time.time() - start
             
-            with mlflow.start_run():
-                mlflow.h2o.log_model(h2o_gbm, "h2o_gbm_model")
-                mlflow.log_params(params if params is not None else {})
-                mlflow.log_param("training_time", duration)
-                mlflow.set_tag("dataset_version", dataset_version)
-                mlflow.set_tag("model_version", model_version)
-                mlflow.set_tag("algorithm", "h2o_gbm")
-                
-                progress = h2o_gbm.scoring_history().to_dict()
-                with open("loss_history.json", "w") as f:
-                    json.dump(progress, f)
-                mlflow.log_artifact("loss_history.json")
-                
-                if self.test_set is not None:
-                    preds = h2o_gbm.predict(self.test_set).as_data_frame(use_multi_thread=True)['p1']
-                    y_true = self.test_set['reordered'].as_data_frame(use_multi_thread=True)
-                else:
-                    preds = h2o_gbm.predict(self.train_set).as_data_frame(use_multi_thread=True)['p1']
-                    y_true = self.train_set['reordered'].as_data_frame(use_multi_thread=True)
-
-                self.__log_details(y_true, preds, prev_commit_hash, params, h2o_gbm)
+            run_id = self.__start_run(dataset_version, model_version, "h2o_gbm")
+            self.logger.log_model(run_id, mlflow.h2o, h2o_gbm, "h2o_gbm_model")
+            self.logger.log_params(run_id, {**params, "training_time": duration})
+
+            progress = h2o_gbm.scoring_history().to_dict()
+            self.logger.log_dict(run_id, progress, "loss_history.json")
+
+            preds, y_true = self.__predict(h2o_gbm)
+
+            self.__log_details(run_id, y_true, preds, prev_commit_hash, params, h2o_gbm)
 
             del y_true, preds
             gc.collect()
@@ -218,33 +392,24 @@ class ModelTrainer:
                 if 'eval_metric' not in params.keys():
                     params['eval_metric'] = 'logloss'
 
+            train_set, test_set = self.__data_sets("xgboost", max_bin=(params or {}).get('max_bin', 256))
             start = time.time()
 
-            if self.test_set is not None:
-                watchlist = [(self.train_set, 'train'), (self.test_set, 'eval')]
-                xgb_model = xgb.train(params, self.train_set, num_boost_round=500, early_stopping_rounds=30, evals=watchlist)
+            if test_set is not None:
+                watchlist = [(train_set, 'train'), (test_set, 'eval')]
+                xgb_model = xgb.train(params, train_set, num_boost_round=500, early_stopping_rounds=30, evals=watchlist)
             else:
-                xgb_model = xgb.train(params, self.train_set, num_boost_round=500, early_stopping_rounds=30,evals=(self.train_set,'train'))
+                xgb_model = xgb.train(params, train_set, num_boost_round=500, early_stopping_rounds=30, evals=[(train_set, 'train')])
 
             duration = time.time() - start
 
-            with mlflow.start_run():
-                
-                mlflow.xgboost.log_model(xgb_model, "xgb_gbm_model")
-                mlflow.log_params(params if params is not None else {})
-                mlflow.log_param("training_time", duration)
-                mlflow.set_tag("dataset_version", dataset_version)
-                mlflow.set_tag("model_version", model_version)
-                mlflow.set_tag("algorithm", "xgb_gbm")
+            run_id = self.__start_run(dataset_version, model_version, "xgb_gbm")
+            self.logger.log_model(run_id, mlflow.xgboost, xgb_model, "xgb_gbm_model")
+            self.logger.log_params(run_id, {**(params if params is not None else {}), "training_time": duration})
 
-                if self.test_set is not None:
-                    preds = xgb_model.predict(self.test_set)
-                    y_true = self.test_set.get_label()
-                else:
-                    preds = xgb_model.predict(self.train_set)
-                    y_true = self.train_set.get_label()
+            preds, y_true = self.__predict(xgb_model)
 
-                self.__log_details(y_true, preds, prev_commit_hash, params, xgb_model)
+            self.__log_details(run_id, y_true, preds, prev_commit_hash, params, xgb_model)
 
             del y_true, preds
             gc.collect()
@@ -253,6 +418,113 @@ class ModelTrainer:
         except Exception as e:
             raise RuntimeError(f"Error training XGBoost GBM: {str(e)}")
 
+    def tune_xgb_gbm(self, prev_commit_hash, dataset_version, model_version, search_space=None, base_params=None,
+                     n_trials=32, n_parallel=None, threads_per_trial=None, num_boost_round=500,
+                     early_stopping_rounds=30, pruner=None, seed=0, maximize=None):
+        """
+        Searches XGBoost GBM hyperparameters with trials running concurrently.
+
+        Every trial trains on the same train_set, so a QuantileDMatrix (see feature_set_dmatrix.load_dmatrix,
+        or a FeatureSetAdapter) is quantized once and shared, instead of once per trial. Trials run in
+        threads, XGBoost releasing the GIL, each with threads_per_trial cores, and report their evaluation
+        score after every round to a shared MedianPruner that stops the ones falling behind. The search is
+        logged as one MLflow run.
+
+        A DMatrix that is not a QuantileDMatrix (in-memory or external memory matrices built by
+        load_dmatrix) can only be read by one thread at a time, its trials then run one after another.
+
+        Parameters:
+        prev_commit_hash (str): The commit hash for version control.
+        dataset_version (str): The version of the dataset.
+        model_version (str): The version of the model.
+        search_space (dict, optional): See sample_params. Defaults to XGB_SEARCH_SPACE.
+        base_params (dict, optional): Fixed parameters of every trial. max_bin must match the one the
+                                      QuantileDMatrix was built with.
+        n_trials (int): Number of configurations tried.
+        n_parallel (int, optional): Concurrent trials. Defaults to the number of cores // 4, at least 1.
+        threads_per_trial (int, optional): XGBoost threads per trial. Defaults to cores // n_parallel.
+        num_boost_round (int): Maximum boosting rounds per trial.
+        early_stopping_rounds (int): Rounds without improvement before a trial stops.
+        pruner (MedianPruner, optional): Defaults to MedianPruner() in the direction of the metric.
+        seed (int): Seed of the parameter sampling.
+        maximize (bool, optional): Whether higher eval_metric values are better. Defaults to
+                                   is_maximized_metric(eval_metric).
+
+        Returns:
+        tuple: (best xgb.Booster, list of trial dicts with params, score, rounds, pruned and training_time).
+        """
+        try:
+            base_params = dict(base_params or {})
+            base_params.setdefault('booster', 'gbtree')
+            base_params.setdefault('tree_method', 'hist')
+            base_params.setdefault('objective', 'binary:logistic')
+            base_params.setdefault('eval_metric', 'logloss')
+
+            # Scores, early stopping and pruning all go in the direction of the metric
+            if maximize is None:
+                maximize = is_maximized_metric(base_params['eval_metric'])
+            pruner = pruner or MedianPruner(minimize=not maximize)
+            if pruner.minimize == maximize:
+                raise ValueError(f"The pruner {'minimizes' if pruner.minimize else 'maximizes'} while "
+                                 f"{base_params['eval_metric']} is {'maximized' if maximize else 'minimized'}")
+            best = max if maximize else min
+
+            train_set, test_set = self.__data_sets("xgboost", max_bin=base_params.get('max_bin', 256))
+            eval_set = test_set if test_set is not None else train_set
+
+            n_cores = os.cpu_count()
+            if all(isinstance(data_set, xgb.QuantileDMatrix) for data_set in (train_set, eval_set)):
+                n_parallel = n_parallel or max(n_cores // 4, 1)
+            else:
+                if n_parallel and n_parallel > 1:
+                    print("Trials run one after another: only a QuantileDMatrix can be shared by concurrent trials")
+                n_parallel = 1
+            threads_per_trial = threads_per_trial or max(n_cores // n_parallel, 1)
+            base_params['nthread'] = threads_per_trial
+            rng = np.random.default_rng(seed)
+            trials_params = [{**base_params, **sample_params(search_space or XGB_SEARCH_SPACE, rng)}
+                             for _ in range(n_trials)]
+
+            def run_trial(trial):
+                callback = _PruningCallback(pruner, trial, 'eval', base_params['eval_metric'])
+                evals_result = {}
+                start = time.time()
+                booster = xgb.train(trials_params[trial], train_set, num_boost_round=num_boost_round,
+                                    evals=[(eval_set, 'eval')], early_stopping_rounds=early_stopping_rounds,
+                                    evals_result=evals_result, callbacks=[callback], verbose_eval=False,
+                                    maximize=maximize)
+                scores = evals_result['eval'][base_params['eval_metric']]
+                return booster, {"trial": trial, "params": trials_params[trial], "score": float(best(scores)),
+                                 "rounds": len(scores), "pruned": callback.pruned,
+                                 "training_time": time.time() - start}
+
+            start = time.time()
+            with ThreadPoolExecutor(max_workers=n_parallel) as executor:
+                results = list(executor.map(run_trial, range(n_trials)))
+            duration = time.time() - start
+
+            trials = [trial for _, trial in results]
+            best_booster, best_trial = best(results, key=lambda result: result[1]["score"])
+
+            run_id = self.__start_run(dataset_version, model_version, "xgb_gbm_tuning")
+            self.logger.log_model(run_id, mlflow.xgboost, best_booster, "xgb_gbm_model")
+            self.logger.log_params(run_id, {**best_trial["params"], "training_time": duration, "n_trials": n_trials,
+                                            "n_parallel": n_parallel, "threads_per_trial": threads_per_trial})
+            self.logger.log_metrics(run_id, {"best_" + base_params['eval_metric']: best_trial["score"],
+                                             "pruned_trials": sum(int(trial["pruned"]) for trial in trials)})
+            self.logger.log_dict(run_id, {"trials": trials}, "trials.json")
+
+            preds, y_true = self.__predict(best_booster, iteration_range=(0, best_booster.best_iteration + 1))
+
+            self.__log_details(run_id, y_true, preds, prev_commit_hash, None, best_booster)
+
+            del y_true, preds
+            gc.collect()
+            return best_booster, trials
+
+        except Exception as e:
+            raise RuntimeError(f"Error tuning XGBoost GBM: {str(e)}")
+
     def train_xgb_rf(self, prev_commit_hash, dataset_version, model_version, params=None):
         """
         Trains a Random Forest using XGBoost's 'random forest' booster.
@@ -275,32 +547,24 @@ class ModelTrainer:
                 if 'eval_metric' not in params.keys():
                     params['eval_metric'] = 'logloss'
 
+            train_set, test_set = self.__data_sets("xgboost", max_bin=(params or {}).get('max_bin', 256))
             start = time.time()
-           
-            if self.test_set is not None:
-                watchlist = [(self.train_set, 'train'), (self.test_set, 'eval')]
-                xgb_rf_model = xgb.train(params, self.train_set, num_boost_round=500, early_stopping_rounds=30, evals=watchlist)
+
+            if test_set is not None:
+                watchlist = [(train_set, 'train'), (test_set, 'eval')]
+                xgb_rf_model = xgb.train(params, train_set, num_boost_round=500, early_stopping_rounds=30, evals=watchlist)
             else:
-                xgb_rf_model = xgb.train(params, self.train_set, num_boost_round=500, early_stopping_rounds=30,evals=(self.train_set,'train'))
+                xgb_rf_model = xgb.train(params, train_set, num_boost_round=500, early_stopping_rounds=30, evals=[(train_set, 'train')])
 
             duration = time.time() - start
 
-            with mlflow.start_run():
-                mlflow.xgboost.log_model(xgb_rf_model, "xgb_rf_model")
-                mlflow.log_params(params if params is not None else {})
-                mlflow.log_param("training_time", duration)
-                mlflow.set_tag("dataset_version", dataset_version)
-                mlflow.set_tag("model_version", model_version)
-                mlflow.set_tag("algorithm", "xgb_rf")
+            run_id = self.__start_run(dataset_version, model_version, "xgb_rf")
+            self.logger.log_model(run_id, mlflow.xgboost, xgb_rf_model, "xgb_rf_model")
+            self.logger.log_params(run_id, {**(params if params is not None else {}), "training_time": duration})
 
-                if self.test_set is not None:
-                    preds = xgb_rf_model.predict(self.test_set)
-                    y_true = self.test_set.get_label()
-                else:
-                    preds = xgb_rf_model.predict(self.train_set)
-                    y_true = self.test_set.get_label()
+            preds, y_true = self.__predict(xgb_rf_model)
 
-                self.__log_details(y_true, preds, prev_commit_hash, params, xgb_rf_model)
+            self.__log_details(run_id, y_true, preds, prev_commit_hash, params, xgb_rf_model)
 
             del y_true, preds
             gc.collect()
@@ -323,41 +587,31 @@ class ModelTrainer:
         lgb_model: The trained LightGBM model.
         """
         try:
-            if params is not None:
-                if 'objective' not in params.keys():
-                    params['objective'] = 'binary'
+            if params is None:
+                params = {}
+            if 'objective' not in params.keys():
+                params['objective'] = 'binary'
 
+            train_set, test_set = self.__data_sets("lightgbm")
             start = time.time()
 
-            
-            if self.test_set is not None:
-                lgb_model = lgb.train(params, self.train_set, num_boost_round=500, early_stopping_rounds=30, valid_sets=[self.test_set])
+            # Early stopping is a callback since LightGBM 4
+            if test_set is not None:
+                lgb_model = lgb.train(params, train_set, num_boost_round=500, valid_sets=[test_set],
+                                      callbacks=[lgb.early_stopping(30)])
             else:
-                lgb_model = lgb.train(params, self.train_set, num_boost_round=500, early_stopping_rounds=30, valid_sets=[self.train_set])
+                lgb_model = lgb.train(params, train_set, num_boost_round=500, valid_sets=[train_set],
+                                      callbacks=[lgb.early_stopping(30)])
 
             duration = time.time() - start
 
-            with mlflow.start_run():
-                
-                mlflow.lightgbm.log_model(lgb_model, "lgb_model")
-                mlflow.log_params(params if params is not None else {})
-                mlflow.log_param("training_time", duration)
-                mlflow.set_tag("dataset_version", dataset_version)
-                mlflow.set_tag("model_version", model_version)
-                mlflow.set_tag("algorithm", "lgbm")
-
-            if self.test_set != None:
-                
-                preds = lgb_model.predict(self.test_set.get_data())
-                y_true = self.test_set.get_label()
-    
-                self.__log_details(y_true, preds, prev_commit_hash, params, lgb_gbm)
-            else:
-                
-                preds = lgb_model.predict(self.train_set.get_data())
-                y_true = self.train_set.get_label()
-    
-                self.__log_details(y_true, preds, prev_commit_hash, params, lgb_gbm)
+            run_id = self.__start_run(dataset_version, model_version, "lgbm")
+            self.logger.log_model(run_id, mlflow.lightgbm, lgb_model, "lgb_model")
+            self.logger.log_params(run_id, {**params, "training_time": duration})
+
+            preds, y_true = self.__predict(lgb_model)
+
+            self.__log_details(run_id, y_true, preds, prev_commit_hash, params, lgb_model)
 
             del y_true, preds
             gc.collect()
@@ -0,0 +1,150 @@
+import numpy as np
+import mlflow
+from f1_optimizer_script import F1Optimizer
+
+# Points kept of the precision / recall / F1 curves in the logged report
+CURVE_POINTS = 1000
+
+
+def _ranked_counts(y_true, preds):
+    # Sorts once by decreasing prediction and counts positives / negatives above every distinct score
+    order = np.argsort(-preds, kind="stable")
+    sorted_preds = preds[order]
+    sorted_true = y_true[order]
+
+    # Last position of every run of equal scores: ties are all in or all out of a threshold
+    last_of_run = np.append(np.flatnonzero(sorted_preds[1:] != sorted_preds[:-1]), len(sorted_preds) - 1)
+    tps = np.cumsum(sorted_true)[last_of_run]
+    fps = (last_of_run + 1) - tps
+    return sorted_preds[last_of_run], tps, fps
+
+
+def binary_metrics(y_true, preds, threshold=0.5):
+    """
+    AUC, log loss and precision / recall / F1 at every threshold, from a single sort of the predictions.
+
+    Parameters:
+    y_true (array-like): 0/1 labels.
+    preds (array-like): Predicted probabilities.
+    threshold (float): Threshold of the reported precision, recall and F1.
+
+    Returns:
+    dict: precision, recall, f1, AUC, logloss, best_f1 and best_f1_threshold, and the "curve" of
+          thresholds, precision, recall and f1 (at most CURVE_POINTS points).
+    """
+    y_true = np.asarray(y_true, dtype=np.float64).ravel()
+    preds = np.asarray(preds).ravel()
+    if preds.dtype not in (np.float32, np.float64):
+        preds = preds.astype(np.float64)
+    if y_true.shape != preds.shape:
+        raise ValueError(f"y_true and preds have different lengths: {len(y_true)} != {len(preds)}")
+
+    thresholds, tps, fps = _ranked_counts(y_true, preds)
+    positives, negatives = tps[-1], fps[-1]
+
+    # Trapezoids between the (fpr, tpr) points of the distinct scores
+    tpr = np.concatenate([[0.0], tps / positives]) if positives else np.zeros(len(tps) + 1)
+    fpr = np.concatenate([[0.0], fps / negatives]) if negatives else np.zeros(len(fps) + 1)
+    auc = float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2)) if positives and negatives else float("nan")
+
+    eps = np.finfo(preds.dtype).eps
+    clipped = np.clip(preds.astype(np.float64), eps, 1 - eps)
+    logloss = float(-np.mean(y_true * np.log(clipped) + (1 - y_true) * np.log(1 - clipped)))
+
+    precision = tps / (tps + fps)
+    recall = tps / positives if positives else np.zeros(len(tps))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        f1 = np.where(tps > 0, 2 * precision * recall / (precision + recall), 0.0)
+
+    # Predictions >= threshold are the runs whose score is >= threshold
+    above = np.searchsorted(-thresholds, -threshold, side="right")
+    tp, fp = (tps[above - 1], fps[above - 1]) if above else (0.0, 0.0)
+
+    best = int(np.argmax(f1))
+    points = np.unique(np.linspace(0, len(thresholds) - 1, min(CURVE_POINTS, len(thresholds))).astype(np.int64))
+    return {
+        "precision": float(tp / (tp + fp)) if tp + fp else 0.0,
+        "recall": float(tp / positives) if positives else 0.0,
+        "f1": float(2 * tp / (tp + fp + positives)) if tp else 0.0,
+        "AUC": auc,
+        "logloss": logloss,
+        "best_f1": float(f1[best]),
+        "best_f1_threshold": float(thresholds[best]),
+        "curve": {"threshold": thresholds[points].tolist(), "precision": precision[points].tolist(),
+                  "recall": recall[points].tolist(), "f1": f1[points].tolist()},
+    }
+
+
+def basket_f1(user_ids, y_true, preds, method="optimizer", threshold=0.5):
+    """
+    Mean F1 of the basket selected for every user, with the "None" convention of the Instacart metric: a user
+    without any positive expects "None", and "None" is predicted when nothing is selected (threshold) or
+    when the optimizer expects it to pay off.
+
+    Parameters:
+    user_ids (array-like): User of every row.
+    y_true (array-like): 0/1 labels.
+    preds (array-like): Predicted probabilities.
+    method (str): "optimizer" (F1Optimizer, expected F1 maximizing baskets) or "threshold".
+    threshold (float): Selection threshold of the "threshold" method.
+
+    Returns:
+    dict: mean basket_f1, n_users and the mean basket size.
+    """
+    user_ids = np.asarray(user_ids).ravel()
+    y_true = np.asarray(y_true, dtype=np.float64).ravel()
+    preds = np.asarray(preds, dtype=np.float64).ravel()
+
+    # Grouped by user, best predictions first, so a basket is a prefix of its user's rows
+    order = np.lexsort((-preds, user_ids))
+    user_ids, y_true, preds = user_ids[order], y_true[order], preds[order]
+    starts = np.concatenate([[0], np.flatnonzero(user_ids[1:] != user_ids[:-1]) + 1])
+    sizes = np.diff(np.append(starts, len(user_ids)))
+
+    if method == "optimizer":
+        best_k, predNone, _ = F1Optimizer.maximize_expectation_batch(np.split(preds, starts[1:]))
+    elif method == "threshold":
+        best_k = np.add.reduceat((preds >= threshold).astype(np.int64), starts)
+        predNone = best_k == 0
+    else:
+        raise ValueError(f"Unknown method '{method}', expected 'optimizer' or 'threshold'")
+
+    # Position of every row within its user: selected when it is among the user's best_k
+    rank = np.arange(len(user_ids)) - np.repeat(starts, sizes)
+    selected = rank < np.repeat(best_k, sizes)
+
+    n_true = np.add.reduceat(y_true, starts)
+    true_none = n_true == 0
+    tp = np.add.reduceat(y_true * selected, starts) + (predNone & true_none)
+    n_predicted = best_k + predNone
+    f1 = 2 * tp / (n_predicted + n_true + true_none)
+
+    return {"basket_f1": float(f1.mean()), "n_users": int(len(starts)),
+            "mean_basket_size": float(best_k.mean())}
+
+
+def evaluate(y_true, preds, user_ids=None, threshold=0.5, basket_method="optimizer"):
+    """
+    Every metric of a model in one report: binary_metrics, and basket_f1 when user_ids are given.
+
+    Returns:
+    dict: The report.
+    """
+    report = binary_metrics(y_true, preds, threshold)
+    if user_ids is not None:
+        report.update(basket_f1(user_ids, y_true, preds, basket_method, threshold))
+    return report
+
+
+def log_evaluation(report, artifact_file="evaluation.json", logger=None, run_id=None):
+    """
+    Logs the scalar metrics of a report to the active MLflow run, or to run_id through a
+    BackgroundMlflowLogger, and the full report as one artifact.
+    """
+    metrics = {name: value for name, value in report.items() if isinstance(value, float)}
+    if logger is not None:
+        logger.log_metrics(run_id, metrics)
+        logger.log_dict(run_id, report, artifact_file)
+        return
+    mlflow.log_metrics(metrics)
+    mlflow.log_dict(report, artifact_file)
@@ -0,0 +1,123 @@
+import os
+import time
+import psutil
+import pandas as pd
+import xgboost as xgb
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Thread count parameter of every ModelTrainer method. H2O models run in the H2O cluster, whose cores are
+# set once by h2o.init(nthreads=...): their threads are only reserved here.
+THREAD_PARAMS = {
+    "train_xgb_gbm": "nthread",
+    "train_xgb_rf": "nthread",
+    "train_lgbm": "num_threads",
+    "train_h2o_glm": None,
+    "train_h2o_gbm": None,
+}
+
+
+def _exclusive_data_sets(spec):
+    # A DMatrix that is not a QuantileDMatrix (in-memory or external memory) can only be read by one thread
+    # at a time: XGBoost jobs sharing one run one after another
+    if not spec["method"].startswith("train_xgb"):
+        return set()
+    trainer = spec["trainer"]
+    return {id(data_set) for data_set in (trainer.train_set, trainer.test_set)
+            if isinstance(data_set, xgb.DMatrix) and not isinstance(data_set, xgb.QuantileDMatrix)}
+
+
+def _run_job(spec, params, prev_commit_hash, dataset_version, model_version):
+    trainer = spec["trainer"]
+    start = time.time()
+    try:
+        model = getattr(trainer, spec["method"])(prev_commit_hash, dataset_version, model_version, params)
+        return model, trainer.last_report, None, time.time() - start
+    except Exception as e:
+        return None, None, str(e), time.time() - start
+
+
+def run_models(specs, prev_commit_hash, dataset_version, model_version, total_cores=None, memory_budget_gb=None):
+    """
+    Trains several models concurrently within a core and memory budget.
+
+    A job starts as soon as enough cores and memory are free, in the order of specs (put the longest
+    first), and its cores are handed to the next jobs when it ends. A job larger than the whole budget
+    runs alone. XGBoost jobs sharing a DMatrix that is not a QuantileDMatrix never run together.
+
+    Parameters:
+    specs (list): One dict per model with
+                  - "name" (str): Name in the comparison table.
+                  - "trainer" (ModelTrainer): Trainer holding the data set of the model's library.
+                  - "method" (str): ModelTrainer method, e.g. "train_xgb_gbm" (see THREAD_PARAMS).
+                  - "params" (dict, optional): Model parameters.
+                  - "threads" (int, optional): Cores of the job. Defaults to an equal share of total_cores.
+                  - "memory_gb" (float, optional): Estimated peak memory of the job. Defaults to 0.
+    prev_commit_hash (str): The commit hash for version control.
+    dataset_version (str): The version of the dataset.
+    model_version (str): The version of the model.
+    total_cores (int, optional): Cores to share. Defaults to every core.
+    memory_budget_gb (float, optional): Memory to share. Defaults to 80% of the physical memory.
+
+    Returns:
+    tuple: (dict name -> trained model, or None when it failed, comparison pd.DataFrame).
+    """
+    if not specs:
+        return {}, pd.DataFrame()
+
+    total_cores = total_cores or os.cpu_count()
+    memory_budget_gb = memory_budget_gb or 0.8 * psutil.virtual_memory().total / 1024 ** 3
+
+    for spec in specs:
+        if spec["method"] not in THREAD_PARAMS:
+            raise ValueError(f"Unknown method '{spec['method']}', expected one of {list(THREAD_PARAMS)}")
+    names = [spec["name"] for spec in specs]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Model names must be unique, got {names}")
+
+    default_threads = max(total_cores // max(len(specs), 1), 1)
+    pending = list(specs)
+    running = {}
+    free_cores, free_memory_gb = total_cores, memory_budget_gb
+    busy_data_sets = set()
+    models, rows = {}, []
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max(len(specs), 1)) as executor:
+        while pending or running:
+            for spec in list(pending):
+                threads = min(spec.get("threads") or default_threads, total_cores)
+                memory_gb = spec.get("memory_gb", 0)
+                data_sets = _exclusive_data_sets(spec)
+                if running and (threads > free_cores or memory_gb > free_memory_gb or data_sets & busy_data_sets):
+                    continue
+
+                params = dict(spec.get("params") or {})
+                if THREAD_PARAMS[spec["method"]] is not None:
+                    params[THREAD_PARAMS[spec["method"]]] = threads
+
+                future = executor.submit(_run_job, spec, params, prev_commit_hash, dataset_version, model_version)
+                running[future] = (spec, threads, memory_gb, data_sets, time.time() - start)
+                free_cores -= threads
+                free_memory_gb -= memory_gb
+                busy_data_sets |= data_sets
+                pending.remove(spec)
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                spec, threads, memory_gb, data_sets, started = running.pop(future)
+                free_cores += threads
+                free_memory_gb += memory_gb
+                busy_data_sets -= data_sets
+
+                model, report, error, duration = future.result()
+                models[spec["name"]] = model
+                rows.append({
+                    "name": spec["name"], "method": spec["method"], "threads": threads, "memory_gb": memory_gb,
+                    "started_s": started, "duration_s": duration, "status": "failed: " + error if error else "ok",
+                    **{metric: value for metric, value in (report or {}).items() if isinstance(value, float)},
+                })
+
+    elapsed = time.time() - start
+    table = pd.DataFrame(rows).set_index("name").loc[names]
+    print(f"Trained {len(specs)} models in {elapsed:.1f}s, {table['duration_s'].sum():.1f}s one after another")
+    return models, table
@@ -0,0 +1,326 @@
+import os
+import json
+import time
+import threading
+import numpy as np
+import pyarrow as pa
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Symlink to the live version of the store, swapped atomically by every build
+CURRENT_LINK = "current"
+
+# Constant columns appended to every row, as in generate_test_set_features
+TIME_CONSTANT_COLUMNS = ["time_mean_dow_count", "time_mean_ohod_count"]
+
+# Arrays of one store version, opened memory-mapped
+ARRAY_FILES = ["user_ids", "user_values", "product_ids", "product_values",
+               "up_user_ids", "up_offsets", "up_product_ids", "up_values"]
+
+
+def _to_arrow(table):
+    # pandas and Polars frames are converted, pyarrow Tables (e.g. from read_feature_set) are used as is
+    if isinstance(table, pa.Table):
+        return table
+    if hasattr(table, "to_arrow"):
+        return table.to_arrow()
+    return pa.Table.from_pandas(table, preserve_index=False)
+
+
+def _column(table, name, dtype):
+    # Nulls become NaN, like the missing values of the DMatrix
+    return table.column(name).to_numpy(zero_copy_only=False).astype(dtype)
+
+
+def _values(table, columns):
+    values = np.empty((table.num_rows, len(columns)), dtype=np.float32)
+    for i, name in enumerate(columns):
+        values[:, i] = _column(table, name, np.float32)
+    return values
+
+
+def build_online_store(store_path, user_features, product_features, user_product_features, time_constants,
+                       keep_versions=2):
+    """
+    Writes the feature tables as sorted, memory-mappable arrays in a new version directory of store_path
+    and atomically points store_path/current to it.
+
+    Values are stored as float32, the precision XGBoost scores with. User x product rows are stored
+    sorted by (user_id, product_id) with per-user offsets, so a lookup reads one contiguous slice.
+
+    Parameters:
+    store_path (str): Local root directory of the store.
+    user_features, product_features, user_product_features: The FeatureGenerator outputs, as pyarrow
+                                                              Tables, pandas or Polars DataFrames.
+    time_constants (tuple): (time_mean_dow_count, time_mean_ohod_count), see generate_time_constants.
+    keep_versions (int): Number of versions kept, older ones are deleted once they are no longer current.
+
+    Returns:
+    str: The new version directory.
+    """
+    user_features = _to_arrow(user_features)
+    product_features = _to_arrow(product_features)
+    user_product_features = _to_arrow(user_product_features)
+
+    for name, table, keys in [("user_features", user_features, ["user_id"]),
+                              ("product_features", product_features, ["product_id"]),
+                              ("user_product_features", user_product_features, ["user_id", "product_id"])]:
+        missing = [key for key in keys if key not in table.column_names]
+        if missing:
+            raise NameError(f"{missing} not found in {name}")
+
+    keys = ["user_id", "product_id"]
+    user_columns = [col for col in user_features.column_names if col not in keys]
+    product_columns = [col for col in product_features.column_names if col not in keys]
+    user_product_columns = [col for col in user_product_features.column_names if col not in keys]
+
+    user_ids = _column(user_features, "user_id", np.int64)
+    user_order = np.argsort(user_ids, kind="stable")
+    product_ids = _column(product_features, "product_id", np.int64)
+    product_order = np.argsort(product_ids, kind="stable")
+
+    up_users = _column(user_product_features, "user_id", np.int64)
+    up_products = _column(user_product_features, "product_id", np.int64)
+    up_order = np.lexsort((up_products, up_users))
+    up_users = up_users[up_order]
+    up_user_ids, up_starts = np.unique(up_users, return_index=True)
+
+    arrays = {
+        "user_ids": user_ids[user_order],
+        "user_values": _values(user_features, user_columns)[user_order],
+        "product_ids": product_ids[product_order],
+        "product_values": _values(product_features, product_columns)[product_order],
+        "up_user_ids": up_user_ids,
+        "up_offsets": np.append(up_starts, len(up_users)).astype(np.int64),
+        "up_product_ids": up_products[up_order],
+        "up_values": _values(user_product_features, user_product_columns)[up_order],
+    }
+
+    os.makedirs(store_path, exist_ok=True)
+    version = f"v{time.time_ns()}"
+    version_path = os.path.join(store_path, version)
+    os.makedirs(version_path)
+    for name, array in arrays.items():
+        np.save(os.path.join(version_path, f"{name}.npy"), array)
+
+    meta = {
+        "columns": keys + user_columns + product_columns + user_product_columns + TIME_CONSTANT_COLUMNS,
+        "user_columns": user_columns,
+        "product_columns": product_columns,
+        "user_product_columns": user_product_columns,
+        "time_constants": [float(value) for value in time_constants],
+    }
+    with open(os.path.join(version_path, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+
+    # A new symlink renamed over the old one: readers see either the old or the new version, never a mix
+    link = os.path.join(store_path, CURRENT_LINK)
+    staging_link = os.path.join(store_path, f".{CURRENT_LINK}-{version}")
+    os.symlink(version, staging_link)
+    os.replace(staging_link, link)
+
+    # Open stores keep their memory maps of deleted versions until they refresh
+    versions = sorted(name for name in os.listdir(store_path) if name.startswith("v") and name != version)
+    for old in versions[:max(len(versions) - keep_versions + 1, 0)]:
+        old_path = os.path.join(store_path, old)
+        for name in os.listdir(old_path):
+            os.remove(os.path.join(old_path, name))
+        os.rmdir(old_path)
+
+    return version_path
+
+
+class _StoreVersion:
+
+    def __init__(self, version_path):
+
+        self.path = version_path
+        with open(os.path.join(version_path, "meta.json")) as f:
+            self.meta = json.load(f)
+        for name in ARRAY_FILES:
+            setattr(self, name, np.load(os.path.join(version_path, f"{name}.npy"), mmap_mode="r"))
+
+        self.columns = self.meta["columns"]
+        self.n_user = len(self.meta["user_columns"])
+        self.n_product = len(self.meta["product_columns"])
+        self.n_user_product = len(self.meta["user_product_columns"])
+        self.time_constants = np.array(self.meta["time_constants"], dtype=np.float32)
+
+
+def _lookup(sorted_ids, ids):
+    # Positions of ids in sorted_ids, with a mask of the ids that were found
+    positions = np.searchsorted(sorted_ids, ids)
+    positions = np.minimum(positions, max(len(sorted_ids) - 1, 0))
+    found = sorted_ids[positions] == ids if len(sorted_ids) else np.zeros(len(ids), dtype=bool)
+    return positions, found
+
+
+class OnlineFeatureStore:
+    """
+    Read side of the online store: memory-mapped, key-sorted feature arrays answering
+    get_features(user_id, product_ids) with binary searches.
+
+    refresh() opens the version store_path/current points to and swaps it in with a single reference
+    assignment, so lookups in flight finish on the version they started with and never pause for a reload.
+    """
+
+    def __init__(self, store_path):
+        """
+        Parameters:
+        store_path (str): Root directory written by build_online_store.
+        """
+        self.store_path = store_path
+        self._lock = threading.Lock()
+        self._version = None
+        if not self.refresh():
+            raise FileNotFoundError(f"No {CURRENT_LINK} version in {store_path}, build it with build_online_store")
+
+    @property
+    def columns(self):
+        return self._version.columns
+
+    def refresh(self):
+        """
+        Switches to the current version if it changed.
+
+        Returns:
+        bool: True when a new version was opened.
+        """
+        link = os.path.join(self.store_path, CURRENT_LINK)
+        with self._lock:
+            if not os.path.islink(link):
+                return False
+            version_path = os.path.join(self.store_path, os.readlink(link))
+            if self._version is not None and self._version.path == version_path:
+                return False
+            self._version = _StoreVersion(version_path)
+            return True
+
+    def get_features(self, user_id, product_ids):
+        """
+        Builds the feature rows of a user's candidate products, in the column order of the featured test set.
+
+        Unknown users, products or user x product pairs get NaN features, like missing values in training.
+
+        Parameters:
+        user_id (int): The user.
+        product_ids (array-like): The candidate products.
+
+        Returns:
+        np.ndarray: float32 array of shape (len(product_ids), len(columns)).
+        """
+        version = self._version
+        product_ids = np.asarray(product_ids, dtype=np.int64)
+        n = len(product_ids)
+
+        rows = np.full((n, len(version.columns)), np.nan, dtype=np.float32)
+        rows[:, 0] = user_id
+        rows[:, 1] = product_ids
+        start = 2
+
+        position, found = _lookup(version.user_ids, np.array([user_id], dtype=np.int64))
+        if found[0]:
+            rows[:, start:start + version.n_user] = version.user_values[position[0]]
+        start += version.n_user
+
+        positions, found = _lookup(version.product_ids, product_ids)
+        rows[found, start:start + version.n_product] = version.product_values[positions[found]]
+        start += version.n_product
+
+        position, user_found = _lookup(version.up_user_ids, np.array([user_id], dtype=np.int64))
+        if user_found[0]:
+            first, last = version.up_offsets[position[0]], version.up_offsets[position[0] + 1]
+            positions, found = _lookup(version.up_product_ids[first:last], product_ids)
+            rows[found, start:start + version.n_user_product] = version.up_values[first + positions[found]]
+        start += version.n_user_product
+
+        rows[:, start:] = version.time_constants
+        return rows
+
+
+def measure_latency(store, n_requests=1000, n_products=100, seed=0):
+    """
+    Times get_features for random users with n_products random candidates each.
+
+    Returns:
+    dict: p50, p99 and max latency in milliseconds.
+    """
+    rng = np.random.default_rng(seed)
+    version = store._version
+    latencies = np.empty(n_requests)
+    for i in range(n_requests):
+        user_id = int(rng.choice(version.user_ids))
+        product_ids = rng.choice(version.product_ids, size=n_products)
+        start = time.perf_counter()
+        store.get_features(user_id, product_ids)
+        latencies[i] = (time.perf_counter() - start) * 1000
+    return {"p50_ms": float(np.percentile(latencies, 50)), "p99_ms": float(np.percentile(latencies, 99)),
+            "max_ms": float(latencies.max())}
+
+
+def make_server(store, host="127.0.0.1", port=8080):
+    """
+    Local HTTP stand-in of the feature service.
+
+    GET /features?user_id=1&product_ids=196,12427 returns {"columns": [...], "rows": [[...], ...]}
+    (null for missing values) and POST /refresh picks up a newly built version.
+
+    Returns:
+    ThreadingHTTPServer: The server, run it with serve_forever().
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _send(self, status, body):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != "/features":
+                return self._send(404, {"error": f"unknown path {url.path}"})
+
+            query = parse_qs(url.query)
+            try:
+                user_id = int(query["user_id"][0])
+                product_ids = [int(p) for p in query.get("product_ids", [""])[0].split(",") if p]
+            except (KeyError, ValueError):
+                return self._send(400, {"error": "expected user_id=<int>&product_ids=<int>,<int>,..."})
+
+            rows = store.get_features(user_id, product_ids)
+            self._send(200, {"columns": store.columns,
+                             "rows": np.where(np.isnan(rows), None, rows).tolist()})
+
+        def do_POST(self):
+            if urlparse(self.path).path != "/refresh":
+                return self._send(404, {"error": f"unknown path {self.path}"})
+            self._send(200, {"refreshed": store.refresh()})
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+def main():
+    # Store written by final_dataset_generator when ONLINE_STORE_PATH is set
+    store_path = os.getenv("ONLINE_STORE_PATH")
+    port = int(os.getenv("ONLINE_STORE_PORT", 8080))
+
+    if not store_path:
+        raise ValueError("Please set ONLINE_STORE_PATH in environment variables.")
+
+    store = OnlineFeatureStore(store_path)
+    print(f"get_features latency: {measure_latency(store)}")
+
+    server = make_server(store, port=port)
+    print(f"Serving features on http://127.0.0.1:{port}/features")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,407 @@
+import polars as pl
+from instacart_feature_transformation_script import DEFAULT_PRODUCT_ATTRIBUTES, COMBINED_PRODUCT_ATTRIBUTES
+
+# Single-node backend of instacart-basket-analysis.py: the same features, computed in process with
+# Polars instead of Spark. Every method mirrors its Spark counterpart and returns the same columns in
+# the same order. Like the Spark features, every numeric column except ids, the day and hour of the
+# order and the label is a Float64.
+RAW_COLUMNS = ["user_id", "product_id", "order_id", "dow", "hour_of_day", "reordered"]
+
+
+def _lazy(df):
+    return df.lazy() if isinstance(df, pl.DataFrame) else df
+
+
+def _columns(df):
+    return _lazy(df).collect_schema().names()
+
+
+def _to_double(df):
+    schema = _lazy(df).collect_schema()
+    return df.with_columns(
+        [pl.col(col).cast(pl.Float64) for col, dtype in schema.items() if dtype.is_numeric() and col not in RAW_COLUMNS]
+    )
+
+
+class FeatureGenerator:
+
+    def __init__(self, prior_product_orders, prior_orders_df, products_df, streak_thresholds=(5, 3, 2),
+                 product_attributes=None):
+        """
+        Parameters:
+        prior_product_orders (pl.DataFrame | pl.LazyFrame): Order-product rows.
+        prior_orders_df (pl.DataFrame | pl.LazyFrame): Orders.
+        products_df (pl.DataFrame | pl.LazyFrame): Products.
+        streak_thresholds (tuple): Streak lengths of the prob_of_reordered_N features.
+        product_attributes (dict, optional): attribute -> case-insensitive regular expression on the
+                                             product name. Defaults to DEFAULT_PRODUCT_ATTRIBUTES.
+        """
+        self.prior_product_orders = _lazy(prior_product_orders) if prior_product_orders is not None else None
+        self.prior_orders_df = _lazy(prior_orders_df) if prior_orders_df is not None else None
+        self.products_df = _lazy(products_df) if products_df is not None else None
+        self.streak_thresholds = tuple(streak_thresholds)
+        self.product_attributes = dict(product_attributes if product_attributes is not None
+                                       else DEFAULT_PRODUCT_ATTRIBUTES)
+        self._frames = {}
+        # Scalars (counts) computed once, kept apart from the frames like in the Spark backend
+        self._values = {}
+
+    def _memoize(self, name, build):
+
+        # Frames are collected once, the shared ones play the role of the persisted Spark frames
+        if name not in self._frames:
+            self._frames[name] = build().collect()
+        return self._frames[name]
+
+    def _memoize_value(self, name, build):
+
+        # Same as _memoize for scalars, e.g. a count
+        if name not in self._values:
+            self._values[name] = build()
+        return self._values[name]
+
+    def unpersist(self):
+
+        self._frames = {}
+
+    def generate_enriched_product_orders(self):
+
+        # Order-product rows with their order attributes and basket size, shared by every feature
+        return self._memoize("enriched_product_orders", lambda: (
+            self.prior_product_orders
+            .join(self.prior_orders_df.select("order_id", "user_id", "order_number", "order_dow", "order_hour_of_day"),
+                  on="order_id", how="left")
+            .with_columns(pl.col("product_id").count().over("order_id").cast(pl.Int64).alias("basket_size"))
+        ))
+
+    def generate_product_attributes(self):
+
+        # One 0/1 flag per attribute for each product, null when the name is missing
+        def build():
+
+            flags = {name: pl.col("product_name").str.contains(f"(?i){pattern}").cast(pl.Int32)
+                     for name, pattern in self.product_attributes.items()}
+            combined = [flags[name] for name in COMBINED_PRODUCT_ATTRIBUTES if name in flags]
+            is_asian_org_item = pl.max_horizontal(combined) if combined else pl.lit(None, dtype=pl.Int32)
+
+            return self.products_df.select(
+                "product_id", is_asian_org_item.alias("is_asian_org_item"),
+                *[flags[name].alias(f"is_{name}_item") for name in self._extra_product_attributes()]
+            )
+
+        return self._memoize("product_attributes", build)
+
+    def _extra_product_attributes(self):
+
+        return [name for name in self.product_attributes if name not in COMBINED_PRODUCT_ATTRIBUTES]
+
+    def generate_order_stats(self):
+
+        # One row per order of the statistics the user features are built from
+        return self._memoize("order_stats", lambda: (
+            self.generate_enriched_product_orders().lazy()
+            .join(self.generate_product_attributes().lazy(), on="product_id", how="left")
+            .group_by("user_id", "order_id")
+            .agg(pl.col("reordered").count().alias("count_of_reordered"),
+                 pl.col("product_id").count().alias("count_of_product"),
+                 (pl.col("reordered") == 1).fill_null(False).cast(pl.Int32).max().alias("contains_reordered"),
+                 # Does the order contain Asian, gluten-free, or organic items
+                 pl.col("is_asian_org_item").max().alias("contains_or_not"),
+                 *[pl.col(f"is_{name}_item").max().alias(f"contains_{name}") for name in self._extra_product_attributes()])
+        ))
+
+    def generate_user_product_stats(self):
+
+        # One row per user and product, shared by the user x product and product features
+        return self._memoize("user_product_stats", lambda: (
+            self.generate_enriched_product_orders().lazy()
+            .group_by("user_id", "product_id")
+            .agg(pl.col("order_id").count().alias("num_of_ord_purch_p_prod"),
+                 pl.col("add_to_cart_order").mean().alias("prod_mean_of_position_p_user"),
+                 (pl.col("basket_size") - 1).sum().alias("num_of_prod_co_ocrd_p_usr_p_prod"),
+                 (pl.col("basket_size") == 1).cast(pl.Int32).max().alias("has_user_purchased_one_shot"))
+        ))
+
+    def generate_candidate_index(self):
+
+        # Distinct products of every user, sorted by user (see select_candidates)
+        return self._memoize("candidate_index", lambda: (
+            self.generate_user_product_stats().lazy().select("user_id", "product_id").sort("user_id", "product_id")
+        ))
+
+    def generate_total_orders(self):
+
+        return self._memoize_value("total_orders", lambda: (
+            self.prior_orders_df.select(pl.col("order_id").n_unique()).collect().item()
+        ))
+
+    def generate_user_related_features(self):
+
+        return self._memoize("user_features", lambda: _to_double(
+            self.generate_order_stats().lazy()
+            .group_by("user_id")
+            .agg(
+                # How often user has reordered
+                pl.col("count_of_reordered").sum().alias("frequency_of_reorder"),
+                # Does the user order Asian, gluten-free, or organic items
+                pl.col("contains_or_not").sum().alias("count_of_asian_org_items"),
+                pl.col("contains_or_not").mean().alias("mean_of_asian_org_items"),
+                # Feature based on order size
+                pl.col("count_of_product").max().alias("max_count_of_products"),
+                pl.col("count_of_product").min().alias("min_count_of_products"),
+                pl.col("count_of_product").mean().alias("mean_count_of_products"),
+                # How many of the user’s orders contained no previously purchased items
+                (1 - pl.col("contains_reordered")).sum().alias("count_ord_no_prev_purchased_items"),
+                (1 - pl.col("contains_reordered")).mean().alias("mean_ord_no_prev_purchased_items"),
+                # Same for every other configured product attribute
+                *[agg for name in self._extra_product_attributes()
+                  for agg in (pl.col(f"contains_{name}").sum().alias(f"count_of_{name}_items"),
+                              pl.col(f"contains_{name}").mean().alias(f"mean_of_{name}_items"))]
+            )
+        ))
+
+    def generate_product_related_features(self):
+
+        def build():
+
+            total_orders = self.generate_total_orders()
+            co_occurred = pl.col("basket_size") - 1
+
+            df_with_product_stats = (
+                self.generate_enriched_product_orders().lazy()
+                .group_by("product_id")
+                .agg(
+                    # Position of product
+                    pl.col("add_to_cart_order").mean().alias("product_mean_of_position"),
+                    # Statistics on the number of items that co-occur with this item
+                    co_occurred.sum().alias("number_of_product_co_occurred"),
+                    co_occurred.mean().alias("mean_of_co_ocuured_product_per_order"),
+                    co_occurred.min().alias("min_of_co_ocuured_product_per_order"),
+                    co_occurred.max().alias("max_of_co_ocuured_product_per_order"),
+                    # Probability it is reordered after the first order
+                    (pl.col("user_id").count() / total_orders).alias("prob_of_being_reordered"),
+                    # Distribution of the day of week it is ordered
+                    *[(pl.col("order_dow") == dow).cast(pl.Int32).sum().alias(f"distrib_count_of_dow_{dow}_p_prod")
+                      for dow in range(7)]
+                )
+            )
+
+            # How many users buy it as a "one-shot" item
+            df_with_freq_one_shot_ord_prods = (
+                self.generate_user_product_stats().lazy()
+                .group_by("product_id")
+                .agg(pl.col("has_user_purchased_one_shot").sum().alias("number_of_user_purchased_item"))
+            )
+
+            # Stats on the order streak and probability of being reordered within N orders
+            df_with_stats_of_streaks = (
+                self.generate_streak_lengths().lazy()
+                .group_by("product_id")
+                .agg(pl.col("grp").count().alias("Total_streak_of_this_product"),
+                     pl.col("length_of_streaks").mean().alias("mean_of_streaks_of_this_product"),
+                     pl.col("length_of_streaks").min().alias("min_of_streaks_of_this_product"),
+                     pl.col("length_of_streaks").max().alias("max_of_streaks_of_this_product"),
+                     *[((pl.col("length_of_streaks") >= threshold).cast(pl.Int32).sum()
+                        / pl.col("length_of_streaks").count()).alias(f"prob_of_reordered_{threshold}")
+                       for threshold in self.streak_thresholds])
+            )
+
+            return _to_double(
+                df_with_product_stats
+                .join(df_with_freq_one_shot_ord_prods, on="product_id", how="left")
+                .join(df_with_stats_of_streaks, on="product_id", how="left")
+                .select("product_id", "product_mean_of_position", "number_of_user_purchased_item",
+                        "number_of_product_co_occurred", "mean_of_co_ocuured_product_per_order",
+                        "min_of_co_ocuured_product_per_order", "max_of_co_ocuured_product_per_order",
+                        "Total_streak_of_this_product", "mean_of_streaks_of_this_product",
+                        "min_of_streaks_of_this_product", "max_of_streaks_of_this_product",
+                        *[f"prob_of_reordered_{threshold}" for threshold in self.streak_thresholds],
+                        *[f"distrib_count_of_dow_{dow}_p_prod" for dow in range(7)],
+                        "prob_of_being_reordered")
+            )
+
+        return self._memoize("product_features", build)
+
+    def generate_basket_sizes(self):
+
+        # Number of products in every order
+        return self._memoize("basket_sizes", lambda: (
+            self.generate_enriched_product_orders().lazy()
+            .group_by("order_id")
+            .agg(pl.col("basket_size").max())
+        ))
+
+    def generate_streak_flags(self):
+
+        # Same streak ids as the Spark backend: grp from the continuation flag, island from the
+        # order number. Rows are sorted once so the per-group expressions run in order
+        keys = ["user_id", "product_id"]
+        return self._memoize("streak_flags", lambda: (
+            self.generate_enriched_product_orders().lazy()
+            .select("user_id", "product_id", "order_number")
+            .sort("user_id", "product_id", "order_number")
+            .with_columns(((pl.col("order_number").shift(-1) - pl.col("order_number")) == 1)
+                          .fill_null(False).cast(pl.Int64).over(keys).alias("is_streak_continued_flag"),
+                          (pl.int_range(pl.len()) + 1).over(keys).alias("row_number"))
+            .with_columns(pl.col("is_streak_continued_flag").cum_sum().over(keys).alias("continued_count"))
+            .with_columns(pl.when(pl.col("is_streak_continued_flag") == 1)
+                          .then(pl.col("row_number") - pl.col("continued_count"))
+                          .otherwise(pl.col("continued_count")).alias("grp"),
+                          (pl.col("order_number") - pl.col("row_number")).alias("island"))
+        ))
+
+    def generate_streak_lengths(self):
+
+        # Length of the order streaks of every product per user
+        return self._memoize("streak_lengths", lambda: (
+            self.generate_streak_flags().lazy()
+            .group_by("user_id", "product_id", "grp")
+            .agg(pl.col("order_number").count().alias("length_of_streaks"))
+        ))
+
+    def generate_current_streaks(self):
+
+        def build():
+
+            # Length of the run of consecutive orders ending at the user's last order, 0 when the
+            # user didn't buy the product in that order
+            df_with_last_order = (
+                self.prior_orders_df.group_by("user_id")
+                .agg(pl.col("order_number").max().alias("last_order_number"))
+            )
+
+            return (
+                self.generate_streak_flags().lazy()
+                .group_by("user_id", "product_id")
+                .agg(pl.col("order_number").max().alias("last_purchase_order_number"),
+                     (pl.col("island") == pl.col("island").max()).sum().alias("length_of_last_streak"))
+                .join(df_with_last_order, on="user_id", how="left")
+                .select("user_id", "product_id",
+                        pl.when(pl.col("last_purchase_order_number") == pl.col("last_order_number"))
+                        .then(pl.col("length_of_last_streak")).otherwise(0).alias("current_streak_p_usr_p_prod"))
+            )
+
+        return self._memoize("current_streaks", build)
+
+    def generate_user_product_related_features(self):
+
+        # Number of orders in which the user purchases the item, position in the cart,
+        # co-occurrence statistics and the streak the user is currently on
+        return self._memoize("user_product_features", lambda: _to_double(
+            self.generate_user_product_stats().lazy()
+            .join(self.generate_current_streaks().lazy(), on=["user_id", "product_id"], how="left")
+            .select("user_id", "product_id", "num_of_ord_purch_p_prod", "prod_mean_of_position_p_user",
+                    "num_of_prod_co_ocrd_p_usr_p_prod", "current_streak_p_usr_p_prod")
+        ))
+
+    def generate_time_related_features(self):
+
+        def build():
+
+            # Counts by day of the week
+            df_with_count_of_dow = (
+                self.prior_orders_df.group_by("order_dow")
+                .agg(pl.col("order_id").count().alias("total_ord_count_p_dow"))
+            )
+
+            # Counts by hour of the day
+            df_with_count_of_ohod = (
+                self.prior_orders_df.group_by("order_hour_of_day")
+                .agg(pl.col("order_id").count().alias("total_ord_count_p_ohod"))
+            )
+
+            return _to_double(
+                self.prior_orders_df.select("user_id", "order_id", "order_dow", "order_hour_of_day")
+                .join(df_with_count_of_dow, on="order_dow", how="left")
+                .join(df_with_count_of_ohod, on="order_hour_of_day", how="left")
+                .select(pl.col("order_hour_of_day").alias("hour_of_day"), pl.col("order_dow").alias("dow"),
+                        "user_id", "order_id", "total_ord_count_p_dow", "total_ord_count_p_ohod")
+            )
+
+        return self._memoize("time_features", build)
+
+    def generate_all_types_of_features(self):
+
+        result_usr_prod_df = self.generate_user_product_related_features()
+        result_time_df = self.generate_time_related_features()
+        result_product_df = self.generate_product_related_features()
+        result_usr_df = self.generate_user_related_features()
+
+        if "all_features" not in self._frames:
+            self._frames["all_features"] = assemble_training_set(
+                self.prior_product_orders, result_usr_df, result_product_df, result_usr_prod_df, result_time_df
+            )
+        return self._frames["all_features"]
+
+
+def assemble_training_set(prior_product_orders, user_stats_df, prods_stats_df, user_prod_stats_df, time_related_stats):
+
+    # Column order of the Spark joins: join keys first, then the left and the right columns
+    final_prior_ord_train_df = (
+        _lazy(prior_product_orders).drop("add_to_cart_order")
+        .join(_lazy(time_related_stats), on="order_id", how="left")
+        .drop("order_id", "dow", "hour_of_day")
+        .join(_lazy(user_stats_df), on="user_id", how="left")
+        .join(_lazy(prods_stats_df), on="product_id", how="left")
+        .join(_lazy(user_prod_stats_df), on=["user_id", "product_id"], how="left")
+    )
+    columns = _columns(final_prior_ord_train_df)
+    first = ["user_id", "product_id"]
+    return _to_double(final_prior_ord_train_df.select(first + [col for col in columns if col not in first])).collect()
+
+
+def select_candidates(candidate_index, users_df):
+
+    # Every product the given users bought before: the candidate pairs of their next order
+    return _lazy(candidate_index).join(_lazy(users_df).select("user_id").unique(), on="user_id", how="semi")
+
+
+def generate_time_constants(time_related_stats):
+
+    # Mean number of orders per day of the week and per hour of the day
+    return _lazy(time_related_stats).select(
+        (pl.col("order_id").count() / pl.col("dow").drop_nulls().n_unique()).alias("mean_dow"),
+        (pl.col("order_id").count() / pl.col("hour_of_day").drop_nulls().n_unique()).alias("mean_ohod")
+    ).collect().row(0)
+
+
+def generate_test_set_features(user_stats_df, prods_stats_df, user_prod_stats_df, time_related_stats, test_set):
+
+    for i in [user_stats_df, user_prod_stats_df]:
+
+        if "user_id" not in _columns(i):
+            raise NameError(f"'user_id' is missing in {i}")
+
+    for i in [prods_stats_df, user_prod_stats_df]:
+
+        if "product_id" not in _columns(i):
+            raise NameError(f"'product_id' is missing in {i}")
+
+    if "user_id" not in _columns(test_set) and "product_id" not in _columns(test_set):
+        raise NameError("'user_id' and 'product_id' both are missing in test_set")
+
+    elif "user_id" not in _columns(test_set):
+        raise NameError("'user_id' not found in test_set")
+
+    elif "product_id" not in _columns(test_set):
+        raise NameError("'product_id' not found in test_set")
+
+    mean_dow_value, mean_ohod_value = generate_time_constants(time_related_stats)
+
+    result_test_df = (
+        _lazy(test_set)
+        .join(_lazy(user_prod_stats_df), on=["user_id", "product_id"], how="inner")
+        .join(_lazy(user_stats_df), on="user_id", how="inner")
+        .join(_lazy(prods_stats_df), on="product_id", how="inner")
+        .with_columns(pl.lit(mean_dow_value, dtype=pl.Float64).alias("time_mean_dow_count"),
+                      pl.lit(mean_ohod_value, dtype=pl.Float64).alias("time_mean_ohod_count"))
+    )
+    keys = ["user_id", "product_id"]
+    first = keys + [col for col in _columns(test_set) if col not in keys]
+    return result_test_df.select(
+        first
+        + [col for col in _columns(user_stats_df) if col not in keys]
+        + [col for col in _columns(prods_stats_df) if col not in keys]
+        + [col for col in _columns(user_prod_stats_df) if col not in keys]
+        + ["time_mean_dow_count", "time_mean_ohod_count"]
+    ).collect()
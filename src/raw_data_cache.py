@@ -0,0 +1,148 @@
+import os
+import polars as pl
+from pyspark.sql import functions as F
+from pyspark.sql.types import (StructType, StructField, IntegerType, ShortType, ByteType, FloatType, DoubleType,
+                               StringType)
+
+# Raw Instacart tables, in the order of the *_FILE_PATH environment variables of final_dataset_generator
+RAW_TABLES = ("orders", "order_products__prior", "products", "order_products__train")
+
+# Tables partitioned in the columnar cache, so the eval_set filters only read their own files
+PARTITION_COLUMNS = {"orders": ["eval_set"]}
+
+# Width of days_since_prior_order, the only fractional column
+DAYS_SINCE_PRIOR_ORDER_TYPES = {"float": FloatType(), "double": DoubleType()}
+
+
+def spark_schemas(days_since_type="float"):
+    """
+    Compact schemas of the raw tables: int32 ids, int16 order numbers and cart positions, int8 day of week,
+    hour, flags and departments.
+
+    Parameters:
+    days_since_type (str): "float" (32 bit) or "double" for days_since_prior_order.
+
+    Returns:
+    dict: table name -> StructType.
+    """
+    if days_since_type not in DAYS_SINCE_PRIOR_ORDER_TYPES:
+        raise ValueError(f"days_since_type must be one of {list(DAYS_SINCE_PRIOR_ORDER_TYPES)}")
+
+    order_products = StructType([
+        StructField("order_id", IntegerType()),
+        StructField("product_id", IntegerType()),
+        StructField("add_to_cart_order", ShortType()),
+        StructField("reordered", ByteType()),
+    ])
+    return {
+        "orders": StructType([
+            StructField("order_id", IntegerType()),
+            StructField("user_id", IntegerType()),
+            StructField("eval_set", StringType()),
+            StructField("order_number", ShortType()),
+            StructField("order_dow", ByteType()),
+            StructField("order_hour_of_day", ByteType()),
+            StructField("days_since_prior_order", DAYS_SINCE_PRIOR_ORDER_TYPES[days_since_type]),
+        ]),
+        "order_products__prior": order_products,
+        "products": StructType([
+            StructField("product_id", IntegerType()),
+            StructField("product_name", StringType()),
+            StructField("aisle_id", ShortType()),
+            StructField("department_id", ByteType()),
+        ]),
+        "order_products__train": order_products,
+    }
+
+
+def polars_schemas(days_since_type="float"):
+    """
+    Polars counterpart of spark_schemas.
+
+    Returns:
+    dict: table name -> {column: dtype}.
+    """
+    dtypes = {IntegerType(): pl.Int32, ShortType(): pl.Int16, ByteType(): pl.Int8, FloatType(): pl.Float32,
+              DoubleType(): pl.Float64, StringType(): pl.String}
+    return {
+        name: {field.name: dtypes[field.dataType] for field in schema.fields}
+        for name, schema in spark_schemas(days_since_type).items()
+    }
+
+
+def _fs_path(spark, path):
+    jvm_path = spark._jvm.org.apache.hadoop.fs.Path(path)
+    return jvm_path, jvm_path.getFileSystem(spark._jsc.hadoopConfiguration())
+
+
+def read_raw_tables(spark, csv_paths, cache_path=None, days_since_type="float", compression="zstd"):
+    """
+    Reads the raw tables with their typed schemas.
+
+    With a cache path, every table is converted once into a compressed Parquet copy under
+    cache_path/<table>, and later runs read that copy instead of parsing the CSV again.
+
+    Parameters:
+    spark (SparkSession): The active Spark session.
+    csv_paths (dict): table name -> CSV path.
+    cache_path (str, optional): Root directory of the columnar cache (any Hadoop-compatible path).
+    days_since_type (str): "float" or "double" for days_since_prior_order.
+    compression (str): Parquet codec of the cache.
+
+    Returns:
+    dict: table name -> DataFrame.
+    """
+    schemas = spark_schemas(days_since_type)
+    tables = {}
+    for name, csv_path in csv_paths.items():
+        schema = schemas[name]
+
+        if cache_path is None:
+            tables[name] = spark.read.csv(csv_path, header=True, schema=schema)
+            continue
+
+        table_path = f"{cache_path.rstrip('/')}/{name}"
+        success, fs = _fs_path(spark, f"{table_path}/_SUCCESS")
+        if not fs.exists(success):
+            (spark.read.csv(csv_path, header=True, schema=schema)
+             .write.mode("overwrite").option("compression", compression)
+             .partitionBy(*PARTITION_COLUMNS.get(name, []))
+             .parquet(table_path))
+
+        # Cast back to the requested schema, the cache may have been written with another float width
+        tables[name] = spark.read.parquet(table_path).select(
+            [F.col(field.name).cast(field.dataType) for field in schema.fields]
+        )
+    return tables
+
+
+def read_raw_tables_polars(csv_paths, cache_path=None, days_since_type="float", compression="zstd"):
+    """
+    Polars counterpart of read_raw_tables, returning LazyFrames. The cache has the same layout, so
+    either backend can read a cache written by the other (cache_path must be local here).
+    """
+    schemas = polars_schemas(days_since_type)
+    tables = {}
+    for name, csv_path in csv_paths.items():
+        schema = schemas[name]
+
+        if cache_path is None:
+            tables[name] = pl.scan_csv(csv_path, schema_overrides=schema)
+            continue
+
+        table_path = os.path.join(cache_path, name)
+        if not os.path.exists(os.path.join(table_path, "_SUCCESS")):
+            df = pl.read_csv(csv_path, schema_overrides=schema)
+            partition_cols = PARTITION_COLUMNS.get(name)
+            if partition_cols:
+                df.write_parquet(table_path, compression=compression, use_pyarrow=True,
+                                 pyarrow_options={"partition_cols": partition_cols})
+            else:
+                os.makedirs(table_path, exist_ok=True)
+                df.write_parquet(os.path.join(table_path, "part-00000.parquet"), compression=compression)
+            open(os.path.join(table_path, "_SUCCESS"), "w").close()
+
+        tables[name] = pl.scan_parquet(os.path.join(table_path, "**", "*.parquet"), hive_partitioning=True).select(
+            [pl.col(column).cast(dtype) for column, dtype in schema.items()]
+        )
+    return tables
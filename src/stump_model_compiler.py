@@ -0,0 +1,239 @@
+import os
+import json
+import time
+import numpy as np
+
+# Objectives whose prediction is the sigmoid of the margin, the others return the margin itself
+LOGISTIC_OBJECTIVES = ("binary:logistic", "reg:logistic")
+
+# Up to this many thresholds a feature is bucketed by comparisons, above it by binary search
+MAX_COMPARED_THRESHOLDS = 32
+
+
+def _load_model_json(model):
+    # A path to a JSON model, an xgb.Booster or the already parsed JSON
+    if isinstance(model, dict):
+        return model
+    if isinstance(model, (str, os.PathLike)):
+        with open(model) as f:
+            return json.load(f)
+    return json.loads(model.save_raw(raw_format="json"))
+
+
+def _base_margin(learner):
+    base_score = float(str(learner["learner_model_param"]["base_score"]).strip("[]"))
+    if learner["objective"]["name"] in LOGISTIC_OBJECTIVES:
+        return float(np.log(base_score / (1 - base_score)))
+    return base_score
+
+
+class CompiledStumpModel:
+    """
+    A depth-1 gradient boosted model collapsed into one step function per feature.
+
+    Every feature keeps its sorted, distinct split thresholds and a table with the summed leaf value
+    of each interval between them, followed by the summed leaf value of a missing value. A row is
+    scored with one interval lookup per feature and a sum, instead of walking every tree.
+    """
+
+    def __init__(self, thresholds, tables, bias, num_feature, objective, feature_names=None):
+        """
+        Parameters:
+        thresholds (dict): feature index -> sorted, distinct float32 split thresholds.
+        tables (dict): feature index -> len(thresholds) + 2 leaf value sums, one per interval and the
+                       missing value last.
+        bias (float): Base margin plus the leaf values of single-leaf trees.
+        num_feature (int): Number of input columns.
+        objective (str): XGBoost objective name.
+        feature_names (list, optional): Input column names.
+        """
+        self.thresholds = thresholds
+        self.tables = tables
+        self.bias = bias
+        self.num_feature = num_feature
+        self.objective = objective
+        self.feature_names = feature_names or None
+
+    @classmethod
+    def from_xgboost(cls, model):
+        """
+        Compiles an XGBoost gbtree model whose trees have at most one split.
+
+        Parameters:
+        model: Path of a JSON model, xgb.Booster or parsed JSON model.
+
+        Returns:
+        CompiledStumpModel: The compiled model.
+        """
+        learner = _load_model_json(model)["learner"]
+        booster = learner["gradient_booster"]
+
+        if booster["name"] != "gbtree":
+            raise ValueError(f"Only gbtree models can be compiled, got '{booster['name']}'")
+        if int(learner["learner_model_param"].get("num_class", 0)) > 1 or \
+                int(learner["learner_model_param"].get("num_target", 1)) > 1:
+            raise ValueError("Only single output models can be compiled")
+
+        bias = _base_margin(learner)
+        stumps = {}
+        for i, tree in enumerate(booster["model"]["trees"]):
+            left, right = tree["left_children"], tree["right_children"]
+            values = tree["split_conditions"]
+
+            # A single leaf adds a constant
+            if left[0] == -1:
+                bias += values[0]
+                continue
+
+            if left[left[0]] != -1 or left[right[0]] != -1:
+                raise ValueError(f"Tree {i} is deeper than one split, only max_depth=1 models can be compiled")
+
+            stumps.setdefault(tree["split_indices"][0], []).append(
+                (values[0], values[left[0]], values[right[0]], tree["default_left"][0])
+            )
+
+        thresholds, tables = {}, {}
+        for feature, splits in sorted(stumps.items()):
+            splits = np.array(splits, dtype=np.float64)
+            split_thresholds = splits[:, 0].astype(np.float32)
+            order = np.argsort(split_thresholds, kind="stable")
+            split_thresholds, splits = split_thresholds[order], splits[order]
+
+            # x < threshold goes left: when k thresholds are <= x the first k stumps go right, the others left
+            left_values, right_values = splits[:, 1], splits[:, 2]
+            cumulative = (np.concatenate([[0.0], np.cumsum(right_values)])
+                          + np.concatenate([np.cumsum(left_values[::-1])[::-1], [0.0]]))
+
+            # Stumps sharing a threshold fall into the same interval
+            thresholds[feature] = np.unique(split_thresholds)
+            intervals = np.concatenate([[0], np.searchsorted(split_thresholds, thresholds[feature], side="right")])
+            tables[feature] = np.append(cumulative[intervals],
+                                        np.where(splits[:, 3] == 1, left_values, right_values).sum())
+
+        return cls(thresholds, tables, bias, int(learner["learner_model_param"]["num_feature"]),
+                   learner["objective"]["name"], learner.get("feature_names"))
+
+    def predict(self, X, output_margin=False, dtype=np.float64):
+        """
+        Scores rows like Booster.predict.
+
+        Parameters:
+        X (array-like): (n_rows, num_feature) matrix, NaN for missing values. It is compared in float32,
+                        as XGBoost does.
+        output_margin (bool): Return the raw margin instead of the probability.
+        dtype: Accumulation type, np.float32 halves the memory traffic of the tables.
+
+        Returns:
+        np.ndarray: The predictions.
+        """
+        # Column-major, so every feature is read as one contiguous column
+        X = np.asfortranarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.num_feature:
+            raise ValueError(f"Expected a (n_rows, {self.num_feature}) matrix, got shape {X.shape}")
+
+        margin = np.full(X.shape[0], self.bias, dtype=dtype)
+        for feature, thresholds in self.thresholds.items():
+            column = X[:, feature]
+            missing = np.isnan(column)
+
+            # Interval index = number of thresholds <= x. A few comparisons beat a binary search per row
+            # for short threshold lists
+            if len(thresholds) <= MAX_COMPARED_THRESHOLDS:
+                interval = np.zeros(len(column), dtype=np.intp)
+                for threshold in thresholds:
+                    interval += column >= threshold
+            else:
+                interval = np.searchsorted(thresholds, column, side="right")
+            interval[missing] = len(thresholds) + 1
+
+            margin += self.tables[feature].astype(dtype, copy=False)[interval]
+
+        if output_margin or self.objective not in LOGISTIC_OBJECTIVES:
+            return margin
+        return 1 / (1 + np.exp(-margin))
+
+    def save(self, path):
+        """
+        Saves the tables to a .npz file, loaded back with load() without XGBoost.
+        """
+        features = sorted(self.thresholds)
+        meta = {"bias": self.bias, "num_feature": self.num_feature, "objective": self.objective,
+                "feature_names": self.feature_names, "features": features}
+        np.savez(path, meta=np.array(json.dumps(meta)),
+                 **{f"thresholds_{feature}": self.thresholds[feature] for feature in features},
+                 **{f"table_{feature}": self.tables[feature] for feature in features})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            meta = json.loads(str(arrays["meta"]))
+            features = meta["features"]
+            return cls({feature: arrays[f"thresholds_{feature}"] for feature in features},
+                       {feature: arrays[f"table_{feature}"] for feature in features},
+                       meta["bias"], meta["num_feature"], meta["objective"], meta["feature_names"])
+
+
+def check_parity(compiled_model, booster, X, atol=1e-6, dtype=np.float64):
+    """
+    Compares the compiled model with Booster.predict on X.
+
+    XGBoost sums the trees in float32 one after the other, so the two differ by rounding only.
+
+    Returns:
+    float: The largest absolute difference.
+
+    Raises:
+    AssertionError: When it is above atol.
+    """
+    # Only needed for the check, the compiled model itself does not depend on XGBoost
+    import xgboost as xgb
+
+    X = np.asarray(X, dtype=np.float32)
+    expected = booster.predict(xgb.DMatrix(X, missing=np.nan))
+    difference = float(np.abs(compiled_model.predict(X, dtype=dtype) - expected).max()) if len(X) else 0.0
+    if difference > atol:
+        raise AssertionError(f"Compiled model differs from Booster.predict by {difference} (atol={atol})")
+    return difference
+
+
+def _sample_rows(compiled_model, n_rows, seed=0):
+    # Rows that hit every interval of every step function, and missing values
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n_rows, compiled_model.num_feature)).astype(np.float32)
+    for feature, thresholds in compiled_model.thresholds.items():
+        X[:, feature] = rng.choice(np.concatenate([thresholds, np.nextafter(thresholds, -np.inf),
+                                                   [thresholds[0] - 1, thresholds[-1] + 1]]), size=n_rows)
+    X[rng.random(X.shape) < 0.05] = np.nan
+    return X
+
+
+def main():
+    import xgboost as xgb
+
+    root_dir = os.getenv('ROOT_DIR', '')
+    model_path = os.getenv("MODEL_PATH", os.path.join(root_dir, 'models', 'final_xgb_model.json'))
+    compiled_model_path = os.getenv("COMPILED_MODEL_PATH", os.path.splitext(model_path)[0] + "_compiled.npz")
+    n_rows = int(os.getenv("PARITY_CHECK_ROWS", 200_000))
+
+    booster = xgb.Booster()
+    booster.load_model(model_path)
+    compiled_model = CompiledStumpModel.from_xgboost(booster)
+    compiled_model.save(compiled_model_path)
+
+    X = _sample_rows(compiled_model, n_rows)
+    for dtype, atol in [(np.float64, 1e-6), (np.float32, 1e-5)]:
+        difference = check_parity(compiled_model, booster, X, atol=atol, dtype=dtype)
+        print(f"{np.dtype(dtype).name}: max abs difference {difference:.2e}")
+
+    start = time.perf_counter()
+    booster.predict(xgb.DMatrix(X, missing=np.nan))
+    booster_time = time.perf_counter() - start
+    start = time.perf_counter()
+    compiled_model.predict(X, dtype=np.float32)
+    compiled_time = time.perf_counter() - start
+    print(f"Booster.predict: {n_rows / booster_time:,.0f} rows/s, compiled: {n_rows / compiled_time:,.0f} rows/s")
+    print(f"Compiled model saved to {compiled_model_path}")
+
+
+if __name__ == "__main__":
+    main()